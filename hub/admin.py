@@ -1,7 +1,7 @@
 from django.contrib import admin
 from .models import (Classroom, UserAnswer, Unscramble, LabelImages, EmbeddedTask, Lesson,
                      WordList, MatchUpTheWords, Test, TrueOrFalse, MakeASentence, SortIntoColumns, Audio,
-                     FillInTheBlanks, UserAutogenerationPreferences, SavedUnsplashImage, Pdf)
+                     FillInTheBlanks, UserAutogenerationPreferences, SavedUnsplashImage, ImageSearchCache, Pdf, TtsAudioCache)
 
 admin.site.register(Classroom)
 admin.site.register(UserAnswer)
@@ -19,4 +19,6 @@ admin.site.register(Audio)
 admin.site.register(FillInTheBlanks)
 admin.site.register(UserAutogenerationPreferences)
 admin.site.register(SavedUnsplashImage)
+admin.site.register(ImageSearchCache)
+admin.site.register(TtsAudioCache)
 admin.site.register(Pdf)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import base64
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import quote_plus
 from asgiref.sync import async_to_sync
 from django.http import JsonResponse
@@ -10,8 +11,12 @@ from google import genai
 from google.genai import types
 import json, math, re, redis, os, requests
 from typing import Any, Optional, Union, Pattern
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from .models import SavedUnsplashImage, GenerationStats
+from django.db import connection
+from .models import SavedUnsplashImage, ImageSearchCache, GenerationStats
+from .utils import normalize_image_query, estimate_tokens
+from users.models import UserTokenBalance
 from api_endpoints import UNSPLASH_ACCESS_KEY, GROQ_ACCESS_KEY, GOOGLE_API_KEY, PIXABAY_API_KEY
 
 
@@ -20,34 +25,41 @@ def has_min_tokens(user, min_tokens=5):
     if not user.is_authenticated:
         add_successful_generation("tokens", False, "User not authenticated")
         return False
-    try:
-        return int(user.token_balance.tokens) >= int(min_tokens)
-    except AttributeError:
+    # Читаем свежий остаток: user.token_balance мог устареть после параллельных списаний
+    row = UserTokenBalance.objects.filter(user_id=user.id).values('tariff_tokens', 'extra_tokens').first()
+    if row is None:
         add_successful_generation("tokens", False, "Unknown error in has min_tokens")
         return False
+    return row['tariff_tokens'] + row['extra_tokens'] >= int(min_tokens)
 
-def take_tokens(user, cost):
-    try:
-        balance = user.token_balance
-    except AttributeError:
-        add_successful_generation("tokens", False, "У пользователя нет баланса токенов" + user.username)
-        return False  # У пользователя нет баланса токенов
-
-    # Проверяем, достаточно ли всех токенов
-    total_tokens = (balance.tariff_tokens or 0) + (balance.extra_tokens or 0)
-    if total_tokens < cost:
+def take_tokens(user, cost, reason=''):
+    """Атомарно списывает cost токенов (сначала тарифные, затем докупленные) с записью в журнал."""
+    if not UserTokenBalance.debit(user.id, cost, reason=reason):
+        if not UserTokenBalance.objects.filter(user_id=user.id).exists():
+            add_successful_generation("tokens", False, "У пользователя нет баланса токенов" + user.username)
         return False  # Недостаточно токенов
+    return True
 
-    # Списываем сначала с тарифных, потом с дополнительных
-    if balance.tariff_tokens >= cost:
-        balance.tariff_tokens -= cost
-    else:
-        remaining = cost - (balance.tariff_tokens or 0)
-        balance.tariff_tokens = 0
-        balance.extra_tokens = (balance.extra_tokens or 0) - remaining
+def reserve_tokens(user, amount, reason=''):
+    """Резерв перед долгой генерацией; возвращает id резерва или None, если токенов не хватает."""
+    return UserTokenBalance.reserve(user.id, max(int(amount), 1), reason=reason)
 
-    balance.save()
-    return True
+def commit_tokens(user, reservation_id, actual_cost, reason=''):
+    """
+    Закрывает резерв фактической стоимостью. Если досписать недостачу не удалось,
+    резерв возвращается и результат False — как раньше при неудачном take_tokens.
+    """
+    if UserTokenBalance.commit_reservation(user.id, reservation_id, actual_cost, reason=reason):
+        return True
+    release_tokens(user, reservation_id, reason=reason)
+    return False
+
+def release_tokens(user, reservation_id, reason=''):
+    UserTokenBalance.release_reservation(user.id, reservation_id, reason=reason)
+
+def estimate_generation_cost(prompt: str) -> int:
+    """Оценка стоимости запроса для резерва: токены промпта по курсу 1 токен баланса за 100."""
+    return math.ceil(estimate_tokens(prompt) / 100) or 1
 
 
 
@@ -57,6 +69,7 @@ def take_tokens(user, cost):
 AI_MODELS = [
     {
         "name": "gemma-3-27b-it",
+        "context_window": 131072,
         "day_limit_requests": 14400,
         "is_visual": True,
         "provider": "Google",
@@ -64,6 +77,7 @@ AI_MODELS = [
     },
     {
         "name": "gemma-3-12b-it",
+        "context_window": 131072,
         "day_limit_requests": 14400,
         "is_visual": False,
         "provider": "Google",
@@ -71,6 +85,7 @@ AI_MODELS = [
     },
     {
         "name": "gemini-2.0-flash-lite",
+        "context_window": 1048576,
         "day_limit_requests": 1500,
         "is_visual": False,
         "provider": "Google",
@@ -78,6 +93,7 @@ AI_MODELS = [
     },
     {
         "name": "gemini-2.0-flash",
+        "context_window": 1048576,
         "day_limit_requests": 1500,
         "is_visual": False,
         "provider": "Google",
@@ -85,6 +101,7 @@ AI_MODELS = [
     },
     {
         "name": "llama-3.1-8b-instant",
+        "context_window": 131072,
         "day_limit_requests": 14400,
         "is_visual": False,
         "provider": "Groq",
@@ -92,6 +109,7 @@ AI_MODELS = [
     },
     {
         "name": "llama-3.3-70b-versatile",
+        "context_window": 131072,
         "day_limit_requests": 1000,
         "is_visual": False,
         "provider": "Groq",
@@ -99,6 +117,7 @@ AI_MODELS = [
     },
     {
         "name": "qwen/qwen3-32b",
+        "context_window": 131072,
         "day_limit_requests": 1000,
         "is_visual": False,
         "provider": "Groq",
@@ -106,6 +125,7 @@ AI_MODELS = [
     },
     {
         "name": "gemma2-9b-it",
+        "context_window": 8192,
         "day_limit_requests": 14400,
         "is_visual": False,
         "provider": "Groq",
@@ -113,6 +133,7 @@ AI_MODELS = [
     },
     {
         "name": "meta-llama/llama-4-maverick-17b-128e-instruct",
+        "context_window": 131072,
         "day_limit_requests": 1000,
         "is_visual": True,
         "provider": "Groq",
@@ -120,6 +141,9 @@ AI_MODELS = [
     }
 ]
 
+# Сколько токенов окна оставляем под инструкцию задания и ответ модели
+CONTEXT_RESERVED_TOKENS = 4096
+
 _MULTILINE_STRING_RE: Pattern = re.compile(r'"(?P<key>\w+)":\s*"\s*(?P<value>.*?)\s*"', flags=re.DOTALL)
 _BOOL_RE: Pattern = re.compile(r'\b(True|False)\b')
 
@@ -189,6 +213,16 @@ def generate_handler(user, query: str, desired_structure: str, image_data: Optio
         "Воспользуйтесь публичными готовыми уроками - это удобно и быстро\n"
     )
 
+def get_context_budget(model_type: str = "basic") -> int:
+    """
+    Возвращает бюджет токенов для контекста урока, который поместится в окно
+    любой модели данного типа (за вычетом CONTEXT_RESERVED_TOKENS).
+    """
+    windows = [m['context_window'] for m in AI_MODELS if m['type'] == model_type]
+    if not windows:
+        windows = [m['context_window'] for m in AI_MODELS]
+    return max(min(windows) - CONTEXT_RESERVED_TOKENS, 0)
+
 def pick_next_model(image_data: Optional[str], preferred_type: str, tried: set) -> Optional[dict]:
     """
     Выбирает подходящую модель, отдавая приоритет preferred_type ("basic"/"premium").
@@ -266,7 +300,9 @@ def _get_image_bytes_and_mime(src: str):
 def generate_google(user, prompt: str, model: str = "gemma-3-27b-it",
     max_output_tokens: int = 2000, temperature: float = 0.7, top_p: float = 0.8,
     image_data: Optional[str] = None, desired_structure: str = "") -> Union[str, dict, list]:
-    if not has_min_tokens(user, min_tokens=-25):
+    # Резервируем оценку заранее, чтобы параллельные генерации не ушли в минус
+    reservation_id = reserve_tokens(user, estimate_generation_cost(prompt), reason=model)
+    if reservation_id is None:
         return "Недостаточно токенов. Пополните баланс."
 
     # 1) Собираем contents — список элементов, которые передаём в Google GenAI.
@@ -296,6 +332,7 @@ def generate_google(user, prompt: str, model: str = "gemma-3-27b-it",
         contents.append(prompt)
 
     # 2) Делаем запрос
+    committed = False
     try:
         gen_config = types.GenerateContentConfig(
             temperature=temperature,
@@ -315,7 +352,8 @@ def generate_google(user, prompt: str, model: str = "gemma-3-27b-it",
         usage = getattr(response, "usage_metadata", None)
         tokens = getattr(usage, "total_token_count", 0)
         cost = math.ceil(tokens / 100) or 8
-        if not take_tokens(user, cost):
+        committed = True
+        if not commit_tokens(user, reservation_id, cost, reason=model):
             return "Ошибка списания токенов. Проверьте баланс."
 
         # 4) Парсинг JSON / структуры
@@ -335,6 +373,8 @@ def generate_google(user, prompt: str, model: str = "gemma-3-27b-it",
 
     except Exception as e:
         print(e)
+        if not committed:
+            release_tokens(user, reservation_id, reason=model)
         return f"API Error (Google): {e}"
 
 def generate_groq(user, prompt: str, model: str = "gemma2-9b-it", max_tokens: int = 8191, temperature: float = 0.85, top_p: float = 0.9, stream: bool = False, image_data: Optional[str] = None, desired_structure: str = "") -> Union[str, dict, list]:
@@ -343,9 +383,11 @@ def generate_groq(user, prompt: str, model: str = "gemma2-9b-it", max_tokens: in
 
     :return: строка ошибки, dict/list или произвольный ответ
     """
-    if not has_min_tokens(user, min_tokens=-25):
+    reservation_id = reserve_tokens(user, estimate_generation_cost(prompt), reason=model)
+    if reservation_id is None:
         return "Недостаточно токенов. Пополните баланс."
 
+    committed = False
     try:
         client = Groq(api_key=GROQ_ACCESS_KEY)
         msgs = [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
@@ -368,7 +410,8 @@ def generate_groq(user, prompt: str, model: str = "gemma2-9b-it", max_tokens: in
 
         usage = getattr(completion.usage, 'total_tokens', None)
         cost = math.ceil(usage / 100) if usage else 1
-        if not take_tokens(user, cost):
+        committed = True
+        if not commit_tokens(user, reservation_id, cost, reason=model):
             return "Ошибка списания токенов. Проверьте баланс."
 
         try:
@@ -388,6 +431,8 @@ def generate_groq(user, prompt: str, model: str = "gemma2-9b-it", max_tokens: in
 
     except Exception as e:
         print(e)
+        if not committed:
+            release_tokens(user, reservation_id, reason=model)
         return f"API Error (Groq): {e}"
 
 def clean_multiline_strings(text: str) -> str:
@@ -524,25 +569,42 @@ def incr_usage(model_name: str) -> None:
 
 
 # Изображения
-def search_images_api(query: str, page: int = 1, user=None):
+IMAGE_SEARCH_TIMEOUT = 10  # секунд на HTTP-запрос к Unsplash
+IMAGE_SEARCH_MAX_WORKERS = 4
+IMAGE_SEARCH_CACHE_TTL = 7 * 24 * 60 * 60  # секунд в Redis
+
+def search_images_api(query: str, page: int = 1, user=None, charge: bool = True):
+    """
+    Ищет картинки по запросу: сначала в сохранённых, затем через Unsplash.
+    При charge=False токены не списываются — вызывающий код списывает их сам
+    (см. search_images_many).
+    """
     if user is None or not getattr(user, 'is_authenticated', False):
         raise PermissionDenied("User must be authenticated for token deduction")
 
     # Проверяем токены и списываем
-    if not has_min_tokens(user, min_tokens=1) or not take_tokens(user, cost=1):
+    if charge and (not has_min_tokens(user, min_tokens=1) or not take_tokens(user, cost=1)):
         raise PermissionDenied("Недостаточно токенов для выполнения поиска")
 
-    # Очищаем запрос
+    # Очищаем запрос и строим ключ кэша
     query_clean = re.sub(r"\s+", ' ', query.strip())
-
-    # 1) Сначала проверяем в БД сохранённые картинки по запросу
-    saved_images = SavedUnsplashImage.objects.filter(query__iexact=query_clean)
-    if saved_images.exists():
-        # Возвращаем до 20 последних записей
-        results = saved_images.order_by('-created_at')[:20]
-        return {'images': [{'url': img.url, 'title': img.title} for img in results]}
-
-    # 2) Если в БД нет, делаем запрос к Unsplash
+    key = normalize_image_query(query_clean) or query_clean.lower()[:100]
+    redis_key = "image_search:" + key.replace(' ', '_')
+
+    # 1) Redis, затем таблица кэша по уникальному ключу
+    images = cache.get(redis_key)
+    if images is None:
+        entry = ImageSearchCache.objects.filter(key=key).first()
+        if entry:
+            images = list(entry.images.order_by('-created_at').values('url', 'title')[:20])
+            if images:
+                cache.set(redis_key, images, IMAGE_SEARCH_CACHE_TTL)
+    if images:
+        # Отмечаем использование для LRU/популярностного вытеснения (буфер в Redis, без записи в БД)
+        ImageSearchCache.record_hit(key)
+        return {'images': images}
+
+    # 2) Если в кэше нет, делаем запрос к Unsplash
     encoded = quote_plus(query_clean)
     url = "https://api.unsplash.com/search/photos"
     params = {
@@ -551,7 +613,7 @@ def search_images_api(query: str, page: int = 1, user=None):
         'per_page': 15,
         'client_id': UNSPLASH_ACCESS_KEY,
     }
-    response = requests.get(url, params=params)
+    response = requests.get(url, params=params, timeout=IMAGE_SEARCH_TIMEOUT)
     response.raise_for_status()
     data = response.json()
     if 'results' not in data:
@@ -559,31 +621,78 @@ def search_images_api(query: str, page: int = 1, user=None):
         raise ValueError("Invalid response from Unsplash API")
 
     images = []
-    count = 0
-    # 3) Сохраняем до 20 с title длиной <=10
-    for item in data['results']:
-        if count >= 20:
-            break
-        title = item.get('alt_description') or ''
-        title = title.strip()
-        if len(query_clean) <= 10:
-            url_img = item['urls'].get('regular')
-            if url_img:
-                # Сохраняем в БД
-                try:
-                    SavedUnsplashImage.objects.create(
-                        query=query_clean,
-                        url=url_img,
-                        title=title
-                    )
-                except Exception:
-                    # возможен IntegrityError при дубле, пропускаем
-                    pass
-                images.append({'url': url_img, 'title': title})
-                count += 1
+    for item in data['results'][:20]:
+        url_img = item['urls'].get('regular')
+        if url_img:
+            title = (item.get('alt_description') or '').strip()[:255]
+            images.append({'url': url_img, 'title': title})
+
+    # 3) Сохраняем одним запросом; дубли (query, url) пропускаются
+    if images:
+        entry, _ = ImageSearchCache.objects.get_or_create(key=key)
+        SavedUnsplashImage.objects.bulk_create(
+            [SavedUnsplashImage(query=key, url=img['url'], title=img['title'], cache=entry) for img in images],
+            ignore_conflicts=True
+        )
+        cache.set(redis_key, images, IMAGE_SEARCH_CACHE_TTL)
 
     return {'images': images}
 
+def search_images_many(queries, user, stop_after: Optional[int] = None, max_workers: int = IMAGE_SEARCH_MAX_WORKERS) -> dict:
+    """
+    Ищет картинки по нескольким запросам параллельно в ограниченном пуле потоков.
+    Как только картинки найдены для stop_after запросов, ещё не начатые поиски отменяются.
+    Токены резервируются до начала поиска (по токену на запрос), после — резерв закрывается
+    числом выполненных поисков, остаток возвращается.
+
+    :return: {индекс запроса: список картинок} для запросов, по которым что-то нашлось
+    """
+    if user is None or not getattr(user, 'is_authenticated', False):
+        raise PermissionDenied("User must be authenticated for token deduction")
+
+    # Свежий остаток из БД: user.token_balance мог устареть, и тогда резерв на все запросы не пройдёт
+    row = UserTokenBalance.objects.filter(user_id=user.id).values('tariff_tokens', 'extra_tokens').first()
+    available = row['tariff_tokens'] + row['extra_tokens'] if row else 0
+    queries = list(queries)[:max(available, 0)]
+    if not queries:
+        raise PermissionDenied("Недостаточно токенов для выполнения поиска")
+
+    reservation_id = reserve_tokens(user, len(queries), reason='image_search')
+    if reservation_id is None:
+        raise PermissionDenied("Недостаточно токенов для выполнения поиска")
+
+    def _search(query):
+        try:
+            return search_images_api(query, user=user, charge=False)
+        finally:
+            # каждый поток открывает своё соединение с БД — закрываем его
+            connection.close()
+
+    found = {}
+    try:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as pool:
+            futures = {pool.submit(_search, query): idx for idx, query in enumerate(queries)}
+            for future in as_completed(futures):
+                try:
+                    images = future.result().get('images', [])
+                except Exception as e:
+                    print(f"search_images_many: error searching '{queries[futures[future]]}': {e}")
+                    continue
+                if images:
+                    found[futures[future]] = images
+                if stop_after and len(found) >= stop_after:
+                    for pending in futures:
+                        pending.cancel()
+                    break
+    except BaseException:
+        release_tokens(user, reservation_id, reason='image_search')
+        raise
+
+    performed = sum(1 for future in futures if not future.cancelled())
+    commit_tokens(user, reservation_id, performed, reason='image_search')
+
+    return found
+
 """
 def search_images_api(query: str, page: int = 1, user=None):
     if user is None or not getattr(user, 'is_authenticated', False):
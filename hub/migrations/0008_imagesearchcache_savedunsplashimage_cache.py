@@ -0,0 +1,72 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:00
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# Копия hub.utils.normalize_image_query на момент миграции: результат исторического
+# заполнения не должен зависеть от последующих изменений нормализатора
+_IRREGULAR_PLURALS = {
+    "men": "man", "women": "woman", "children": "child", "people": "person", "mice": "mouse",
+    "feet": "foot", "teeth": "tooth", "geese": "goose", "knives": "knife", "leaves": "leaf",
+}
+
+
+def _singularize(word):
+    if word in _IRREGULAR_PLURALS:
+        return _IRREGULAR_PLURALS[word]
+    if not word.isascii() or len(word) <= 3:
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("ches", "shes", "sses", "xes", "zes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def normalize_image_query(query):
+    words = re.findall(r"[^\W_]+", (query or "").lower())
+    return " ".join(_singularize(w) for w in words)[:100]
+
+
+def backfill_legacy_images(apps, schema_editor):
+    """Привязывает сохранённые ранее картинки к записям кэша по нормализованному ключу запроса."""
+    SavedUnsplashImage = apps.get_model('hub', 'SavedUnsplashImage')
+    ImageSearchCache = apps.get_model('hub', 'ImageSearchCache')
+
+    queries = SavedUnsplashImage.objects.filter(cache__isnull=True).values_list('query', flat=True).distinct()
+    for query in queries.iterator():
+        key = normalize_image_query(query) or query.lower()[:100]
+        entry, _ = ImageSearchCache.objects.get_or_create(key=key)
+        SavedUnsplashImage.objects.filter(cache__isnull=True, query=query).update(cache=entry)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0007_delete_application'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageSearchCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='savedunsplashimage',
+            name='cache',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='images', to='hub.imagesearchcache'),
+        ),
+        migrations.RunPython(backfill_legacy_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.23 on 2026-10-19 10:30
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0008_imagesearchcache_savedunsplashimage_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PdfPageText',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pdf_hash', models.CharField(max_length=64)),
+                ('page', models.PositiveIntegerField()),
+                ('settings_key', models.CharField(max_length=64)),
+                ('text', models.TextField(blank=True)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'unique_together': {('pdf_hash', 'settings_key', 'page')},
+            },
+        ),
+    ]
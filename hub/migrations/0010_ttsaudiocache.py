@@ -0,0 +1,28 @@
+# Generated by Django 4.2.23 on 2026-10-19 12:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0009_pdfpagetext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TtsAudioCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('voice', models.CharField(max_length=100)),
+                ('length_bytes', models.PositiveIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tts_cache', to='hub.mediafile')),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.23 on 2026-10-19 14:20
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_storage_key(apps, schema_editor):
+    MediaFile = apps.get_model('hub', 'MediaFile')
+    MediaFile.objects.exclude(file='').update(storage_key=F('file'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0010_ttsaudiocache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='storage_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=1000),
+        ),
+        migrations.RunPython(fill_storage_key, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.23 on 2026-10-19 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hub', '0011_mediafile_storage_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mediafile',
+            name='hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='mediafile',
+            constraint=models.UniqueConstraint(condition=models.Q(('hash', ''), _negated=True), fields=('user', 'hash'), name='media_file_user_hash'),
+        ),
+    ]
@@ -6,20 +6,23 @@ import string
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import JSONField
+from django.db.models import JSONField, F, Case, When, Value
+from django.db.models.functions import Greatest
+from django_redis import get_redis_connection
 import uuid
 import bleach
-from datetime import timedelta, timezone, datetime
+from datetime import timedelta, timezone as dt_timezone, datetime
 
 from django.core.validators import FileExtensionValidator
 from django.utils import timezone
 from django.utils.text import slugify
 from django.utils.timezone import now
 from django_cron import CronJobBase, Schedule
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 
 from users.models import CustomUser
+from .utils import redis_hash_snapshot
 
 
 class CourseManager(models.Manager):
@@ -159,10 +162,23 @@ class MediaFile(models.Model):
         related_name='media_files'
     )
     file = models.FileField(upload_to='uploads', max_length=1000)
+    # Имя файла в хранилище (как в file.name) — индексированный ключ для поиска по URL
+    storage_key = models.CharField(max_length=1000, db_index=True, blank=True, editable=False)
     size = models.PositiveIntegerField(default=0)  # в байтах
-    hash = models.CharField(max_length=64, unique=True, blank=True)  # SHA-256 = 64 символа
+    hash = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 = 64 символа
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # У каждого пользователя своя запись на файл; одинаковые файлы разных
+            # пользователей ссылаются на один объект хранилища (storage_key)
+            models.UniqueConstraint(
+                fields=['user', 'hash'],
+                condition=~models.Q(hash=''),
+                name='media_file_user_hash',
+            ),
+        ]
+
     def save(self, *args, **kwargs):
         file_url = str(self.file)
 
@@ -173,20 +189,27 @@ class MediaFile(models.Model):
             self.size = 0
         else:
             if self.file and not self.hash:
-                self.file.seek(0)
-                self.size = self.file.size
-                self.hash = self.calculate_hash()
-                self.file.seek(0)
+                # Хэш и размер считаются за один проход по файлу
+                self.hash, self.size = self.calculate_hash(with_size=True)
 
+            # Записываем файл заранее, чтобы знать итоговое имя в хранилище
+            if self.file and not self.file._committed:
+                self.file.save(self.file.name, self.file.file, save=False)
+
+        self.storage_key = self.file.name or ''
         super().save(*args, **kwargs)
 
-    def calculate_hash(self):
-        """Вычисляет SHA-256 хеш файла."""
+    def calculate_hash(self, with_size=False):
+        """Вычисляет SHA-256 хеш файла (и размер в байтах, если with_size)."""
         sha256 = hashlib.sha256()
+        size = 0
         self.file.seek(0)  # Перемотать начало файла
         for chunk in self.file.chunks():
             sha256.update(chunk)
+            size += len(chunk)
         self.file.seek(0)  # Вернуть указатель в начало
+        if with_size:
+            return sha256.hexdigest(), size
         return sha256.hexdigest()
 
 class CoursePdf(models.Model):
@@ -640,11 +663,92 @@ class Homework(models.Model):
         return f"HW for {self.student} ({self.classroom.name}) - {self.status}"
 
 
+# Буфер попаданий в кэш картинок: ключ запроса -> число попаданий / время последнего использования
+IMAGE_SEARCH_HITS_KEY = "image_search_hits"
+IMAGE_SEARCH_LAST_USED_KEY = "image_search_last_used"
+
+
+class ImageSearchCache(models.Model):
+    """Запись кэша поиска картинок по нормализованному ключу запроса."""
+    key = models.CharField(max_length=100, unique=True)  # см. hub.utils.normalize_image_query
+    hits = models.PositiveIntegerField(default=0)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.key} ({self.hits})"
+
+    @classmethod
+    def evict(cls, max_entries, max_idle_days=180):
+        """
+        Удаляет записи, не использовавшиеся max_idle_days дней, а затем наименее
+        популярные (по hits, затем по давности использования) сверх max_entries.
+        Возвращает список удалённых ключей.
+        """
+        idle_cutoff = timezone.now() - timedelta(days=max_idle_days)
+        evicted = list(cls.objects.filter(last_used_at__lt=idle_cutoff).values_list("key", flat=True))
+
+        overflow = cls.objects.exclude(key__in=evicted).count() - max_entries
+        if overflow > 0:
+            evicted += list(
+                cls.objects.exclude(key__in=evicted)
+                .order_by("hits", "last_used_at")
+                .values_list("key", flat=True)[:overflow]
+            )
+
+        if evicted:
+            cls.objects.filter(key__in=evicted).delete()
+        return evicted
+
+    @classmethod
+    def record_hit(cls, key):
+        """Учитывает попадание в кэш в Redis; в БД его переносит flush_hits()."""
+        pipe = get_redis_connection("default").pipeline()
+        pipe.hincrby(IMAGE_SEARCH_HITS_KEY, key, 1)
+        pipe.hset(IMAGE_SEARCH_LAST_USED_KEY, key, timezone.now().timestamp())
+        pipe.execute()
+
+    @classmethod
+    def flush_hits(cls):
+        """
+        Переносит накопленные попадания в hits/last_used_at: один UPDATE F() + n на группу
+        ключей с одинаковым приростом и одно CASE-обновление времени использования.
+        Возвращает число обновлённых ключей.
+        """
+        with redis_hash_snapshot(IMAGE_SEARCH_HITS_KEY, IMAGE_SEARCH_LAST_USED_KEY) as snapshot:
+            hits = {key: int(n) for key, n in snapshot[IMAGE_SEARCH_HITS_KEY].items() if int(n)}
+            last_used = {
+                key: datetime.fromtimestamp(float(ts), tz=dt_timezone.utc)
+                for key, ts in snapshot[IMAGE_SEARCH_LAST_USED_KEY].items()
+            }
+            with transaction.atomic():
+                groups = {}
+                for key, n in hits.items():
+                    groups.setdefault(n, []).append(key)
+                for n, keys in groups.items():
+                    cls.objects.filter(key__in=keys).update(hits=F("hits") + n)
+                if last_used:
+                    used_case = Case(
+                        *[When(key=key, then=Value(ts)) for key, ts in last_used.items()],
+                        output_field=models.DateTimeField(),
+                    )
+                    cls.objects.filter(key__in=list(last_used)).update(
+                        last_used_at=Greatest(F("last_used_at"), used_case)
+                    )
+        return len(set(hits) | set(last_used))
+
 class SavedUnsplashImage(models.Model):
     query = models.CharField(max_length=100, db_index=True)
     url = models.URLField()
     title = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    cache = models.ForeignKey(
+        ImageSearchCache,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="images"
+    )
 
     class Meta:
         unique_together = ('query', 'url')
@@ -659,6 +763,67 @@ class SavedUnsplashImage(models.Model):
 
 
 
+class PdfPageText(models.Model):
+    """Кэш извлечённого текста страниц PDF по SHA-256 файла, номеру страницы и настройкам OCR."""
+    pdf_hash = models.CharField(max_length=64)
+    page = models.PositiveIntegerField()
+    settings_key = models.CharField(max_length=64)
+    text = models.TextField(blank=True)
+    size = models.PositiveIntegerField(default=0)  # в байтах
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        unique_together = ('pdf_hash', 'settings_key', 'page')
+
+    def __str__(self):
+        return f"{self.pdf_hash[:12]}… p.{self.page}"
+
+    @classmethod
+    def store(cls, pdf_hash, settings_key, pages, hit_pages=()):
+        """Сохраняет текст новых страниц {page: text} и отмечает использование закэшированных."""
+        if pages:
+            cls.objects.bulk_create(
+                [
+                    cls(pdf_hash=pdf_hash, settings_key=settings_key, page=page, text=text,
+                        size=len(text.encode("utf-8")))
+                    for page, text in pages.items()
+                ],
+                ignore_conflicts=True
+            )
+        if hit_pages:
+            cls.objects.filter(pdf_hash=pdf_hash, settings_key=settings_key, page__in=list(hit_pages)) \
+                .update(last_used_at=timezone.now())
+
+    @classmethod
+    def evict(cls, max_total_size):
+        """Удаляет давно не использованные страницы, пока суммарный размер больше max_total_size."""
+        total = cls.objects.aggregate(total=models.Sum("size"))["total"] or 0
+        if total <= max_total_size:
+            return 0
+
+        to_delete = []
+        for pk, size in cls.objects.order_by("last_used_at").values_list("pk", "size").iterator():
+            if total <= max_total_size:
+                break
+            to_delete.append(pk)
+            total -= size
+
+        deleted, _ = cls.objects.filter(pk__in=to_delete).delete()
+        return deleted
+
+class TtsAudioCache(models.Model):
+    """Синтезированное аудио по ключу (текст после clean_text, голос, скорость, тон)."""
+    key = models.CharField(max_length=64, unique=True)  # SHA-256, см. hub.tasks.tts_cache_key
+    media = models.ForeignKey(MediaFile, on_delete=models.CASCADE, related_name="tts_cache")
+    voice = models.CharField(max_length=100)
+    length_bytes = models.PositiveIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    last_used_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.voice}: {self.key[:12]} ({self.hits})"
+
 class SiteErrorLog(models.Model):
     error_message = models.TextField(help_text="Описание ошибки")
     function_name = models.CharField(max_length=255, help_text="Функция или метод, где произошла ошибка")
@@ -2336,12 +2336,15 @@ function generateAudio(taskId = '') {
             });
 
             if (!startResponse.ok) throw new Error(await startResponse.text());
-            const { task_id, error } = await startResponse.json();
+            const startData = await startResponse.json();
+            const { task_id, error } = startData;
             if (error) throw new Error(error);
-            if (!task_id) throw new Error("Не удалось получить ID задачи");
 
-            let statusData;
-            for (let attempts = 0; attempts < 30; attempts++) {
+            // Аудио для этого текста уже есть в кэше — опрос не нужен
+            let statusData = startData.state === 'SUCCESS' ? startData : null;
+            if (!statusData && !task_id) throw new Error("Не удалось получить ID задачи");
+
+            for (let attempts = 0; statusData?.state !== 'SUCCESS' && attempts < 30; attempts++) {
                 const statusResponse = await fetch(`/api/edge-tts/status/${task_id}/`);
                 if (!statusResponse.ok) throw new Error(await statusResponse.text());
                 statusData = await statusResponse.json();
@@ -2351,21 +2354,21 @@ function generateAudio(taskId = '') {
                 await new Promise(r => setTimeout(r, 2000));
             }
 
-            if (!statusData?.result?.audio_base64) throw new Error("Результат генерации пуст");
+            if (!statusData?.result?.url) throw new Error("Результат генерации пуст");
 
-            // сохраняем base64 сразу
-            const audioBase64 = `data:audio/mpeg;base64,${statusData.result.audio_base64}`;
-            container.dataset.audioBase64 = audioBase64;
+            // аудио уже сохранено на сервере — храним только ссылку
+            const audioUrl = statusData.result.url;
+            container.dataset.audioUrl = audioUrl;
 
             const preview = container.querySelector('.audio-preview');
             preview.innerHTML = `
-                <audio controls class="w-100">
-                    <source src="${audioBase64}" type="audio/mpeg">
+                <audio controls class="w-100" preload="metadata">
+                    <source src="${audioUrl}" type="audio/mpeg">
                     Ваш браузер не поддерживает воспроизведение аудио.
                 </audio>
             `;
             setupModernAudioPlayer(preview.querySelector('audio'));
-            delete container.dataset.audioUrl;
+            delete container.dataset.audioBase64;
 
         } catch (error) {
             console.error('Ошибка генерации речи:', error);
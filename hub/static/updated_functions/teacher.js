@@ -860,9 +860,96 @@ document.addEventListener('DOMContentLoaded', () => {
 
         // Сохранение задания
 
+// Поле с файлом у заданий, медиа которых хранится на сервере
+const TASK_MEDIA_FIELDS = { Image: 'image_url', Audio: 'audio_url', Pdf: 'pdf_url' };
+
+// Файлы больше этого размера загружаются кусками с возможностью докачки
+const CHUNKED_UPLOAD_THRESHOLD = 4 * 1024 * 1024;
+const CHUNKED_UPLOAD_RETRIES = 5;
+
+async function sha256Hex(blob) {
+    const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Докачиваемая загрузка: start → куски с offset → finish (сервер сверяет SHA-256)
+async function uploadMediaChunked(blob, name = 'upload') {
+    const headers = { 'X-CSRFToken': getCookie('csrftoken') };
+    const startResponse = await fetch('/upload-media/chunked/', {
+        method: 'POST',
+        headers: { ...headers, 'Content-Type': 'application/json' },
+        body: JSON.stringify({ name, mime: blob.type, size: blob.size, sha256: await sha256Hex(blob) })
+    });
+    const start = await startResponse.json();
+    if (!start.success) throw new Error(start.error || 'Не удалось начать загрузку');
+    if (start.done) return start;
+
+    const chunkUrl = `/upload-media/chunked/${start.upload_id}/`;
+    let offset = start.offset;
+    let failures = 0;
+    while (offset < blob.size) {
+        try {
+            const response = await fetch(chunkUrl, {
+                method: 'POST',
+                headers: { ...headers, 'X-Upload-Offset': String(offset) },
+                body: blob.slice(offset, offset + start.chunk_size)
+            });
+            const data = await response.json();
+            // 409 — сервер уже принял другой объём, продолжаем с его offset
+            if ((!data.success && response.status !== 409) || typeof data.offset !== 'number') {
+                throw new Error(data.error || 'Ошибка загрузки куска');
+            }
+            offset = data.offset;
+            failures = 0;
+        } catch (error) {
+            // обрыв связи — узнаём, сколько сервер успел принять, и продолжаем с этого места
+            if (++failures > CHUNKED_UPLOAD_RETRIES) throw error;
+            await new Promise(r => setTimeout(r, 1000 * failures));
+            const status = await fetch(chunkUrl).then(r => r.json()).catch(() => null);
+            if (status?.success) offset = status.offset;
+        }
+    }
+
+    const finishResponse = await fetch(`${chunkUrl}finish/`, { method: 'POST', headers });
+    const finish = await finishResponse.json();
+    if (!finish.success) throw new Error(finish.error || 'Не удалось завершить загрузку');
+    return finish;
+}
+
+// Загружает файл (data:/blob: URL) отдельным запросом и возвращает { media_id, url }
+async function uploadTaskMedia(fileUrl) {
+    const blob = await (await fetch(fileUrl)).blob();
+    if (blob.size > CHUNKED_UPLOAD_THRESHOLD) return uploadMediaChunked(blob);
+
+    const formData = new FormData();
+    formData.append('file', blob, 'upload');
+
+    const response = await fetch('/upload-media/', {
+        method: 'POST',
+        headers: { 'X-CSRFToken': getCookie('csrftoken') },
+        body: formData
+    });
+    const data = await response.json();
+    if (!data.success) throw new Error(data.error || 'Не удалось загрузить файл');
+    return data;
+}
+
 async function saveTask(params, payloads) {
     const url = `/hub/section/${params.section_id}/task/save`;
 
+    // Файл передаётся не в JSON, а отдельной загрузкой — в задание уходит только media_id
+    const mediaField = TASK_MEDIA_FIELDS[params.task_type];
+    const mediaValue = mediaField && payloads[mediaField];
+    if (typeof mediaValue === 'string' && /^(data|blob):/.test(mediaValue)) {
+        try {
+            const uploaded = await uploadTaskMedia(mediaValue);
+            payloads = { ...payloads, [mediaField]: uploaded.url, media_id: uploaded.media_id };
+        } catch (error) {
+            showNotification(error.message, "danger");
+            return null;
+        }
+    }
+
     const requestData = {
         obj_id: params.obj_id || null,
         task_type: params.task_type,
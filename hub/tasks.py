@@ -1,64 +1,175 @@
+import asyncio
 import json
 import base64
+import hashlib
 import logging
 import math
 import re
 import random
 import secrets
+import tempfile
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from django.shortcuts import get_object_or_404
 from asgiref.sync import async_to_sync
 from celery import shared_task, states, chain, group
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import F
 from django.shortcuts import get_object_or_404
 from django.http import JsonResponse
+from django.utils import timezone
 from edge_tts import Communicate
 from exceptiongroup import catch
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path
+import fitz
 import pytesseract
 from hub.models import Lesson
-from .models import Section, UserAutogenerationPreferences, MediaFile, LessonGenerationStatus
-from .ai_calls import generate_handler, has_min_tokens, take_tokens, add_successful_generation, search_images_api, extract_json_or_array_from_text
+from .models import Section, UserAutogenerationPreferences, MediaFile, LessonGenerationStatus, PdfPageText, \
+    TtsAudioCache
+from .ai_calls import generate_handler, has_min_tokens, take_tokens, reserve_tokens, commit_tokens, release_tokens, add_successful_generation, search_images_api, extract_json_or_array_from_text, \
+    get_context_budget
 from users.models import CustomUser
 from .utils import process_image_data, build_base_query, enhance_query_with_params, extract_lesson_context, \
-    update_auto_context, markdown_to_html, shuffle_sentence, shuffle_word
+    update_auto_context, markdown_to_html, shuffle_sentence, shuffle_word, pack_context_elements, AVG_CHARS_PER_TOKEN, \
+    AUTO_CONTEXT_MAX_TOKENS, estimate_tokens
 
 
-def decode_and_extract_text_from_base64_pdf(base64_string):
-    """Декодирует PDF из Base64 и извлекает текст через OCR."""
-    print("decode_and_extract_text_from_base64_pdf: Начало декодирования PDF")
-    if base64_string.startswith("data:application/pdf;base64,"):
-        base64_string = base64_string.split("base64,")[1]
-        print("decode_and_extract_text_from_base64_pdf: Удалён префикс data URI")
+PDF_UPLOAD_DIR = "pdf_uploads"
 
-    try:
-        pdf_data = base64.b64decode(base64_string)
-        print(f"decode_and_extract_text_from_base64_pdf: PDF декодирован, длина данных {len(pdf_data)} байт")
-    except Exception as e:
-        print(f"decode_and_extract_text_from_base64_pdf: Ошибка декодирования base64: {e}")
-        raise
+def save_pdf_upload(fileobj) -> str:
+    """Сохраняет загруженный PDF в хранилище (потоково, по чанкам) и возвращает его имя."""
+    return default_storage.save(f"{PDF_UPLOAD_DIR}/{secrets.token_hex(16)}.pdf", fileobj)
 
+@contextmanager
+def local_pdf_path(storage_name):
+    """
+    Отдаёт локальный путь к PDF из хранилища. Для нелокальных хранилищ
+    файл копируется во временный файл по чанкам.
+    """
     try:
-        images = convert_from_bytes(pdf_data)
-        print(f"decode_and_extract_text_from_base64_pdf: PDF конвертирован в {len(images)} изображений")
-    except Exception as e:
-        print(f"decode_and_extract_text_from_base64_pdf: Ошибка конвертации PDF в изображения: {e}")
-        raise
+        path = default_storage.path(storage_name)
+    except NotImplementedError:
+        path = None
+    if path:
+        yield path
+        return
 
-    text_parts = []
-    for page_num, image in enumerate(images, start=1):
-        try:
-            page_text = pytesseract.image_to_string(image, lang='eng+rus')
-            print(f"decode_and_extract_text_from_base64_pdf: Текст извлечён с страницы {page_num}")
-            text_parts.append(f"\n--- Page {page_num} ---\n{page_text.strip()}")
-        except Exception as e:
-            print(f"decode_and_extract_text_from_base64_pdf: Ошибка OCR на странице {page_num}: {e}")
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        with default_storage.open(storage_name, "rb") as src:
+            for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                tmp.write(chunk)
+        tmp.flush()
+        yield tmp.name
+
+# Текстовый слой страницы считается пригодным, если в нём достаточно символов
+# и они в основном буквы/цифры (битая кодировка шрифтов даёт мусор и U+FFFD)
+TEXT_LAYER_MIN_CHARS = 40
+TEXT_LAYER_MIN_ALNUM_RATIO = 0.6
+
+def is_text_layer_usable(text):
+    """Эвристика качества встроенного текстового слоя страницы."""
+    chars = [c for c in text if not c.isspace()]
+    if len(chars) < TEXT_LAYER_MIN_CHARS or "\ufffd" in text:
+        return False
+    alnum = sum(1 for c in chars if c.isalnum())
+    return alnum / len(chars) >= TEXT_LAYER_MIN_ALNUM_RATIO
+
+OCR_LANG = 'eng+rus'
+# Увеличивать при изменении извлечения текста, чтобы не отдавать устаревший кэш
+PDF_TEXT_CACHE_VERSION = 1
+
+def ocr_pdf_page(pdf_path, page_num, dpi):
+    """Растеризует одну страницу PDF и распознаёт её через Tesseract."""
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=page_num, last_page=page_num)
+    return pytesseract.image_to_string(images[0], lang=OCR_LANG) if images else ""
+
+def file_sha256(path):
+    """SHA-256 файла, читаемого по чанкам."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def pdf_text_settings_key(dpi):
+    return f"v{PDF_TEXT_CACHE_VERSION}:dpi={dpi}:lang={OCR_LANG}"
+
+def iter_pdf_pages_text(pdf_path, dpi=None, workers=None, pdf_hash=None, first_page=None, last_page=None):
+    """
+    Извлекает текст PDF постранично. Сначала берётся встроенный текстовый слой (fitz);
+    страницы, где слой пустой или некачественный, распознаются параллельно
+    в ограниченном пуле. Возвращает генератор (номер страницы, текст) в порядке страниц.
 
-    full_text = "\n".join(text_parts).strip()
-    print("decode_and_extract_text_from_base64_pdf: Завершено извлечение текста из PDF")
-    return full_text
+    Если передан pdf_hash, текст страниц берётся из PdfPageText и сохраняется туда,
+    так что повторная обработка того же PDF не запускает OCR.
+    first_page/last_page (включительно) ограничивают диапазон страниц.
+
+    Пул потоковый: pdftoppm и tesseract запускаются отдельными процессами,
+    поэтому OCR загружает все ядра, а из демонического процесса Celery-воркера
+    нельзя создавать ProcessPoolExecutor.
+    """
+    dpi = dpi or settings.PDF_OCR_DPI
+    workers = workers or settings.PDF_OCR_WORKERS
+    settings_key = pdf_text_settings_key(dpi)
+
+    cached = {}
+    if pdf_hash:
+        cached = dict(
+            PdfPageText.objects.filter(pdf_hash=pdf_hash, settings_key=settings_key).values_list("page", "text")
+        )
+
+    layer_texts = []
+    with fitz.open(pdf_path) as doc:
+        print(f"iter_pdf_pages_text: в PDF {doc.page_count} страниц, из кэша {len(cached)}")
+        for page_num, page in enumerate(doc, start=1):
+            if (first_page and page_num < first_page) or (last_page and page_num > last_page):
+                layer_texts.append(False)
+                continue
+            if page_num in cached:
+                layer_texts.append(cached[page_num])
+                continue
+            try:
+                page_text = page.get_text("text")
+            except Exception as e:
+                print(f"iter_pdf_pages_text: Ошибка чтения текстового слоя на странице {page_num}: {e}")
+                page_text = ""
+            layer_texts.append(page_text if is_text_layer_usable(page_text) else None)
+
+    ocr_pages = [page_num for page_num, text in enumerate(layer_texts, start=1) if text is None]
+    print(f"iter_pdf_pages_text: OCR нужен для {len(ocr_pages)} страниц")
+
+    extracted = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ocr_pages)))) as pool:
+        futures = {page_num: pool.submit(ocr_pdf_page, pdf_path, page_num, dpi) for page_num in ocr_pages}
+        for page_num, page_text in enumerate(layer_texts, start=1):
+            if page_text is False:
+                continue
+            if page_text is None:
+                try:
+                    page_text = futures[page_num].result()
+                except Exception as e:
+                    print(f"iter_pdf_pages_text: Ошибка OCR на странице {page_num}: {e}")
+                    continue
+            page_text = page_text.strip()
+            if page_num not in cached:
+                extracted[page_num] = page_text
+            yield page_num, page_text
+
+    if pdf_hash:
+        PdfPageText.store(pdf_hash, settings_key, extracted, hit_pages=cached.keys())
+
+def extract_text_from_pdf(pdf_path, pdf_hash=None):
+    """Извлекает текст PDF (текстовый слой или OCR) с маркерами --- Page N ---."""
+    text_parts = [
+        f"\n--- Page {page_num} ---\n{page_text}"
+        for page_num, page_text in iter_pdf_pages_text(pdf_path, pdf_hash=pdf_hash)
+    ]
+    return "\n".join(text_parts).strip()
 
 TASK_TYPE_MODEL_PREFERENCE = {
     "WordList":        "basic",
@@ -76,16 +187,128 @@ TASK_TYPE_MODEL_PREFERENCE = {
     "LabelImages":     "basic"
 }
 
+PDF_CHUNK_MAX_TOKENS = 3000  # текста PDF на один запрос первого этапа
+PDF_GENERATION_WORKERS = 4   # параллельных запросов к моделям при обработке PDF
+PDF_TASKS_STRUCTURE = "JSON [{'task_type': str, 'instruction': str, 'content': str, 'answers': str}]"
+
+def run_with_own_connection(func, *args, **kwargs):
+    """Обёртка для потоков пула: закрывает соединение с БД, открытое потоком."""
+    try:
+        return func(*args, **kwargs)
+    finally:
+        connection.close()
+
+def chunk_pdf_pages(pages, max_tokens):
+    """
+    Группирует идущие подряд страницы [(номер, текст)] в чанки не больше max_tokens.
+    Страница, которая сама больше бюджета, становится отдельным чанком.
+    Возвращает [(первая страница, последняя страница, текст с маркерами --- Page N ---)].
+    """
+    chunks = []
+    current = []
+    used = 0
+
+    def flush():
+        if current:
+            chunks.append((current[0][0], current[-1][0], "\n".join(part for _, part in current).strip()))
+
+    for page_num, page_text in pages:
+        part = f"\n--- Page {page_num} ---\n{page_text}"
+        cost = estimate_tokens(part)
+        if current and used + cost > max_tokens:
+            flush()
+            current, used = [], 0
+        current.append((page_num, part))
+        used += cost
+
+    flush()
+    return chunks
+
+def _parse_generated_list(generated_data):
+    """Приводит ответ генератора к списку заданий или возвращает None."""
+    if isinstance(generated_data, list):
+        return generated_data
+    if isinstance(generated_data, str):
+        try:
+            parsed = json.loads(generated_data)
+        except json.JSONDecodeError:
+            return None
+        return parsed if isinstance(parsed, list) else None
+    return None
+
+def _prepare_pdf_item(item):
+    """
+    Превращает элемент первого этапа в (task_type, user_query) для форматирования
+    через generate_task_core или None, если элемент нужно пропустить.
+    """
+    if not isinstance(item, dict):
+        return None
+    task_type = item.get("task_type")
+
+    # Маппинг типов
+    consider = ""
+    if task_type in ["SpeakingQuestion", "ComprehensionQuestion", "Speaking", "GrammarNote"]:
+        task_type_original = task_type
+        task_type = "Note"
+        if task_type_original != "GrammarNote":
+            consider = " SYSTEM PROMPT: Just rewrite the original task."
+    elif task_type in ["WritingQuestion", "Writing", "Essay"]:
+        task_type = "Essay"
+    elif task_type == "Reading":
+        task_type = "Article"
+    elif task_type == "ListeningMonologue":
+        task_type = "Audio"
+
+    # Данные
+    instruction = item.get("instruction") or ""
+    content_part = item.get("content") or ""
+    answers = item.get("answers") or ""
+
+    if not task_type or not (instruction or content_part):
+        return None
+    if task_type not in TASK_TYPE_MODEL_PREFERENCE and task_type != "Audio":
+        return None
+
+    if instruction:
+        instruction = " SYSTEM_TITLE: " + instruction
+    if content_part:
+        content_part = " SYSTEM_CONTENT: " + content_part
+    if answers:
+        answers = " SYSTEM_ANSWERS: " + answers
+
+    if task_type in ["MatchUpTheWords", "TrueOrFalse", "Test", "Unscramble",
+                     "MakeASentence", "SortIntoColumns", "FillInTheBlanks"]:
+        content = instruction + content_part + answers + consider
+    else:
+        content = instruction + content_part + consider
+
+    return task_type, content
+
 @shared_task(bind=True, name="process_pdf_section_task")
-def process_pdf_section_task(self, section_id, query, pdf_base64, user_id):
-    from django.contrib.auth import get_user_model
-    from .views import create_task_instance
+def process_pdf_section_task(self, section_id, query, pdf_path, user_id, first_page=None, last_page=None):
+    """
+    OCR + генерация заданий из PDF. pdf_path — имя файла в default_storage
+    (см. save_pdf_upload); после обработки файл удаляется.
+    first_page/last_page ограничивают обрабатываемый диапазон страниц.
+    """
+    try:
+        return _process_pdf_section(self, section_id, query, pdf_path, user_id, first_page, last_page)
+    finally:
+        try:
+            default_storage.delete(pdf_path)
+        except Exception as e:
+            print(f"[process_pdf_section_task] Не удалось удалить загруженный PDF {pdf_path}: {e}")
+
+def _process_pdf_section(task, section_id, query, pdf_path, user_id, first_page=None, last_page=None):
+    from .views import create_task_instances_bulk
     from hub.views import call_form_function
-    User = get_user_model()
 
     def make_error(msg: str) -> dict:
         return {"status": "error", "error": msg}
 
+    def report_progress(stage, done, total):
+        task.update_state(state="PROGRESS", meta={"stage": stage, "done": done, "total": total})
+
     print(f"[process_pdf_section_task] Запуск задачи для section_id={section_id}, user_id={user_id}")
 
     # --- Проверка раздела
@@ -101,11 +324,17 @@ def process_pdf_section_task(self, section_id, query, pdf_base64, user_id):
 
     # --- Извлечение текста из PDF
     try:
-        full_text = decode_and_extract_text_from_base64_pdf(pdf_base64)
+        with local_pdf_path(pdf_path) as local_path:
+            pages = list(iter_pdf_pages_text(
+                local_path, pdf_hash=file_sha256(local_path), first_page=first_page, last_page=last_page
+            ))
     except Exception as e:
         print(f"[process_pdf_section_task] Ошибка при извлечении текста: {e}")
         return make_error(f"OCR error: {str(e)}")
-    print("[DEBUG] TEXT: ", full_text[:100])
+
+    if not any(page_text for _, page_text in pages):
+        return make_error("No text found in PDF")
+
     # --- Подготовка system prompt
     system_prompt = (
         "SYSTEM PROMPT: Format the tasks content into JSON as structured objects. Task types must be from the list. WRITE FULL TASK CONTENT!\n"
@@ -120,127 +349,107 @@ def process_pdf_section_task(self, section_id, query, pdf_base64, user_id):
         system_prompt += f"\nAdditional instructions: {query}"
     system_prompt += " The text: \n\n"
 
-    # --- Генерация заданий
+    # --- Разбиение текста на диапазоны страниц под окно модели
+    max_tokens = min(PDF_CHUNK_MAX_TOKENS, get_context_budget("premium") - estimate_tokens(system_prompt))
+    chunks = chunk_pdf_pages(pages, max_tokens)
+    print(f"[process_pdf_section_task] Текст разбит на {len(chunks)} чанков")
+
     try:
         user = CustomUser.objects.get(id=user_id)
-        generated_data = generate_handler(
-            user=user,
-            query=system_prompt + full_text,
-            desired_structure="JSON [{'task_type': str, 'instruction': str, 'content': str, 'answers': str}]",
-            model_type="premium"
-        )
-        print(f"[process_pdf_section_task] Данные от генератора: {generated_data}")
-        if not generated_data:
-            return make_error("Generation returned empty result")
-    except Exception as e:
-        print(f"[process_pdf_section_task] Ошибка генерации: {e}")
-        return make_error(f"Generation error: {str(e)}")
-
-    # --- Проверка формата JSON
-    if not isinstance(generated_data, list):
-        if isinstance(generated_data, str):
-            try:
-                parsed = json.loads(generated_data)
-                if isinstance(parsed, list):
-                    generated_data = parsed
-                else:
-                    return make_error("Parsed data is not a list")
-            except json.JSONDecodeError as e:
-                print(f"[process_pdf_section_task] Ошибка JSON decode: {e}")
-                return make_error("Failed to decode JSON")
-        else:
-            return make_error("Invalid format from generator")
-
-    # --- Обработка заданий
-    results = []
-    for idx, item in enumerate(generated_data, 1):
-        try:
-            task_type = item.get("task_type")
-            print(f"[process_pdf_section_task] Обработка задания #{idx} ({task_type})")
-
-            # Маппинг типов
-            consider = ""
-            if task_type in ["SpeakingQuestion", "ComprehensionQuestion", "Speaking", "GrammarNote"]:
-                task_type_original = task_type
-                task_type = "Note"
-                if task_type_original != "GrammarNote":
-                    consider = " SYSTEM PROMPT: Just rewrite the original task."
-            elif task_type in ["WritingQuestion", "Writing", "Essay"]:
-                task_type = "Essay"
-            elif task_type == "Reading":
-                task_type = "Article"
-            elif task_type == "ListeningMonologue":
-                task_type = "Audio"
-
-            # Данные
-            instruction = item.get("instruction") or ""
-            content_part = item.get("content") or ""
-            answers = item.get("answers") or ""
-
-            if instruction:
-                instruction = " SYSTEM_TITLE: " + instruction
-            if content_part:
-                content_part = " SYSTEM_CONTENT: " + content_part
-            if answers:
-                answers = " SYSTEM_ANSWERS: " + answers
-
-            if task_type in ["MatchUpTheWords", "TrueOrFalse", "Test", "Unscramble",
-                             "MakeASentence", "SortIntoColumns", "FillInTheBlanks"]:
-                content = instruction + content_part + answers + consider
-            else:
-                content = instruction + content_part + consider
-
-            if not task_type or not (instruction or content_part):
-                print(f"[process_pdf_section_task] Пропуск #{idx} — нет типа или контента")
-                continue
-
-            if task_type not in TASK_TYPE_MODEL_PREFERENCE and task_type != "Audio":
-                print(f"[process_pdf_section_task] Пропуск #{idx} — неподдерживаемый тип {task_type}")
-                continue
-
-            # --- Генерация task_core
-            try:
-                params = {
-                    "lesson_id": section_obj.lesson.id,
-                    "task_type": task_type,
-                    "context_flag": False,
-                    "emoji": False,
-                    "user_query": content,
-                    "is_copy": True
-                }
-                prepared_data = generate_task_core(user, params)
-                if prepared_data:
-                    payload = prepared_data.get("data")
-                else:
-                    print(f"[process_pdf_section_task] Пустые prepared_data для задания #{idx}")
-                    continue
-            except Exception as e:
-                print(f"[process_pdf_section_task] Ошибка в generate_task_core для #{idx}: {e}")
-                continue
-
-            # --- Формирование данных
+    except CustomUser.DoesNotExist:
+        return make_error("User not found")
+
+    # --- Этап 1: задания из каждого чанка, параллельно
+    chunk_items = [[] for _ in chunks]
+    report_progress("chunks", 0, len(chunks))
+    with ThreadPoolExecutor(max_workers=max(1, min(PDF_GENERATION_WORKERS, len(chunks)))) as pool:
+        futures = {
+            pool.submit(
+                run_with_own_connection, generate_handler,
+                user=user,
+                query=system_prompt + chunk_text,
+                desired_structure=PDF_TASKS_STRUCTURE,
+                model_type="premium"
+            ): idx
+            for idx, (_, _, chunk_text) in enumerate(chunks)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            idx = futures[future]
+            first, last = chunks[idx][0], chunks[idx][1]
             try:
-                task_data = call_form_function(task_type, user, payload=payload)
-                if not task_data:
-                    print(f"[process_pdf_section_task] Не удалось сформировать данные для #{idx}")
-                    continue
+                items = _parse_generated_list(future.result())
             except Exception as e:
-                print(f"[process_pdf_section_task] Ошибка в call_form_function для #{idx}: {e}")
+                print(f"[process_pdf_section_task] Ошибка генерации для страниц {first}-{last}: {e}")
+                items = None
+            if items is None:
+                print(f"[process_pdf_section_task] Некорректный ответ для страниц {first}-{last}")
+            else:
+                chunk_items[idx] = items
+            report_progress("chunks", done, len(chunks))
+
+    prepared = []
+    for items in chunk_items:
+        for item in items:
+            prepared_item = _prepare_pdf_item(item)
+            if prepared_item:
+                prepared.append(prepared_item)
+
+    if not prepared:
+        return make_error("Generation returned empty result")
+
+    # --- Этап 2: форматирование каждого задания (is_copy), параллельно с ограничением
+    def format_item(prepared_item):
+        task_type, content = prepared_item
+        params = {
+            "lesson_id": section_obj.lesson.id,
+            "task_type": task_type,
+            "context_flag": False,
+            "emoji": False,
+            "user_query": content,
+            "is_copy": True
+        }
+        try:
+            return run_with_own_connection(generate_task_core, user, params)
+        except Exception as e:
+            print(f"[process_pdf_section_task] Ошибка в generate_task_core ({task_type}): {e}")
+            return None
+
+    report_progress("tasks", 0, len(prepared))
+    formatted = [None] * len(prepared)
+    with ThreadPoolExecutor(max_workers=max(1, min(PDF_GENERATION_WORKERS, len(prepared)))) as pool:
+        futures = {pool.submit(format_item, prepared_item): idx for idx, prepared_item in enumerate(prepared)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            formatted[futures[future]] = future.result()
+            report_progress("tasks", done, len(prepared))
+
+    # --- Создание заданий в исходном порядке, одной пачкой
+    to_create = []
+    for idx, ((task_type, _), prepared_data) in enumerate(zip(prepared, formatted), 1):
+        try:
+            payload = prepared_data.get("data") if prepared_data else None
+            if not payload or prepared_data.get("status") != "success":
+                print(f"[process_pdf_section_task] Пустые prepared_data для задания #{idx}")
                 continue
 
-            # --- Создание объекта
-            try:
-                task_obj = create_task_instance(user, task_type, task_data, section_obj)
-                results.append({"task_id": task_obj.id, "task_type": task_type})
-                print(f"[process_pdf_section_task] Задание #{idx} создано (id={task_obj.id})")
-            except Exception as e:
-                print(f"[process_pdf_section_task] Ошибка создания task_instance для #{idx}: {e}")
+            task_data = call_form_function(task_type, user, payload=payload)
+            if not task_data:
+                print(f"[process_pdf_section_task] Не удалось сформировать данные для #{idx}")
                 continue
 
+            to_create.append((task_type, task_data))
         except Exception as e:
-            print(f"[process_pdf_section_task] Критическая ошибка обработки #{idx}: {e}")
+            print(f"[process_pdf_section_task] Ошибка обработки #{idx} ({task_type}): {e}")
             continue
 
+    results = []
+    try:
+        task_objs = create_task_instances_bulk(user, section_obj, to_create)
+        results = [{"task_id": task_obj.id, "task_type": task_type}
+                   for task_obj, (task_type, _) in zip(task_objs, to_create) if task_obj is not None]
+        print(f"[process_pdf_section_task] Создано заданий: {len(results)}")
+    except Exception as e:
+        print(f"[process_pdf_section_task] Ошибка создания заданий: {e}")
+
     # --- Итог
     if not results:
         return make_error("No tasks were created from generated data")
@@ -255,6 +464,9 @@ def process_pdf_section_task(self, section_id, query, pdf_base64, user_id):
 
 
 MAX_AUDIO_SIZE = 80 * 1024 * 1024
+TTS_CHUNK_MAX_CHARS = 800   # длина куска текста для одного запроса Edge-TTS
+TTS_MAX_CONCURRENCY = 4     # одновременных запросов к Edge-TTS на одну задачу
+TTS_CHUNK_RETRIES = 3       # попыток на каждый кусок
 
 def clean_text(text):
     # Удаляем эмодзи
@@ -283,12 +495,96 @@ def clean_text(text):
     # Удаляем лишние пробелы и возвращаем очищенный текст
     return re.sub(r'\s+', ' ', text).strip()
 
+def split_text_for_tts(text, max_chars=TTS_CHUNK_MAX_CHARS):
+    """
+    Делит текст на куски не длиннее max_chars по границам предложений.
+    Предложение длиннее max_chars режется по пробелам.
+    """
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?])\s+', text):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            pieces.append(sentence)
+
+    chunks = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + 1 + len(piece) <= max_chars:
+            chunks[-1] += ' ' + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+async def synthesize_tts(text, voice, rate, pitch):
+    """
+    Озвучивает текст кусками параллельно (не больше TTS_MAX_CONCURRENCY запросов)
+    и склеивает MP3-кадры в исходном порядке. Упавший кусок повторяется
+    до TTS_CHUNK_RETRIES раз; если он так и не получился — исключение.
+    """
+    semaphore = asyncio.Semaphore(TTS_MAX_CONCURRENCY)
+
+    async def _chunk(chunk_text):
+        for attempt in range(1, TTS_CHUNK_RETRIES + 1):
+            try:
+                async with semaphore:
+                    audio = bytearray()
+                    comm = Communicate(chunk_text, voice, rate=rate, pitch=pitch)
+                    async for chunk in comm.stream():
+                        if chunk.get("type") == "audio":
+                            audio.extend(chunk["data"])
+                if audio:
+                    return bytes(audio)
+                raise ValueError("Пустой аудиопоток")
+            except Exception as e:
+                if attempt == TTS_CHUNK_RETRIES:
+                    raise
+                print(f"[synthesize_tts] Попытка {attempt} не удалась ({e}), повтор")
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+    parts = await asyncio.gather(*(_chunk(chunk_text) for chunk_text in split_text_for_tts(text)))
+    return b"".join(parts)
+
+def tts_cache_key(clean, voice, rate, pitch):
+    """Ключ кэша синтеза: SHA-256 от очищенного текста и параметров голоса."""
+    raw = json.dumps([clean, voice, rate, pitch], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def get_cached_tts(text, voice, rate, pitch, user):
+    """
+    Возвращает {'media_id', 'url', 'length_bytes'} для уже синтезированного аудио или None.
+    media_id — собственная запись MediaFile пользователя на тот же файл (место учитывается ему),
+    чтобы ссылка не зависела от того, кто озвучил текст первым.
+    Записи, чей файл исчез из хранилища, удаляются.
+    """
+    from .views import claim_media
+    key = tts_cache_key(clean_text(text), voice, rate, pitch)
+    entry = TtsAudioCache.objects.select_related("media").filter(key=key).first()
+    if not entry:
+        return None
+
+    if not entry.media.file or not entry.media.file.storage.exists(entry.media.file.name):
+        entry.delete()
+        return None
+
+    owned = claim_media(entry.media, user)
+    if not owned or not owned.get('url'):
+        return None
+
+    TtsAudioCache.objects.filter(pk=entry.pk).update(hits=F("hits") + 1, last_used_at=timezone.now())
+    return {'media_id': owned['media_id'], 'url': owned['url'], 'length_bytes': entry.length_bytes}
+
 @shared_task(bind=True)
 def generate_audio_task(self, user_id, text, voice='en-US-JennyNeural', rate='+0%', pitch='+0Hz'):
     """
     Celery задача для генерации аудио.
-    Возвращает байты аудио в base64 или путь к файлу (в зависимости от реализации).
+    Сохраняет аудио в хранилище как MediaFile (с дедупликацией по SHA-256)
+    и возвращает {'media_id', 'url', 'length_bytes'} — сами байты в результат не попадают.
     """
+    from .views import store_media_blob
     from django.contrib.auth import get_user_model
     User = get_user_model()
     user = User.objects.get(id=user_id)
@@ -298,48 +594,79 @@ def generate_audio_task(self, user_id, text, voice='en-US-JennyNeural', rate='+0
         self.update_state(state=states.FAILURE, meta={'exc_message': 'Недопустимая длина текста'})
         return
 
+    # Тот же текст с тем же голосом уже озвучивали — отдаём готовый файл без списания токенов
+    cached = get_cached_tts(clean, voice, rate, pitch, user)
+    if cached:
+        return cached
+
     cost = math.ceil(len(clean) / 100)
 
-    # Проверки токенов
-    if not has_min_tokens(user, min_tokens=-25):
+    # Токены резервируются до синтеза и возвращаются, если аудио получить не удалось
+    reservation_id = reserve_tokens(user, cost, reason='tts')
+    if reservation_id is None:
         self.update_state(state=states.FAILURE, meta={'exc_message': 'Недостаточно токенов для генерации аудио'})
         return
 
-    if not take_tokens(user, cost):
-        self.update_state(state=states.FAILURE, meta={'exc_message': 'Не удалось списать токены'})
-        return
-
-    async def _collect():
-        audio = bytearray()
-        comm = Communicate(clean, voice, rate=rate, pitch=pitch)
-        async for chunk in comm.stream():
-            if chunk.get("type") == "audio":
-                audio.extend(chunk["data"])
-        return bytes(audio)
-
     try:
-        audio_bytes = async_to_sync(_collect)()
+        audio_bytes = async_to_sync(synthesize_tts)(clean, voice, rate, pitch)
     except Exception as e:
+        release_tokens(user, reservation_id, reason='tts')
         self.update_state(state=states.FAILURE, meta={'exc_message': str(e)})
         add_successful_generation("audio", False, f"Ошибка генерации: {e}")
         return
 
     if not audio_bytes:
+        release_tokens(user, reservation_id, reason='tts')
         add_successful_generation("audio", False, "Пустой аудиопоток: " + clean)
         self.update_state(state=states.FAILURE, meta={'exc_message': 'Пустой аудиопоток'})
         return
 
     if len(audio_bytes) > MAX_AUDIO_SIZE:
+        release_tokens(user, reservation_id, reason='tts')
         add_successful_generation("audio", False, "Аудиофайл слишком большой")
         self.update_state(state=states.FAILURE, meta={'exc_message': 'Аудиофайл слишком большой'})
         return
 
+    stored = store_media_blob(audio_bytes, user, ext='.mp3')
+    if not stored or not stored.get('url'):
+        release_tokens(user, reservation_id, reason='tts')
+        add_successful_generation("audio", False, "Не удалось сохранить аудио")
+        self.update_state(state=states.FAILURE, meta={'exc_message': 'Не удалось сохранить аудио'})
+        return
+
+    commit_tokens(user, reservation_id, cost, reason='tts')
+
+    TtsAudioCache.objects.get_or_create(
+        key=tts_cache_key(clean, voice, rate, pitch),
+        defaults={'media_id': stored['media_id'], 'voice': voice, 'length_bytes': len(audio_bytes)}
+    )
+
     add_successful_generation("audio", True, "Successful generation")
+    return {'media_id': stored['media_id'], 'url': stored['url'], 'length_bytes': len(audio_bytes)}
+
+def build_context_prefix(user, lesson_obj, params, model_type):
+    """
+    Возвращает префикс запроса с контекстом урока (или пустую строку).
+    Контекст упаковывается в бюджет токенов выбранного типа модели.
+    """
+    auto_context = params.get('auto_context')
+    if params.get('context_flag') and not params.get('image_data', False):
+        if hasattr(user, 'context_length') and user.context_length:
+            context_length = user.context_length.context_length
+        else:
+            context_length = 2000
+        # Пользовательская длина задаётся в символах — переводим в токены
+        # и ограничиваем окном самой маленькой модели выбранного типа
+        max_tokens = min(context_length // AVG_CHARS_PER_TOKEN, get_context_budget(model_type))
+        return extract_lesson_context(lesson_obj, auto_context, max_tokens)
 
-    # Можно вернуть аудио в base64, или сохранить в хранилище и вернуть путь
-    import base64
-    audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
-    return {'audio_base64': audio_b64, 'length_bytes': len(audio_bytes)}
+    if auto_context:
+        elements = [auto_context] if isinstance(auto_context, str) else auto_context
+        max_tokens = min(AUTO_CONTEXT_MAX_TOKENS, get_context_budget(model_type))
+        joined = "\n".join(pack_context_elements(elements, max_tokens, pinned=1))
+        return f"Ты - методист. Мы уже разработали несколько заданий урока: \n{joined}\n\n Ты должен разработать задание в дополнение к уроку.\n  "
+
+    return ""
 
 def generate_task_core(user, params):
     """
@@ -385,16 +712,7 @@ def generate_task_core(user, params):
 
         # Добавление контекста урока
         try:
-            auto_context = params.get('auto_context')
-            if params.get('context_flag') and not params.get('image_data', False):
-                if hasattr(user, 'context_length') and user.context_length:
-                    context_length = user.context_length.context_length
-                else:
-                    context_length = 2000
-                context = extract_lesson_context(lesson_obj, auto_context, context_length)
-                base_query = context + base_query
-            elif auto_context:
-                base_query = f"Ты - методист. Мы уже разработали несколько заданий урока: \n{auto_context}\n\n Ты должен разработать задание в дополнение к уроку.\n  {base_query}" if auto_context else base_query
+            base_query = build_context_prefix(user, lesson_obj, params, model_type) + base_query
         except Exception as e:
             print(f"[Warning] Context addition failed in core: {e}")
 
@@ -445,6 +763,117 @@ def generate_task_celery(self, user_id, params):
     return generate_task_core(user, params)
 
 
+# Block prompt: несколько заданий блока генерируются одним запросом к модели,
+# общий контекст урока и уровень передаются один раз.
+# LabelImages не входит: его проверка через formLabelImages ищет картинки и списывает токены.
+BLOCK_PROMPT_TASK_TYPES = {
+    "WordList", "Test", "FillInTheBlanks", "MatchUpTheWords", "MakeASentence", "Unscramble",
+    "TrueOrFalse", "Audio", "Essay", "Note", "Article", "SortIntoColumns",
+}
+BLOCK_PROMPT_MAX_TASKS = 4
+BLOCK_PROMPT_STRUCTURE = "JSON {'tasks': [{'index': int, 'data': dict}]}"
+
+def generate_block_core(user, params_list):
+    """
+    Генерирует несколько заданий блока одним запросом к модели.
+    Возвращает список той же длины, что params_list: {'data': ...} для заданий,
+    прошедших проверку form*-функцией, и None для заданий, которые нужно
+    сгенерировать отдельным вызовом.
+    """
+    from hub.views import call_form_function
+
+    results = [None] * len(params_list)
+    if not params_list:
+        return results
+
+    try:
+        lesson_obj = Lesson.objects.select_related('course').get(id=params_list[0]['lesson_id'])
+    except Lesson.DoesNotExist:
+        print("[Error] Lesson retrieval failed in block core")
+        return results
+
+    model_type = 'premium'
+    parts = []
+    for idx, params in enumerate(params_list):
+        query_params = dict(params)
+        if query_params.get('task_type') == "Audio":
+            query_params['task_type'] = "Transcript"
+        try:
+            base_query, _ = build_base_query(query_params)
+            parts.append(f"{idx}. {enhance_query_with_params(base_query, query_params)}")
+        except Exception as e:
+            print(f"[Warning] Query building failed in block core for #{idx}: {e}")
+
+    if not parts:
+        return results
+
+    query = (
+        f"Уровень языка: {lesson_obj.course.student_level}. "
+        + build_context_prefix(user, lesson_obj, params_list[0], model_type)
+        + "Составь несколько заданий урока. Каждое задание оформи строго по указанной для него структуре.\n"
+        + "\n".join(parts)
+        + f"\nВерни только {BLOCK_PROMPT_STRUCTURE} — по одному объекту на задание, index равен номеру задания."
+    )
+
+    response = generate_handler(
+        user=user,
+        query=query,
+        desired_structure=BLOCK_PROMPT_STRUCTURE,
+        model_type=model_type
+    )
+    items = response.get('tasks') if isinstance(response, dict) else None
+    if not isinstance(items, list):
+        print("[Warning] Block prompt returned no task list")
+        return results
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        idx = item.get('index')
+        if not isinstance(idx, int) or not 0 <= idx < len(params_list) or results[idx] is not None:
+            continue
+
+        data = item.get('data')
+        try:
+            formed = call_form_function(params_list[idx]['task_type'], user, payload=data)
+        except Exception as e:
+            print(f"[Warning] Block item #{idx} failed validation: {e}")
+            continue
+
+        if isinstance(formed, dict) and formed.get('status') != 'error':
+            results[idx] = {'data': data}
+
+    return results
+
+@shared_task(bind=True)
+def generate_block_celery(self, user_id, params_list):
+    """
+    Celery-task: генерирует блок заданий одним запросом (block prompt).
+    Задания, не прошедшие проверку, перезапускаются отдельными generate_task_celery.
+    Возвращает {'status': 'success', 'block': [{'data': ...} | {'task_id': ...}, ...]}
+    в порядке params_list.
+    """
+    try:
+        user = CustomUser.objects.get(id=user_id)
+    except Exception as e:
+        print(f"[Error] User retrieval failed in block celery wrapper: {e}")
+        return {'status': 'error', 'message': 'User not found'}
+
+    try:
+        results = generate_block_core(user, params_list)
+    except Exception as e:
+        print(f"[Error] Block generation failed, falling back to per-task calls: {e}")
+        results = [None] * len(params_list)
+
+    block = []
+    for params, result in zip(params_list, results):
+        if result is None:
+            result = {'task_id': str(generate_task_celery.delay(user_id, params).id)}
+        block.append(result)
+
+    return {'status': 'success', 'block': block}
+
+
 
 
 
@@ -482,3 +911,37 @@ def generate_lesson_task(self, user_id, lesson_topic, generation_id=None, course
             except Exception:
                 logger.exception("Failed to mark generation status as failed")
         return {"error": str(e)}
+
+
+@shared_task(bind=True)
+def reconcile_pending_payments_task(self, user_id=None):
+    """
+    Сверка pending-платежей с YooKassa вне HTTP-запроса: для одного пользователя
+    (ставит главная страница) или для всех (крон).
+    """
+    from django.contrib.auth import get_user_model
+    from hub.views import check_user_pending_payments
+    User = get_user_model()
+
+    user = None
+    if user_id is not None:
+        user = User.objects.filter(pk=user_id).first()
+        if user is None:
+            return {"error": "user_not_found"}
+
+    return {"processed": check_user_pending_payments(user)}
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=30)
+def reconcile_payment_task(self, payment_id):
+    """Сверка одного платежа по вебхуку YooKassa; при сетевой ошибке — повтор."""
+    from hub.views import reconcile_pending_payment, PaymentRecord
+
+    payment = PaymentRecord.objects.filter(pk=payment_id, status=PaymentRecord.Status.PENDING).first()
+    if payment is None:
+        return {"processed": False}
+    try:
+        return {"processed": reconcile_pending_payment(payment)}
+    except Exception as e:
+        logger.exception("reconcile_payment_task failed for payment %s: %s", payment_id, e)
+        raise self.retry(exc=e)
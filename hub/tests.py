@@ -4,7 +4,8 @@ from django.urls import reverse
 import uuid
 from django.contrib.contenttypes.models import ContentType
 from hub.models import Course, Lesson, Section, BaseTask, WordList, Classroom
-from django.test import TransactionTestCase
+from hub.utils import estimate_tokens, pack_context_elements, update_auto_context, normalize_image_query
+from django.test import TransactionTestCase, SimpleTestCase
 from channels.testing import WebsocketCommunicator
 from linguaglow.asgi import application
 
@@ -81,4 +82,725 @@ class WebSocketTest(TransactionTestCase):
 
     def test_run_ws_test(self):
         import asyncio
-        asyncio.run(self.test_websocket_connection())
\ No newline at end of file
+        asyncio.run(self.test_websocket_connection())
+
+
+class ContextBudgetTest(SimpleTestCase):
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens("cat, dog"), 3)
+        self.assertGreater(estimate_tokens("Привет"), estimate_tokens("Hello"))
+
+    def test_pack_keeps_pinned_and_latest(self):
+        packed = pack_context_elements(["topic", "old " * 50, "new"], 10, pinned=1)
+        self.assertEqual(packed, ["topic", "new"])
+
+    def test_update_auto_context_respects_budget(self):
+        auto_context = ["Тема урока: animals"]
+        for i in range(50):
+            auto_context = update_auto_context(auto_context, "Note", {"content": f"note number {i} " * 10}, max_tokens=100)
+        self.assertEqual(auto_context[0], "Тема урока: animals")
+        self.assertLessEqual(sum(estimate_tokens(line) + 1 for line in auto_context), 100)
+        self.assertIn("note number 49", auto_context[-1])
+
+
+class ImageQueryKeyTest(SimpleTestCase):
+    def test_normalize_image_query(self):
+        self.assertEqual(normalize_image_query("  Red  Apples! "), "red apple")
+        self.assertEqual(normalize_image_query("boxes"), normalize_image_query("box"))
+        self.assertEqual(normalize_image_query("Children"), "child")
+        self.assertEqual(normalize_image_query("кошки"), "кошки")
+
+
+class TextLayerHeuristicTest(SimpleTestCase):
+    def test_is_text_layer_usable(self):
+        from hub.tasks import is_text_layer_usable
+        self.assertTrue(is_text_layer_usable("Unit 3. Read the text and answer the questions below."))
+        self.assertFalse(is_text_layer_usable(""))
+        self.assertFalse(is_text_layer_usable("12"))
+        self.assertFalse(is_text_layer_usable("\ufffd" * 60))
+        self.assertFalse(is_text_layer_usable("#$%&*@!" * 10))
+
+
+class TtsSplitTest(SimpleTestCase):
+    def test_split_text_for_tts(self):
+        from hub.tasks import split_text_for_tts
+        text = "First sentence. Second one! " + "word " * 60
+        chunks = split_text_for_tts(text.strip(), max_chars=100)
+        self.assertEqual(chunks[0], "First sentence. Second one!")
+        self.assertTrue(all(len(chunk) <= 100 for chunk in chunks))
+        self.assertEqual(" ".join(chunks).split(), text.split())
+
+
+class FakeYooKassaPayment:
+    """Подмена yookassa.Payment: статусы платежей задаются словарём transaction_id -> status."""
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.captured = []
+
+    def find_one(self, transaction_id):
+        return {"id": transaction_id, "status": self.statuses[transaction_id]}
+
+    def capture(self, transaction_id, body, idempotence_key):
+        self.captured.append(transaction_id)
+        self.statuses[transaction_id] = "succeeded"
+        return {"id": transaction_id, "status": "succeeded"}
+
+
+class PendingPaymentsReconcileTest(TestCase):
+    def test_reconcile_credits_captures_and_drops(self):
+        from unittest import mock
+        from users.models import Payment as PaymentRecord, UserTokenBalance
+        from hub.views import check_user_pending_payments
+
+        user = User.objects.create_user(username="payer", password="pass", role="teacher")
+
+        def make(tx):
+            return PaymentRecord.objects.create(
+                user=user, payment_type=PaymentRecord.PaymentType.TOKEN_PACK, token_amount=100,
+                amount=10, full_price=10, transaction_id=tx,
+            )
+        paid, waiting, canceled = make("tx-paid"), make("tx-wait"), make("tx-cancel")
+        fake = FakeYooKassaPayment({"tx-paid": "succeeded", "tx-wait": "waiting_for_capture",
+                                    "tx-cancel": "canceled"})
+
+        with mock.patch("hub.views.Payment", fake):
+            self.assertEqual(check_user_pending_payments(user), 2)
+            # Повторная сверка ничего не зачисляет второй раз
+            self.assertEqual(check_user_pending_payments(user), 0)
+
+        self.assertEqual(fake.captured, ["tx-wait"])
+        self.assertFalse(PaymentRecord.objects.filter(pk=canceled.pk).exists())
+        self.assertEqual(UserTokenBalance.objects.get(user=user).extra_tokens, 200)
+
+
+class ImageSearchHitsFlushTest(TestCase):
+    def setUp(self):
+        from django_redis import get_redis_connection
+        from hub.models import IMAGE_SEARCH_HITS_KEY, IMAGE_SEARCH_LAST_USED_KEY
+        self.keys = [k for key in (IMAGE_SEARCH_HITS_KEY, IMAGE_SEARCH_LAST_USED_KEY) for k in (key, f"{key}:flushing")]
+        get_redis_connection("default").delete(*self.keys)
+
+    def tearDown(self):
+        from django_redis import get_redis_connection
+        get_redis_connection("default").delete(*self.keys)
+
+    def test_flush_hits_applies_buffered_hits(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from hub.models import ImageSearchCache
+        long_ago = timezone.now() - timedelta(days=30)
+        cat = ImageSearchCache.objects.create(key="cat", hits=5, last_used_at=long_ago)
+        dog = ImageSearchCache.objects.create(key="dog", hits=1, last_used_at=long_ago)
+
+        for _ in range(3):
+            ImageSearchCache.record_hit("cat")
+        ImageSearchCache.record_hit("dog")
+        # Попадания не пишутся в БД до сброса
+        cat.refresh_from_db()
+        self.assertEqual(cat.hits, 5)
+
+        self.assertEqual(ImageSearchCache.flush_hits(), 2)
+        cat.refresh_from_db()
+        dog.refresh_from_db()
+        self.assertEqual((cat.hits, dog.hits), (8, 2))
+        self.assertGreater(cat.last_used_at, long_ago)
+        # Повторный сброс пуст
+        self.assertEqual(ImageSearchCache.flush_hits(), 0)
+        cat.refresh_from_db()
+        self.assertEqual(cat.hits, 8)
+
+
+class MediaOwnershipTest(TestCase):
+    """Файлы с одинаковым хэшем у разных пользователей — разные записи MediaFile на один объект хранилища."""
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        from users.models import UserTariff
+        self.media_dir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_dir.name, CHUNKED_UPLOAD_DIR=self.media_dir.name + "/chunks"
+        )
+        self.settings_override.enable()
+        self.owner = User.objects.create_user(username="owner", email="owner@example.com", password="pass", role="teacher")
+        self.other = User.objects.create_user(username="other", email="other@example.com", password="pass", role="teacher")
+        for user in (self.owner, self.other):
+            UserTariff.objects.create(user=user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_dir.cleanup()
+
+    def test_chunked_upload_does_not_hand_out_foreign_media(self):
+        import hashlib
+        from hub.models import MediaFile
+        from hub.views import store_media_blob
+        blob = b"\x89PNG\r\n\x1a\n" + b"pixels" * 100
+        sha256 = hashlib.sha256(blob).hexdigest()
+        foreign = store_media_blob(blob, self.owner, mime="image/png")
+
+        self.client.force_login(self.other)
+        start = self.client.post(reverse("chunked_upload_start"), {
+            "name": "a.png", "mime": "image/png", "size": len(blob), "sha256": sha256,
+        }, content_type="application/json").json()
+        # Знания хэша недостаточно — файл нужно загрузить
+        self.assertNotIn("done", start)
+        upload_id = start["upload_id"]
+        self.client.post(reverse("chunked_upload_chunk", args=[upload_id]), blob,
+                         content_type="application/octet-stream", HTTP_X_UPLOAD_OFFSET="0")
+        finish = self.client.post(reverse("chunked_upload_finish", args=[upload_id])).json()
+
+        self.assertNotEqual(finish["media_id"], foreign["media_id"])
+        own = MediaFile.objects.get(id=finish["media_id"])
+        self.assertEqual(own.user, self.other)
+        # Объект хранилища общий, место учитывается обоим
+        self.assertEqual(own.storage_key, MediaFile.objects.get(id=foreign["media_id"]).storage_key)
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.used_storage, len(blob))
+
+        again = self.client.post(reverse("chunked_upload_start"), {
+            "name": "a.png", "mime": "image/png", "size": len(blob), "sha256": sha256,
+        }, content_type="application/json").json()
+        self.assertEqual((again["done"], again["media_id"]), (True, str(own.id)))
+
+    def test_upload_extension_comes_from_mime(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from hub.models import MediaFile
+        self.client.force_login(self.other)
+        upload = SimpleUploadedFile("evil.html", b"<script>alert(1)</script>", content_type="image/png")
+        response = self.client.post(reverse("upload_media"), {"file": upload}).json()
+        media = MediaFile.objects.get(id=response["media_id"])
+        self.assertTrue(media.storage_key.endswith(".png"))
+
+    def test_task_save_rejects_foreign_media_id(self):
+        import json
+        from hub.views import store_media_blob
+        foreign = store_media_blob(b"foreign image bytes", self.owner, mime="image/png")
+        course = Course.objects.create(name="Course", user=self.other)
+        section = Section.objects.create(name="Section", lesson=Lesson.objects.create(name="Lesson", course=course))
+
+        self.client.force_login(self.other)
+        response = self.client.post(reverse("save_task", args=[section.id]), json.dumps({
+            "task_type": "Image", "payloads": {"title": "Picture", "media_id": foreign["media_id"]},
+        }), content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(BaseTask.objects.filter(section=section).exists())
+
+    def test_replacing_file_in_shared_content_keeps_original(self):
+        import json
+        from hub.models import Image, MediaFile
+        from hub.views import store_media_blob, is_task_content_shared
+
+        def make_section(user):
+            course = Course.objects.create(name="Course", user=user)
+            return Section.objects.create(name="Section", lesson=Lesson.objects.create(name="Lesson", course=course))
+
+        original = store_media_blob(b"original image", self.owner, mime="image/png")
+        image = Image.objects.create(title="Picture", image_url=original["url"])
+        image_type = ContentType.objects.get_for_model(Image)
+        owner_task = BaseTask.objects.create(section=make_section(self.owner), order=1,
+                                             content_type=image_type, object_id=image.id)
+        owner_task.media.add(original["media_id"])
+        # Копия урока без копирования контента
+        other_section = make_section(self.other)
+        copy_task = BaseTask.objects.create(section=other_section, order=1,
+                                            content_type=image_type, object_id=image.id)
+        copy_task.media.add(original["media_id"])
+        self.assertTrue(is_task_content_shared(copy_task))
+
+        # Автор меняет картинку в своём задании: копия должна сохранить прежний файл
+        replacement = store_media_blob(b"replacement image", self.owner, mime="image/png")
+        self.client.force_login(self.owner)
+        response = self.client.post(reverse("save_task", args=[owner_task.section_id]), json.dumps({
+            "obj_id": str(owner_task.id), "task_type": "Image",
+            "payloads": {"title": "Picture", "media_id": replacement["media_id"]},
+        }), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+        image.refresh_from_db()
+        owner_task.refresh_from_db()
+        self.assertEqual(image.image_url, original["url"])
+        self.assertNotEqual(owner_task.object_id, image.id)
+        self.assertTrue(MediaFile.objects.filter(id=original["media_id"]).exists())
+        # Задание без раздела не делает контент общим
+        owner_task.object_id = image.id
+        owner_task.save()
+        copy_task.section = None
+        copy_task.save()
+        self.assertFalse(is_task_content_shared(owner_task))
+
+    def test_tts_cache_hit_gives_requester_own_media(self):
+        from hub.models import MediaFile, TtsAudioCache
+        from hub.tasks import get_cached_tts, tts_cache_key, clean_text
+        from hub.views import store_media_blob, removeFile
+        audio = b"ID3" + b"\x00" * 300
+        stored = store_media_blob(audio, self.owner, ext=".mp3")
+        TtsAudioCache.objects.create(key=tts_cache_key(clean_text("Hello there"), "en-US-JennyNeural", "+0%", "+0Hz"),
+                                     media_id=stored["media_id"], voice="en-US-JennyNeural", length_bytes=len(audio))
+
+        cached = get_cached_tts("Hello there", "en-US-JennyNeural", "+0%", "+0Hz", self.other)
+        media = MediaFile.objects.get(id=cached["media_id"])
+        self.assertEqual(media.user, self.other)
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.used_storage, len(audio))
+
+        # Автор удаляет задание со своим аудио — файл остаётся у того, кто получил его из кэша
+        from hub.models import Audio
+        course = Course.objects.create(name="Course", user=self.owner)
+        section = Section.objects.create(name="Section", lesson=Lesson.objects.create(name="Lesson", course=course))
+        content = Audio.objects.create(audio_url=stored["url"])
+        task = BaseTask.objects.create(section=section, order=1, object_id=content.id,
+                                       content_type=ContentType.objects.get_for_model(Audio))
+        task.media.add(stored["media_id"])
+        self.assertTrue(removeFile(stored["url"], self.owner)["deleted"])
+        self.assertFalse(MediaFile.objects.filter(id=stored["media_id"]).exists())
+        self.assertTrue(media.file.storage.exists(media.file.name))
+        # Запись кэша пережила удаление и по-прежнему отдаёт файл
+        self.assertEqual(TtsAudioCache.objects.get().media_id, media.id)
+        again = get_cached_tts("Hello there", "en-US-JennyNeural", "+0%", "+0Hz", self.owner)
+        self.assertEqual(again["url"], cached["url"])
+
+
+class BulkTaskCreationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="bulk", password="pass", role="teacher")
+        course = Course.objects.create(name="Course", user=self.user)
+        self.section = Section.objects.create(name="Section", lesson=Lesson.objects.create(name="Lesson", course=course))
+
+    def test_invalid_items_do_not_sink_the_batch(self):
+        from hub.views import create_task_instances_bulk
+        tasks = create_task_instances_bulk(self.user, self.section, [
+            ("WordList", {"title": "x" * 1000, "words": ["cat"]}),
+            ("WordList", {"title": "Bad", "words": ["dog"], "no_such_field": 1}),
+            ("Unknown", {}),
+            ("Note", {"content": "Remember this"}),
+        ])
+        self.assertIsNone(tasks[1])
+        self.assertIsNone(tasks[2])
+        self.assertEqual([t.order for t in (tasks[0], tasks[3])], [1, 2])
+        self.assertEqual(len(WordList.objects.get(id=tasks[0].object_id).title), 255)
+
+    def test_falls_back_to_single_inserts(self):
+        from unittest import mock
+        from django.db import DatabaseError
+        from hub.views import create_task_instances_bulk
+        original_bulk_create = WordList.objects.bulk_create
+
+        def fail_on_batches(objs, *args, **kwargs):
+            if len(objs) > 1:
+                raise DatabaseError("batch rejected")
+            return original_bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(WordList.objects, "bulk_create", side_effect=fail_on_batches):
+            tasks = create_task_instances_bulk(self.user, self.section, [
+                ("WordList", {"title": "One", "words": ["a"]}),
+                ("WordList", {"title": "Two", "words": ["b"]}),
+            ])
+        self.assertTrue(all(tasks))
+        self.assertEqual(BaseTask.objects.filter(section=self.section).count(), 2)
+
+
+class HomeFragmentsRoleTest(TestCase):
+    def test_switching_role_shows_notifications_for_new_role(self):
+        from users.models import Notification
+        from hub.views import build_home_fragments, invalidate_home_fragments
+        student = User.objects.create_user(username="switcher", password="pass", role="student")
+        invalidate_home_fragments(student.id)
+        Notification.objects.create(title="For students", message="s", target_roles=["student"])
+        Notification.objects.create(title="For teachers", message="t", target_roles=["teacher"])
+
+        titles = [n['title'] for n in build_home_fragments(student, student.role)['notifications']]
+        self.assertEqual(titles, ["For students"])
+
+        self.client.force_login(student)
+        response = self.client.post(reverse("switch_role"), "{}", content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        student.refresh_from_db()
+        titles = [n['title'] for n in build_home_fragments(student, student.role)['notifications']]
+        self.assertEqual(titles, ["For teachers"])
+        invalidate_home_fragments(student.id)
+
+
+class ImageSearchManyTokensTest(TestCase):
+    def test_reserves_up_front_and_charges_performed_searches(self):
+        from unittest import mock
+        from users.models import UserTokenBalance, TokenLedger
+        from hub.ai_calls import search_images_many
+        user = User.objects.create_user(username="searcher", password="pass", role="teacher")
+        UserTokenBalance.credit(user.id, extra_amount=10)
+
+        with mock.patch("hub.ai_calls.search_images_api", return_value={"images": [{"url": "x"}]}):
+            found = search_images_many(["cat", "dog", "owl"], user, max_workers=1)
+        self.assertEqual(sorted(found), [0, 1, 2])
+        self.assertEqual(UserTokenBalance.objects.get(user=user).tokens, 7)
+        kinds = set(TokenLedger.objects.filter(user=user, reason="image_search").values_list("kind", flat=True))
+        self.assertEqual(kinds, {"reserve", "commit"})
+
+        with mock.patch("hub.ai_calls.search_images_api", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                search_images_many(["cat"], user)
+        self.assertEqual(UserTokenBalance.objects.get(user=user).tokens, 7)
+
+
+class PdfSectionProgressTest(TestCase):
+    def test_tasks_progress_reported_as_items_finish(self):
+        from contextlib import contextmanager
+        from unittest import mock
+        from hub.tasks import _process_pdf_section
+
+        teacher = User.objects.create_user(username="pdfteacher", password="pass", role="teacher")
+        course = Course.objects.create(name="Course", user=teacher)
+        section = Section.objects.create(name="Section", lesson=Lesson.objects.create(name="Lesson", course=course))
+
+        @contextmanager
+        def fake_path(name):
+            yield "/tmp/fake.pdf"
+
+        class FakeTask:
+            def __init__(self):
+                self.states = []
+
+            def update_state(self, state, meta):
+                self.states.append((meta["stage"], meta["done"], meta["total"]))
+
+        items = [{"task_type": "GrammarNote", "instruction": f"Rule {i}", "content": "text"} for i in range(3)]
+        formatted = {"status": "success", "data": {"title": "Rule", "content": "Use the present simple."}}
+        task = FakeTask()
+        with mock.patch("hub.tasks.local_pdf_path", fake_path), \
+                mock.patch("hub.tasks.file_sha256", return_value="0" * 64), \
+                mock.patch("hub.tasks.iter_pdf_pages_text", return_value=[(1, "Page text " * 20)]), \
+                mock.patch("hub.tasks.generate_handler", return_value=items), \
+                mock.patch("hub.tasks.generate_task_core", return_value=formatted):
+            result = _process_pdf_section(task, section.id, "", "fake.pdf", teacher.id)
+
+        self.assertEqual(result["status"], "ok")
+        self.assertEqual(len(result["result"]), 3)
+        self.assertEqual([s for s in task.states if s[0] == "tasks"],
+                         [("tasks", 0, 3), ("tasks", 1, 3), ("tasks", 2, 3), ("tasks", 3, 3)])
+
+
+class BlockPromptTest(TestCase):
+    def test_block_prompt_keeps_valid_items_only(self):
+        from unittest import mock
+        from hub.tasks import generate_block_core
+        user = User.objects.create_user(username="blocker", password="pass", role="teacher")
+        course = Course.objects.create(name="Course", user=user)
+        lesson = Lesson.objects.create(name="Lesson", course=course)
+        params = [
+            {"lesson_id": lesson.id, "task_type": "WordList", "user_query": "animals", "context_flag": False},
+            {"lesson_id": lesson.id, "task_type": "WordList", "user_query": "colours", "context_flag": False},
+        ]
+        words = {"title": "Animals", "words": [{"word": "cat", "translation": "кот"}]}
+        response = {"tasks": [
+            {"index": 0, "data": words},
+            {"index": 1, "data": "not a task"},
+            {"index": 7, "data": words},
+        ]}
+        with mock.patch("hub.tasks.generate_handler", return_value=response) as handler:
+            results = generate_block_core(user, params)
+        handler.assert_called_once()
+        self.assertEqual(results, [{"data": words}, None])
+
+
+class LabelImagesSearchTest(TestCase):
+    def setUp(self):
+        from users.models import UserTokenBalance
+        self.user = User.objects.create_user(username="labeler", password="pass", role="teacher")
+        UserTokenBalance.credit(self.user.id, extra_amount=10)
+
+    @staticmethod
+    def fake_search(query, user=None, charge=True):
+        return {"images": [{"url": f"https://img.example/{query}.jpg"}] if query != "xyzzy" else []}
+
+    def test_labels_get_pictures_from_parallel_search(self):
+        from unittest import mock
+        from users.models import UserTokenBalance
+        from hub.views import formLabelImages
+        with mock.patch("hub.ai_calls.search_images_api", side_effect=self.fake_search):
+            result = formLabelImages(self.user, {"title": "Pets", "labels": ["cat", "dog", "xyzzy"]})
+        self.assertEqual(result["title"], "Pets")
+        self.assertEqual(sorted((img["label"], img["url"]) for img in result["images"]), [
+            ("cat", "https://img.example/cat.jpg"), ("dog", "https://img.example/dog.jpg"),
+        ])
+        self.assertEqual(UserTokenBalance.objects.get(user=self.user).tokens, 7)
+
+    def test_stale_cached_balance_limits_searches_instead_of_failing(self):
+        from unittest import mock
+        from users.models import UserTokenBalance
+        from hub.views import formLabelImages
+        self.assertEqual(self.user.token_balance.tokens, 10)
+        # Токены списаны в другом месте — закэшированный на пользователе остаток устарел
+        UserTokenBalance.debit(self.user.id, 8)
+
+        with mock.patch("hub.ai_calls.search_images_api", side_effect=self.fake_search):
+            result = formLabelImages(self.user, {"title": "Pets", "labels": ["cat", "dog", "owl"]})
+        self.assertEqual(sorted(img["label"] for img in result["images"]), ["cat", "dog"])
+        self.assertEqual(UserTokenBalance.objects.get(user=self.user).tokens, 0)
+
+
+class TempMediaRootTestCase(TestCase):
+    """MEDIA_ROOT во временном каталоге: файлы теста не попадают в настоящее хранилище."""
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        self.media_dir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_dir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_dir.cleanup()
+
+
+class PdfUploadTest(TempMediaRootTestCase):
+    def test_uploaded_pdf_is_readable_from_local_path(self):
+        from unittest import mock
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        from hub.tasks import save_pdf_upload, local_pdf_path, PDF_UPLOAD_DIR
+        content = b"%PDF-1.4\n" + b"0" * 3000
+        name = save_pdf_upload(ContentFile(content, name="lesson.pdf"))
+        self.assertTrue(name.startswith(PDF_UPLOAD_DIR + "/"))
+
+        with local_pdf_path(name) as path:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+        # Хранилище без локальных путей — файл копируется во временный
+        class RemoteStorage:
+            def path(self, name):
+                raise NotImplementedError
+
+            def open(self, name, mode="rb"):
+                return default_storage.open(name, mode)
+
+        with mock.patch("hub.tasks.default_storage", RemoteStorage()):
+            with local_pdf_path(name) as path:
+                with open(path, "rb") as f:
+                    self.assertEqual(f.read(), content)
+
+
+class PdfPageTextCacheTest(TempMediaRootTestCase):
+    def test_page_text_is_cached_by_pdf_hash(self):
+        import os
+        import fitz
+        from hub.models import PdfPageText
+        from hub.tasks import iter_pdf_pages_text, file_sha256
+        path = os.path.join(self.media_dir.name, "text.pdf")
+        with fitz.open() as doc:
+            doc.new_page().insert_text((72, 72), "The quick brown fox jumps over the lazy dog again and again")
+            doc.save(path)
+        pdf_hash = file_sha256(path)
+
+        pages = list(iter_pdf_pages_text(path, workers=1, pdf_hash=pdf_hash))
+        self.assertEqual(len(pages), 1)
+        self.assertIn("quick brown fox", pages[0][1])
+        self.assertEqual(PdfPageText.objects.filter(pdf_hash=pdf_hash).count(), 1)
+
+        # Повторная обработка берёт текст из кэша, а не из файла
+        PdfPageText.objects.filter(pdf_hash=pdf_hash).update(text="cached page text")
+        self.assertEqual(list(iter_pdf_pages_text(path, workers=1, pdf_hash=pdf_hash)), [(1, "cached page text")])
+
+
+class GeneratedAudioStorageTest(TempMediaRootTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="audiouser", email="audiouser@example.com",
+                                             password="pass", role="teacher")
+
+    def test_generated_audio_is_stored_as_media(self):
+        from unittest import mock
+        from hub.models import MediaFile, TtsAudioCache
+        from hub.tasks import generate_audio_task
+        from users.models import UserTokenBalance
+        UserTokenBalance.credit(self.user.id, extra_amount=10)
+        audio = b"ID3" + b"\x00" * 500
+
+        async def fake_synthesize(text, voice, rate, pitch):
+            return audio
+
+        with mock.patch("hub.tasks.synthesize_tts", fake_synthesize):
+            result = generate_audio_task.apply(args=[self.user.id, "Hello there"]).get()
+        self.assertEqual(set(result), {"media_id", "url", "length_bytes"})
+        self.assertEqual(result["length_bytes"], len(audio))
+        self.assertTrue(MediaFile.objects.get(id=result["media_id"]).storage_key.endswith(".mp3"))
+        self.assertTrue(TtsAudioCache.objects.filter(media_id=result["media_id"]).exists())
+        self.assertEqual(UserTokenBalance.objects.get(user=self.user).tokens, 9)
+
+
+class MediaStreamHashTest(TempMediaRootTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="streamuser", email="streamuser@example.com",
+                                             password="pass", role="teacher")
+
+    def test_data_uri_is_hashed_and_stored_in_one_pass(self):
+        import base64
+        import hashlib
+        from hub.models import MediaFile
+        from hub.views import hashMediaFile
+        blob = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 500
+        encoded = base64.b64encode(blob).decode()
+        data_uri = "data:image/png;base64," + "\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+
+        stored = hashMediaFile(data_uri, self.user)
+        self.assertEqual(stored["size"], len(blob))
+        media = MediaFile.objects.get(id=stored["media_id"])
+        self.assertEqual(media.hash, hashlib.sha256(blob).hexdigest())
+        with media.file.open("rb") as f:
+            self.assertEqual(f.read(), blob)
+
+        again = hashMediaFile(data_uri, self.user)
+        self.assertEqual((again["media_id"], again["size"]), (stored["media_id"], 0))
+        self.assertIsNone(hashMediaFile("data:image/png;base64,%%%", self.user))
+
+
+class MediaUrlLookupTest(TempMediaRootTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="lookupuser", email="lookupuser@example.com",
+                                             password="pass", role="teacher")
+
+    def test_media_url_resolves_by_storage_key(self):
+        from hub.views import media_storage_key, resolve_media_url, store_media_blob
+        self.assertEqual(media_storage_key("https://linguaglow.ru/media/uploads/a%20b.png"), "uploads/a b.png")
+        self.assertEqual(media_storage_key("/media/uploads/x.png"), "uploads/x.png")
+        self.assertIsNone(media_storage_key("/static/x.png"))
+
+        stored = store_media_blob(b"some image", self.user, mime="image/png")
+        memo = {}
+        media = resolve_media_url("https://linguaglow.ru" + stored["url"], memo, self.user)
+        self.assertEqual(str(media.id), stored["media_id"])
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_media_url(stored["url"], memo, self.user), media)
+
+
+class SectionCloneTest(TestCase):
+    def setUp(self):
+        from hub.models import MediaFile
+        self.user = User.objects.create_user(username="cloner", email="cloner@example.com",
+                                             password="pass", role="teacher")
+        course = Course.objects.create(name="Course", user=self.user)
+        lesson = Lesson.objects.create(name="Lesson", course=course)
+        self.old_section = Section.objects.create(name="Old", lesson=lesson)
+        self.new_section = Section.objects.create(name="New", lesson=lesson)
+        word_list_type = ContentType.objects.get_for_model(WordList)
+        self.media = MediaFile.objects.create(user=self.user, hash="f" * 64, file="uploads/pic.png")
+        for order, title in ((1, "First"), (2, "Second")):
+            content = WordList.objects.create(title=title, words=["cat"])
+            task = BaseTask.objects.create(section=self.old_section, order=order, size=100,
+                                           content_type=word_list_type, object_id=content.id)
+            if order == 1:
+                task.media.add(self.media)
+
+    def test_clone_copies_tasks_media_and_storage(self):
+        from hub.views import clone_sections_bulk
+        used_before = self.user.used_storage
+        self.assertEqual(clone_sections_bulk([(self.old_section, self.new_section)], self.user), 2)
+
+        copies = list(BaseTask.objects.filter(section=self.new_section).order_by("order"))
+        originals = list(BaseTask.objects.filter(section=self.old_section).order_by("order"))
+        self.assertEqual([t.order for t in copies], [1, 2])
+        self.assertEqual([WordList.objects.get(id=t.object_id).title for t in copies], ["First", "Second"])
+        self.assertTrue(all(c.object_id != o.object_id for c, o in zip(copies, originals)))
+        self.assertEqual(list(copies[0].media.all()), [self.media])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.used_storage, used_before + 200)
+
+    def test_shared_clone_reuses_content(self):
+        from hub.views import clone_sections_bulk
+        used_before = self.user.used_storage
+        clone_sections_bulk([(self.old_section, self.new_section)], self.user, share_content=True)
+
+        copies = BaseTask.objects.filter(section=self.new_section).order_by("order")
+        originals = BaseTask.objects.filter(section=self.old_section).order_by("order")
+        self.assertEqual([t.object_id for t in copies], [t.object_id for t in originals])
+        self.assertEqual({t.size for t in copies}, {0})
+        self.assertEqual(WordList.objects.count(), 2)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.used_storage, used_before)
+
+
+class SendHomeworkTest(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user(username="hwteacher", email="hwteacher@example.com",
+                                                password="pass", role="teacher")
+        self.students = [
+            User.objects.create_user(username=f"hwstudent{i}", email=f"hwstudent{i}@example.com",
+                                     password="pass", role="student")
+            for i in range(2)
+        ]
+        self.classroom = Classroom.objects.create(name="Class")
+        self.classroom.teachers.add(self.teacher)
+        self.classroom.students.add(*self.students)
+
+    def test_send_homework_replaces_task_links(self):
+        import json
+        from hub.models import Homework
+        course = Course.objects.create(name="Course", user=self.teacher)
+        lesson = Lesson.objects.create(name="Lesson", course=course)
+        section = Section.objects.create(name="Section", lesson=lesson)
+        word_list_type = ContentType.objects.get_for_model(WordList)
+        tasks = [
+            BaseTask.objects.create(section=section, order=i, content_type=word_list_type,
+                                    object_id=WordList.objects.create(title=f"List {i}", words=[]).id)
+            for i in range(3)
+        ]
+
+        def send(task_list):
+            return self.client.post(reverse("send_homework"), json.dumps({
+                "classroom_id": str(self.classroom.id), "lesson_id": str(lesson.id),
+                "task_ids": [str(t.id) for t in task_list],
+            }), content_type="application/json")
+
+        self.client.force_login(self.teacher)
+        self.assertEqual(send(tasks[:2]).json()["created_count"], 2)
+        homeworks = Homework.objects.filter(classroom=self.classroom, lesson=lesson)
+        self.assertEqual({hw.student_id for hw in homeworks}, {s.id for s in self.students})
+        for hw in homeworks:
+            self.assertEqual(set(hw.tasks.values_list("id", flat=True)), {tasks[0].id, tasks[1].id})
+
+        send(tasks[1:])
+        self.assertEqual(homeworks.count(), 2)
+        for hw in homeworks:
+            self.assertEqual(set(hw.tasks.values_list("id", flat=True)), {tasks[1].id, tasks[2].id})
+
+
+class ClassroomAccessCacheTest(TestCase):
+    def setUp(self):
+        from hub.views import invalidate_classroom_access
+        self.teacher = User.objects.create_user(username="hwteacher", email="hwteacher@example.com",
+                                                password="pass", role="teacher")
+        self.students = [
+            User.objects.create_user(username=f"hwstudent{i}", email=f"hwstudent{i}@example.com",
+                                     password="pass", role="student")
+            for i in range(2)
+        ]
+        self.classroom = Classroom.objects.create(name="Class")
+        self.classroom.teachers.add(self.teacher)
+        self.classroom.students.add(self.students[0])
+        self.user_ids = [self.teacher.id] + [s.id for s in self.students]
+        invalidate_classroom_access(self.classroom.id, self.user_ids)
+
+    def tearDown(self):
+        from hub.views import invalidate_classroom_access
+        invalidate_classroom_access(self.classroom.id, self.user_ids)
+
+    def test_classroom_access_is_memoized_and_invalidated(self):
+        from hub.views import get_classroom_access, invalidate_classroom_access
+        access = get_classroom_access(self.teacher, self.classroom)
+        self.assertEqual(access["role"], "teacher")
+        self.assertEqual(access["class_count"], 1)
+        with self.assertNumQueries(0):
+            self.assertIs(get_classroom_access(self.teacher, self.classroom), access)
+
+        # Новый объект пользователя (следующий запрос) берёт контекст из Redis
+        teacher = User.objects.get(id=self.teacher.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_classroom_access(teacher, self.classroom)["role"], "teacher")
+
+        newcomer = self.students[1]
+        self.assertIsNone(get_classroom_access(User.objects.get(id=newcomer.id), self.classroom)["role"])
+        self.classroom.students.add(newcomer)
+        invalidate_classroom_access(self.classroom.id, [newcomer.id])
+        self.assertEqual(get_classroom_access(User.objects.get(id=newcomer.id), self.classroom)["role"], "student")
@@ -24,6 +24,10 @@ urlpatterns = [
     path('section/<uuid:section_id>/update', views.update_section, name='update_section'),
     path('section/<uuid:section_id>/delete/', views.delete_section_view, name='delete_section'),
     path('section/<uuid:section_id>/task/save', views.taskSave, name='save_task'),
+    path('upload-media/', views.upload_media, name='upload_media'),
+    path('upload-media/chunked/', views.chunked_upload_start, name='chunked_upload_start'),
+    path('upload-media/chunked/<slug:upload_id>/', views.chunked_upload_chunk, name='chunked_upload_chunk'),
+    path('upload-media/chunked/<slug:upload_id>/finish/', views.chunked_upload_finish, name='chunked_upload_finish'),
     path('api/tasks/<uuid:task_id>/', views.get_task_data, name='get_task_data'),
     path('api/section/<uuid:section_id>', views.get_section_tasks, name='get_section_tasks'),
     path('tasks/<uuid:task_id>/delete/', views.delete_task, name='delete_task'),
@@ -90,6 +94,7 @@ urlpatterns = [
 
     path('payments/connect-tokens/', views.connect_tokens, name='connect_tokens'),
     path('payments/return/', views.tokens_return, name='return'),
+    path('payments/yookassa-webhook/', views.yookassa_webhook, name='yookassa_webhook'),
 
     path('api/subscribe/', views.subscribe_emails, name='subscribe'),
     path('api/switch-role/', views.switch_role, name='switch_role'),
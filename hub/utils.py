@@ -2,8 +2,11 @@
 import json
 import random
 import re
+from contextlib import contextmanager
 from bs4 import BeautifulSoup
 from django.http import JsonResponse
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
 
 
 
@@ -28,14 +31,135 @@ def process_image_data(image_data):
 
     raise ValueError('Invalid image format. Expected base64 data URL.')
 
-def extract_lesson_context(lesson_obj, auto_context, max_chars):
+# Сброс дольше этого времени считается зависшим: блокировка снимается, и следующий запуск дочитает снимок
+REDIS_FLUSH_LOCK_TIMEOUT = 10 * 60
+
+
+def redis_flush_lock_key(key):
+    return f"{key}:flush_lock"
+
+
+@contextmanager
+def redis_hash_snapshot(*keys):
+    """
+    Забирает буферные хэши Redis для сброса в БД. Каждый ключ переименовывается
+    в <key>:flushing (незавершённый прошлый сброс дочитывается первым), а новые события
+    копятся в свежем хэше. Отдаёт {key: {поле: значение}}. Снимки удаляются только после
+    успешного выхода из блока; при исключении их подберёт следующий запуск.
+
+    Весь сброс (снимок, запись в БД, удаление) идёт под блокировкой по первому ключу:
+    если сброс уже выполняется в другом процессе, отдаются пустые хэши — иначе оба
+    прочитали бы один снимок и учли его дважды.
+    """
+    redis = get_redis_connection("default")
+    lock = redis.lock(redis_flush_lock_key(keys[0]), timeout=REDIS_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        yield {key: {} for key in keys}
+        return
+
+    try:
+        snapshot = {}
+        for key in keys:
+            flushing = f"{key}:flushing"
+            if not redis.exists(flushing) and redis.exists(key):
+                redis.rename(key, flushing)
+            snapshot[key] = {k.decode(): v.decode() for k, v in redis.hgetall(flushing).items()}
+        yield snapshot
+        redis.delete(*[f"{key}:flushing" for key in keys])
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            pass  # блокировка истекла по таймауту
+
+
+def redis_hash_pending(key, field):
+    """Значение поля буферного хэша с учётом снимка, который сейчас сбрасывается."""
+    redis = get_redis_connection("default")
+    return sum(int(v or 0) for v in (redis.hget(key, field), redis.hget(f"{key}:flushing", field)))
+
+
+# Оценка токенов без обращения к токенизатору модели.
+# BPE-токенизаторы (Llama, Gemma) кодируют частые английские слова одним токеном,
+# длинные слова — несколькими, а кириллицу и цифры — примерно по 2-3 символа на токен.
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", flags=re.UNICODE)
+AVG_CHARS_PER_TOKEN = 3
+AUTO_CONTEXT_MAX_TOKENS = 1000
+
+
+def _piece_tokens(piece: str) -> int:
+    if not (piece[0].isalnum() or piece[0] == "_"):
+        return 1  # знак препинания
+    if piece.isascii() and not piece.isdigit():
+        return 1 + (len(piece) - 1) // 5
+    return -(-len(piece) // 3)
+
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительно считает количество токенов модели в тексте (линейно по длине)."""
+    if not text:
+        return 0
+    return sum(_piece_tokens(m.group()) for m in _TOKEN_RE.finditer(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Оставляет конец текста, укладывающийся в max_tokens."""
+    if max_tokens <= 0 or not text:
+        return ""
+    matches = list(_TOKEN_RE.finditer(text))
+    used = 0
+    start = len(text)
+    for m in reversed(matches):
+        cost = _piece_tokens(m.group())
+        if used + cost > max_tokens:
+            break
+        used += cost
+        start = m.start()
+    return text[start:].lstrip()
+
+
+def pack_context_elements(elements, max_tokens: int, pinned: int = 0):
+    """
+    Упаковывает элементы контекста в бюджет max_tokens за один проход.
+
+    Более поздние элементы считаются более релевантными: набираем с конца,
+    пропуская не влезающие элементы. Первые pinned элементов сохраняются всегда
+    (например, тема урока). Если не влезает даже самый свежий элемент —
+    берётся его конец. Порядок элементов сохраняется.
+    """
+    elements = [e for e in elements if e]
+    head, tail = elements[:pinned], elements[pinned:]
+
+    budget = max_tokens
+    for element in head:
+        budget -= estimate_tokens(element) + 1
+
+    picked = []
+    for element in reversed(tail):
+        if budget <= 0:
+            break
+        cost = estimate_tokens(element) + 1  # +1 на разделитель
+        if cost <= budget:
+            picked.append(element)
+            budget -= cost
+        elif not picked:
+            truncated = truncate_to_tokens(element, budget - 1)
+            if truncated:
+                picked.append(truncated)
+                budget = 0
+
+    picked.reverse()
+    return head + picked
+
+
+def extract_lesson_context(lesson_obj, auto_context, max_tokens):
     """Извлекает контекст из урока и auto_context, возвращает строку с приоритетом конца, с префиксом SYSTEM CONTEXT."""
     from hub.views import normalize
 
-    lesson_context = lesson_obj.context
-    full_text = ""
+    lesson_context = lesson_obj.context or {}
+    elements = []
 
-    # Собираем весь контекст из lesson_context в одну строку
+    # Собираем элементы контекста из lesson_context
     for key, value in lesson_context.items():
         if key == "base":
             continue
@@ -49,34 +173,31 @@ def extract_lesson_context(lesson_obj, auto_context, max_chars):
             bold_words = re.findall(r"<b>(.*?)</b>", content)
             clean = [normalize(w).strip() for w in bold_words if normalize(w).strip()]
             if clean:
-                full_text += f"{header}: {', '.join(clean)}. "
+                elements.append(f"{header}: {', '.join(clean)}.")
         else:
             text = BeautifulSoup(content, "html.parser").get_text()
             text = normalize(text)
             text = re.sub(r'[^\w\s,.\-!?]', '', text).strip()
             if text:
-                full_text += f"{header}: {text}. "
+                elements.append(f"{header}: {text}.")
 
     # Добавляем auto_context, если есть
     if auto_context:
-        auto_context_text = " ".join(normalize(line) for line in auto_context)
-        if auto_context_text:
-            full_text += auto_context_text
+        if isinstance(auto_context, str):
+            auto_context = [auto_context]
+        elements.extend(normalize(line) for line in auto_context)
 
-    full_text = full_text.strip()
-
-    # Обрезаем строку с приоритетом конца (срезаем спереди, чтобы сохранить конец)
-    if len(full_text) > max_chars:
-        full_text = full_text[-max_chars:].lstrip()
+    # Упаковываем в бюджет токенов с приоритетом конца
+    full_text = " ".join(pack_context_elements(elements, max_tokens)).strip()
 
     return f"Ты - методист. Мы уже разработали несколько заданий урока: \n{full_text}\n\n Ты должен разработать задание в дополнение к уроку.\n" if full_text else ""
 
-def update_auto_context(auto_context, task_type, result):
+def update_auto_context(auto_context, task_type, result, max_tokens=AUTO_CONTEXT_MAX_TOKENS):
     """
     Добавляет строку в auto_context на основе task_type и result.
     Гарантирует, что:
     - первый элемент в auto_context сохраняется;
-    - длина итоговой строки auto_context не превышает 3000 символов.
+    - итоговый auto_context укладывается в max_tokens токенов.
     """
     if not isinstance(auto_context, list):
         auto_context = []
@@ -113,17 +234,43 @@ def update_auto_context(auto_context, task_type, result):
     if not new_line:
         return auto_context  # ничего не добавлять
 
-    # Обновляем список
+    # Обновляем список, сохраняя первый элемент и отбрасывая самые старые
     fixed_first = auto_context[0] if auto_context else ""
     rest = auto_context[1:] if len(auto_context) > 1 else []
-
     rest.append(new_line)
 
-    # Ограничиваем по длине
-    while len('\n'.join([fixed_first] + rest)) > 3000 and rest:
-        rest.pop(0)
+    if fixed_first:
+        return pack_context_elements([fixed_first] + rest, max_tokens, pinned=1)
+    return pack_context_elements(rest, max_tokens)
 
-    return [fixed_first] + rest if fixed_first else rest
+_IRREGULAR_PLURALS = {
+    "men": "man", "women": "woman", "children": "child", "people": "person", "mice": "mouse",
+    "feet": "foot", "teeth": "tooth", "geese": "goose", "knives": "knife", "leaves": "leaf",
+}
+
+
+def _singularize(word: str) -> str:
+    if word in _IRREGULAR_PLURALS:
+        return _IRREGULAR_PLURALS[word]
+    if not word.isascii() or len(word) <= 3:
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("ches", "shes", "sses", "xes", "zes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def normalize_image_query(query: str) -> str:
+    """
+    Приводит поисковый запрос картинок к ключу кэша: нижний регистр,
+    без пунктуации и лишних пробелов, английские существительные в единственном числе.
+    "Red Apples!" и "red apple" дают один ключ.
+    """
+    words = re.findall(r"[^\W_]+", (query or "").lower())
+    return " ".join(_singularize(w) for w in words)[:100]
 
 def build_base_query(params):
     """Construct the base query based on task type and parameters"""
@@ -1,10 +1,9 @@
 from __future__ import annotations
 
-import mimetypes
 import traceback
 from decimal import Decimal
 from typing import Optional
-from urllib.parse import urlparse
+from urllib.parse import urlparse, unquote
 
 import markdown
 
@@ -26,6 +25,7 @@ from django.core.validators import validate_email
 from django.db.models import Case, When, Value, IntegerField
 import hashlib
 import os
+import tempfile
 import random
 import re
 import secrets
@@ -35,7 +35,9 @@ import base64
 from django.views.decorators.csrf import csrf_exempt
 from django_ratelimit.decorators import ratelimit
 
-from .tasks import process_pdf_section_task, generate_audio_task, generate_task_celery, generate_lesson_task
+from .tasks import process_pdf_section_task, generate_audio_task, generate_task_celery, generate_lesson_task, \
+    generate_block_celery, BLOCK_PROMPT_TASK_TYPES, BLOCK_PROMPT_MAX_TASKS, save_pdf_upload, get_cached_tts, \
+    reconcile_pending_payments_task, reconcile_payment_task
 import jwt
 from PIL import Image
 from datetime import timezone, date, datetime, timedelta
@@ -46,10 +48,11 @@ from django.forms.models import model_to_dict
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
-from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import default_storage
-from django.db import transaction
-from django.db.models import Sum
+from django.db import transaction, DatabaseError
+from django.db.models import Sum, Count
 from django.db.models import Max
 from django.db.models import Q
 from django.http import Http404, HttpResponseBadRequest, HttpResponseServerError, HttpResponseNotFound, FileResponse
@@ -60,7 +63,7 @@ from django.urls import reverse
 from django.views.decorators.http import require_POST, require_GET
 from django.views.decorators.http import require_http_methods
 from lzstring import LZString
-from .ai_calls import generate_handler, search_images_api, has_min_tokens, add_successful_generation
+from .ai_calls import generate_handler, search_images_api, search_images_many, has_min_tokens, add_successful_generation
 from django.db.models import Case, When, IntegerField
 from .forms import ClassroomForm
 from django.utils import timezone
@@ -69,7 +72,7 @@ from .models import Course, Section, Lesson, BaseTask, WordList, Image, MatchUpT
     MakeASentence, Unscramble, FillInTheBlanks, Dialogue, Article, Audio, Test, TrueOrFalse, LabelImages, EmbeddedTask, \
     Classroom, UserAnswer, UserAutogenerationPreferences, Homework, LessonPublicData, MediaFile, \
     UserContextLength, Pdf, CoursePdf, SiteErrorLog, Generation, LessonGenerationStatus, PublicLessonsEmails
-from users.models import TariffStatus, UserTokenBalance, UserMetrics, TelegramAuthToken
+from users.models import TariffStatus, UserTokenBalance, UserMetrics, TelegramAuthToken, user_access_cache_key
 
 from .templatetags.custom_tags import get_user_tariff_discounts, recount_tariff_prices, recount_token_prices
 from .utils import markdown_to_html, update_auto_context, enhance_query_with_params, build_base_query
@@ -141,6 +144,84 @@ def landing(request):
 
     return render(request, 'home/landing.html')
 
+# Блоки главной страницы (курсы, классы, уведомления) хранятся в Redis как простые словари;
+# ключ сбрасывается при изменении курсов/классов пользователя, остальное добирает TTL.
+HOME_FRAGMENTS_CACHE_TTL = 2 * 60
+
+
+def home_fragments_cache_key(user_id, role):
+    # Уведомления зависят от роли — после смены роли кэш прежней роли не используется
+    return f"home_fragments:{user_id}:{role}"
+
+
+def invalidate_home_fragments(*user_ids):
+    if user_ids:
+        cache.delete_many([home_fragments_cache_key(uid, role) for uid in user_ids for role in Role.values])
+
+
+def invalidate_classroom_home_fragments(classroom):
+    """Сбрасывает главную страницу всем участникам класса."""
+    members = _get_classroom_members(classroom)
+    invalidate_home_fragments(*members['teachers'], *members['students'])
+
+
+def build_home_fragments(user, role):
+    """
+    Собирает курсы (с числом уроков), классы (с ролью пользователя, числом учеников
+    и названием урока) и видимые уведомления — по одному запросу на блок.
+    """
+    key = home_fragments_cache_key(user.id, role)
+    fragments = cache.get(key)
+    if fragments is not None:
+        return fragments
+
+    courses = list(
+        Course.objects.filter(user=user)
+        .annotate(lesson_count=Count('lessons'))
+        .values('id', 'name', 'lesson_count')
+    )
+
+    # Фильтр по id подзапросом, чтобы Count('students') не склеивался с join'ом фильтра
+    teacher_ids = set(Classroom.objects.filter(teachers=user).values_list('id', flat=True))
+    classrooms = list(
+        Classroom.objects.filter(id__in=Classroom.objects.for_user(user).values('id'))
+        .annotate(student_count=Count('students'))
+        .values('id', 'name', 'lesson__name', 'student_count')
+    )
+    for classroom in classrooms:
+        classroom['lesson_name'] = classroom.pop('lesson__name')
+        classroom['is_teacher'] = classroom['id'] in teacher_ids
+
+    hidden_ids = UserNotification.objects.filter(
+        user=user,
+        is_hidden=True
+    ).values_list('notification_id', flat=True)
+    notifications = list(
+        Notification.objects.filter(is_active=True, target_roles__contains=[role])
+        .exclude(id__in=hidden_ids)
+        .values('id', 'title', 'message', 'link')
+    )
+
+    fragments = {'courses': courses, 'classrooms': classrooms, 'notifications': notifications}
+    cache.set(key, fragments, HOME_FRAGMENTS_CACHE_TTL)
+    return fragments
+
+
+def schedule_pending_payments_check(user):
+    """
+    Ставит в очередь сверку pending-платежей пользователя с YooKassa, не чаще раза
+    в PENDING_PAYMENTS_CHECK_INTERVAL. Сама сверка идёт в Celery, страница её не ждёт.
+    """
+    if not cache.add(f"pending_payments_check:{user.id}", 1, PENDING_PAYMENTS_CHECK_INTERVAL):
+        return
+    if PaymentRecord.objects.filter(
+        user=user,
+        status=PaymentRecord.Status.PENDING,
+        created_at__gte=timezone.now() - timedelta(hours=24)
+    ).exists():
+        reconcile_pending_payments_task.delay(user.id)
+
+
 @login_required
 def home_view(request):
     # 🚦 Проверка онбординга
@@ -181,19 +262,11 @@ def home_view(request):
         except Exception as e:
             logger.error(f"Token error: {str(e)}")
 
-        # Курсы пользователя
-        try:
-            context['courses'] = Course.objects.filter(user=request.user)
-        except Exception as e:
-            logger.error(f"Courses error: {str(e)}")
-
-        # Классы пользователя
+        # Курсы, классы и уведомления пользователя
         try:
-            context['classrooms'] = Classroom.objects.filter(
-                Q(teachers=request.user) | Q(students=request.user)
-            ).distinct()
+            context.update(build_home_fragments(request.user, context['role']))
         except Exception as e:
-            logger.error(f"Classrooms error: {str(e)}")
+            logger.error(f"Home fragments error: {str(e)}")
 
         # Домашние задания студента
         try:
@@ -235,7 +308,7 @@ def home_view(request):
         # Данные тарифа
         try:
             if context['role'] == 'teacher':
-                check_user_pending_payments(request.user)
+                schedule_pending_payments_check(request.user)
                 tariff = getattr(request.user, 'tariff', None)
                 if tariff:
                     context['is_tariff_active'] = tariff.is_active
@@ -261,20 +334,6 @@ def home_view(request):
         except Exception as e:
             logger.error(f"Tariff error: {str(e)}")
 
-        # Уведомления
-        try:
-            notifications = Notification.objects.filter(
-                is_active=True,
-                target_roles__contains=[context['role']]
-            )
-            hidden_ids = UserNotification.objects.filter(
-                user=request.user,
-                is_hidden=True
-            ).values_list('notification_id', flat=True)
-            context['notifications'] = notifications.exclude(id__in=hidden_ids)
-        except Exception as e:
-            logger.error(f"Notifications error: {str(e)}")
-
         # Длина контекста
         try:
             context['context_length'] = request.user.context_length.context_length
@@ -282,9 +341,15 @@ def home_view(request):
             logger.error(f"Context length error: {str(e)}")
 
         try:
-            metrics, _ = UserMetrics.objects.get_or_create(user=request.user)
-            metrics.update_activity()
+            # Только чтение: активность копится в Redis и переносится в БД кроном
+            now = timezone.now()
+            metrics = UserMetrics.objects.filter(user=request.user).only(
+                'first_activity_at', 'last_activity_at'
+            ).first() or UserMetrics(user=request.user)
+            metrics.first_activity_at = metrics.first_activity_at or now
+            metrics.last_activity_at = now
             context['retention'] = metrics.retention_status()
+            UserMetrics.record_activity(request.user.id)
         except Exception as e:
             logger.error(f"User metrics error: {str(e)}")
             context['retention'] = {"D1": False, "D3": False, "D7": False}
@@ -398,6 +463,7 @@ def create_course(request):
                 )
                 print(f"✅ Section created: {section} (id={section.id})")
 
+            invalidate_home_fragments(request.user.id)
             print("🔀 Redirecting to lesson_list...")
             return redirect('lesson_list', course_id=new_course.id)
 
@@ -464,7 +530,7 @@ def delete_course(request, course_id):
     course_to_delete = get_object_or_404(Course, id=course_id)
 
     if request.method == "POST" and course_to_delete.user == request.user:
-        with transaction.atomic():
+        with transaction.atomic(), request.user.storage_batch():
             # Удаляем все задания через delete_task_handler
             for lesson in course_to_delete.lessons.all():
                 for section in lesson.sections.all():
@@ -476,6 +542,7 @@ def delete_course(request, course_id):
 
             # Удаляем сам курс
             course_to_delete.delete()
+        invalidate_home_fragments(request.user.id)
 
     return redirect('home')
 
@@ -528,29 +595,90 @@ def clone_section(old_section, new_section, user):
     Клонирует все задачи и медиа из old_section в new_section.
     user — текущий пользователь, чтобы обновлять использованное хранилище.
     """
-    # Получаем все задачи старой секции
-    old_tasks = BaseTask.objects.filter(section=old_section).prefetch_related('media', 'content_type')
+    clone_sections_bulk([(old_section, new_section)], user)
 
-    for t in old_tasks:
-        original_content = t.content_object
-        if not original_content:
-            continue
-
-        # Клонируем объект контента
-        cloned_content = clone_content_object(original_content)
-        content_type = ContentType.objects.get_for_model(cloned_content)
+def clone_sections_bulk(section_pairs, user, share_content=False):
+    """
+    Клонирует задания нескольких разделов за фиксированное число запросов:
+    контент читается и копируется через bulk_create по одному запросу на тип,
+    BaseTask и связи с медиафайлами создаются одной вставкой, квота обновляется один раз.
+    share_content=True — копирование при записи: новые BaseTask ссылаются на тот же
+    контент с размером 0, собственная копия появляется при редактировании (fork_task_content).
+    section_pairs — [(old_section, new_section)]. Возвращает число скопированных заданий.
+    """
+    new_section_by_old = {old.id: new for old, new in section_pairs}
+    old_tasks = list(BaseTask.objects.filter(section_id__in=new_section_by_old.keys()).order_by('order'))
+    if not old_tasks:
+        return 0
 
-        # Создаем новую задачу
-        new_task = BaseTask.objects.create(
-            section=new_section,
+    # 1) Контент: один запрос на чтение и один bulk_create на каждый тип задания
+    ids_by_type = {}
+    for t in old_tasks:
+        ids_by_type.setdefault(t.content_type_id, []).append(t.object_id)
+
+    cloned_ids = {}  # (content_type_id, старый id) → id копии
+    if share_content:
+        cloned_ids = {(t.content_type_id, t.object_id): t.object_id for t in old_tasks}
+        ids_by_type = {}
+
+    for content_type_id, object_ids in ids_by_type.items():
+        model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+        originals = list(model_class.objects.filter(pk__in=object_ids))
+        for obj in originals:
+            old_pk = obj.pk
+            obj.pk = uuid.uuid4()
+            obj._state.adding = True
+            cloned_ids[(content_type_id, old_pk)] = obj.pk
+        model_class.objects.bulk_create(originals)
+
+    # 2) BaseTask копий
+    new_task_by_old = {}
+    for t in old_tasks:
+        cloned_id = cloned_ids.get((t.content_type_id, t.object_id))
+        if not cloned_id:
+            continue  # контент задания потерян — пропускаем, как и раньше
+        new_task_by_old[t.id] = BaseTask(
+            section=new_section_by_old[t.section_id],
             order=t.order,
-            content_type=content_type,
-            object_id=cloned_content.id,
-            size=t.size
+            content_type_id=t.content_type_id,
+            object_id=cloned_id,
+            size=0 if share_content else t.size
         )
+    BaseTask.objects.bulk_create(new_task_by_old.values())
+
+    # 3) Связи с медиафайлами копируются одной вставкой
+    Through = BaseTask.media.through
+    links = Through.objects.filter(basetask_id__in=new_task_by_old.keys()).values_list('basetask_id', 'mediafile_id')
+    Through.objects.bulk_create([
+        Through(basetask_id=new_task_by_old[basetask_id].id, mediafile_id=mediafile_id)
+        for basetask_id, mediafile_id in links
+    ], ignore_conflicts=True)
+
+    # 4) Обновляем использованное место у пользователя одним запросом
+    user.update_used_storage(sum(t.size for t in new_task_by_old.values()))
+    return len(new_task_by_old)
+
+def is_task_content_shared(task_obj) -> bool:
+    """Используется ли контент задания другими BaseTask (копии урока без копирования контента)."""
+    return BaseTask.objects.filter(
+        content_type_id=task_obj.content_type_id,
+        object_id=task_obj.object_id
+    ).exclude(id=task_obj.id).exclude(section__isnull=True).exists()
+
+def fork_task_content(task_obj):
+    """
+    Копирование при записи: если контент задания общий, задание получает собственную
+    копию контента (клон и перепривязка BaseTask). Возвращает контент для изменения.
+    Размер задания и квота пересчитываются вызывающим кодом при сохранении.
+    """
+    content = task_obj.content_object
+    if content is None or not is_task_content_shared(task_obj):
+        return content
 
-        # Обновляем использованное место у пользователя
-        user.update_used_storage(t.size)
+    content = clone_content_object(content)
+    task_obj.object_id = content.pk
+    task_obj.save(update_fields=['object_id'])
+    return content
 
 def add_lesson(request, course_id):
     try:
@@ -626,6 +754,7 @@ def add_lesson(request, course_id):
                             )
                             clone_section(rev, new_sec, request.user)
 
+                invalidate_home_fragments(request.user.id)
                 return redirect('lesson_list', course_id=course_id)
 
             except ValidationError as ve:
@@ -820,16 +949,18 @@ def delete_lesson(request, lesson_id):
     if request.user != lesson_to_delete.course.user:
         return HttpResponseForbidden("You do not have access to this lesson.")
 
-    for section in lesson_to_delete.sections.all():
-        tasks = BaseTask.objects.filter(section=section)
-        for task in tasks:
-            delete_task_handler(request.user, task)
-        section.delete()
+    with request.user.storage_batch():
+        for section in lesson_to_delete.sections.all():
+            tasks = BaseTask.objects.filter(section=section)
+            for task in tasks:
+                delete_task_handler(request.user, task)
+            section.delete()
 
     course_id = lesson_to_delete.course.id
 
     if request.method == "POST":
         lesson_to_delete.delete()
+        invalidate_home_fragments(request.user.id)
 
     return HttpResponseRedirect(reverse('lesson_list', args=[course_id]))
 
@@ -934,7 +1065,7 @@ def delete_section_view(request, section_id):
         return JsonResponse({'error': 'Нельзя удалить последний раздел.'}, status=400)
 
     if request.method == "POST":
-        with transaction.atomic():
+        with transaction.atomic(), request.user.storage_batch():
             tasks = BaseTask.objects.filter(section=section_obj)
             for task in tasks:
                 delete_task_handler(request.user, task)
@@ -1425,45 +1556,77 @@ def normalize_payloads(payloads):
         return payloads
     return model_to_dict(payloads)
 
-def extract_media_ids(task_type, payloads):
-    media_ids = []
+def media_storage_key(url) -> str | None:
+    """Переводит URL медиафайла (абсолютный или относительный) в ключ хранилища MediaFile.storage_key."""
+    if not url or not isinstance(url, str):
+        return None
+    path = unquote(urlparse(url.strip()).path)
+    media_prefix = urlparse(settings.MEDIA_URL).path
+    if path.startswith(media_prefix):
+        return path[len(media_prefix):] or None
+    return None
 
-    def find_media_by_url(url):
-        if url and "/media/" in url:
-            relative_path = url.split("/media/")[-1]
-            try:
-                media = MediaFile.objects.get(file=relative_path)
-                return str(media.id)
-            except MediaFile.DoesNotExist:
-                print(f"[WARN] MediaFile не найден по пути: {relative_path}")
+def _prefer_own_media(rows, user) -> dict:
+    """storage_key -> MediaFile; из записей разных владельцев одного файла выбирается запись user."""
+    found = {}
+    user_id = getattr(user, 'id', None)
+    for media in rows:
+        current = found.get(media.storage_key)
+        if current is None or (media.user_id == user_id and current.user_id != user_id):
+            found[media.storage_key] = media
+    return found
+
+def resolve_media_url(url, memo: dict = None, user=None) -> MediaFile | None:
+    """
+    Находит MediaFile по URL одним индексированным запросом.
+    Один файл хранилища может принадлежать нескольким пользователям — тогда
+    предпочитается запись user.
+    memo — словарь на время запроса: повторные URL не ходят в БД.
+    """
+    key = media_storage_key(url)
+    if not key:
         return None
+    if memo is not None and key in memo:
+        return memo[key]
 
+    media = _prefer_own_media(MediaFile.objects.filter(storage_key=key), user).get(key)
+    if memo is not None:
+        memo[key] = media
+    return media
+
+def collect_media_urls(task_type, payloads) -> list:
+    """Возвращает URL медиафайлов, на которые ссылается задание."""
     payloads = normalize_payloads(payloads)
 
     if task_type == 'Image':
-        url = payloads.get('image_url')
-        media_id = find_media_by_url(url)
-        if media_id:
-            media_ids.append(media_id)
-
-    elif task_type == 'Audio':
-        url = payloads.get('audio_url')
-        media_id = find_media_by_url(url)
-        if media_id:
-            media_ids.append(media_id)
-
-    elif task_type == 'LabelImages':
-        for item in payloads.get('images', []):
-            url = item.get('media_url') or item.get('url')
-            media_id = find_media_by_url(url)
-            if media_id:
-                media_ids.append(media_id)
+        return [payloads.get('image_url')]
+    if task_type == 'Audio':
+        return [payloads.get('audio_url')]
+    if task_type == 'Pdf':
+        return [payloads.get('pdf_url')]
+    if task_type == 'LabelImages':
+        return [item.get('media_url') or item.get('url') for item in payloads.get('images', [])]
+    return []
+
+def prefetch_media_urls(urls, memo: dict, user=None):
+    """Заполняет memo для resolve_media_url одним запросом на все URL."""
+    keys = {media_storage_key(url) for url in urls} - {None} - memo.keys()
+    if not keys:
+        return
+    found = _prefer_own_media(MediaFile.objects.filter(storage_key__in=keys), user)
+    for key in keys:
+        memo[key] = found.get(key)
+
+def extract_media_ids(task_type, payloads, memo: dict = None, user=None):
+    media_ids = []
+    memo = {} if memo is None else memo
 
-    elif task_type == 'Pdf':
-        url = payloads.get('pdf_url')
-        media_id = find_media_by_url(url)
-        if media_id:
-            media_ids.append(media_id)
+    for url in collect_media_urls(task_type, payloads):
+        media = resolve_media_url(url, memo, user)
+        if media:
+            media_ids.append(str(media.id))
+        elif url:
+            print(f"[WARN] MediaFile не найден по URL: {url}")
 
     print(f"[DEBUG] Найденные media_ids: {media_ids}")
     return media_ids
@@ -1503,29 +1666,24 @@ def taskSave(request, section_id):
         if title:
             payloads["title"] = title[:200].strip()
 
-        def looks_like_base64(s: str) -> bool:
-            if not isinstance(s, str):
-                return False
-            if 'base64,' in s or s.startswith('data:'):
-                return True
-            s_clean = ''.join(s.split())
-            return bool(re.fullmatch(r'[A-Za-z0-9+/=\s]+', s)) and len(s_clean) > 32
-
         embed_map = {'Image': 'image_url', 'Audio': 'audio_url', 'Pdf': 'pdf_url'}
         model_class = globals().get(task_type)
         if not model_class:
             return JsonResponse({'success': False, 'error': 'Неверный тип задания'}, status=400)
 
         media_to_attach = []
+        media_memo = {}  # URL → MediaFile в пределах запроса
+        replaced_url = None  # прежний файл задания, заменённый новым
 
         if task_type in embed_map:
             target_field = embed_map[task_type]
 
-            found_b64, found_key = None, None
-            for key, val in payloads.items():
-                if isinstance(val, str) and looks_like_base64(val):
-                    found_b64, found_key = val, key
-                    break
+            # Файлы загружаются отдельно (upload_media); здесь принимаются только media_id или URL
+            media_id = payloads.pop('media_id', None)
+            provided_url = payloads.get(target_field)
+            if isinstance(provided_url, str) and provided_url.strip().startswith(('data:', 'blob:')):
+                return JsonResponse({'success': False,
+                                     'error': 'Файл нужно сначала загрузить через /upload-media/'}, status=400)
 
             old_url, task_obj = None, None
             if obj_id:
@@ -1533,43 +1691,36 @@ def taskSave(request, section_id):
                 content = task_obj.content_object
                 old_url = getattr(content, target_field, None)
 
-            if found_b64:
-                if old_url:
-                    removeFile(old_url, request.user)
-                res = hashMediaFile(found_b64, request.user)
-                if not res or not res.get('url'):
-                    return JsonResponse({'success': False, 'error': 'Не удалось обработать base64'}, status=400)
-                payloads[target_field] = res['url']
-                if res.get('media_id'):
-                    media_to_attach.append(str(res['media_id']))
-                if found_key != target_field:
-                    payloads.pop(found_key, None)
+            found_media = None
+            if media_id:
+                try:
+                    found_media = MediaFile.objects.filter(id=media_id, user=request.user).first()
+                except ValidationError:
+                    found_media = None
+                if not found_media or not found_media.file:
+                    return JsonResponse({'success': False, 'error': 'Файл не найден'}, status=400)
+                provided_url = found_media.file.url
+            elif provided_url:
+                # URL может вести на файл другого пользователя (копия урока) — ищем по ключу хранилища, своя запись в приоритете
+                found_media = resolve_media_url(provided_url, media_memo, request.user)
+                if not found_media:
+                    return JsonResponse({'success': False,
+                                         'error': f'URL для {target_field} не найден в хранилище'}, status=400)
+
+            if found_media:
+                if old_url and old_url != provided_url:
+                    replaced_url = old_url
+                media_to_attach.append(str(found_media.id))
+                payloads[target_field] = provided_url
             else:
-                provided_url = payloads.get(target_field)
-                if provided_url:
-                    found_media = MediaFile.objects.filter(user=request.user, file=provided_url).first()
-                    if not found_media:
-                        filename = urlparse(provided_url).path.split('/')[-1] if urlparse(provided_url).path else ''
-                        candidates = MediaFile.objects.filter(user=request.user, file__endswith=filename)
-                        for m in candidates:
-                            if getattr(m.file, 'url', None) == provided_url or \
-                               (m.file and m.file.name.endswith(filename)):
-                                found_media = m
-                                break
-                    if not found_media:
-                        return JsonResponse({'success': False,
-                                             'error': f'URL для {target_field} не найден в хранилище'}, status=400)
-                    media_to_attach.append(str(found_media.id))
-                    payloads[target_field] = provided_url
-                else:
-                    if not obj_id:
-                        return JsonResponse({'success': False, 'error': f'{target_field} обязателен'}, status=400)
-                    if obj_id and not old_url:
-                        return JsonResponse({'success': False, 'error': f'Нет старого файла для {target_field}'}, status=400)
-                    payloads[target_field] = old_url
-                    if task_obj:
-                        old_media_qs = task_obj.media.all()
-                        media_to_attach.extend([str(m.id) for m in old_media_qs])
+                if not obj_id:
+                    return JsonResponse({'success': False, 'error': f'{target_field} обязателен'}, status=400)
+                if obj_id and not old_url:
+                    return JsonResponse({'success': False, 'error': f'Нет старого файла для {target_field}'}, status=400)
+                payloads[target_field] = old_url
+                if task_obj:
+                    old_media_qs = task_obj.media.all()
+                    media_to_attach.extend([str(m.id) for m in old_media_qs])
 
         # --- storage calc ---
         json_size = len(json.dumps(payloads, ensure_ascii=False).encode('utf-8'))
@@ -1583,19 +1734,25 @@ def taskSave(request, section_id):
             if request.user.used_storage - task_obj.size + json_size > storage_limit:
                 return JsonResponse({'success': False, 'error': 'Превышен лимит'}, status=403)
 
+            # Общий контент (урок, выбранный из публичных) не меняем — задание получает свою копию
+            content = fork_task_content(task_obj)
+            # Прежний файл удаляется после копирования: на него по-прежнему ссылаются задания с общим контентом
+            if replaced_url:
+                removeFile(replaced_url, request.user, memo=media_memo)
             for k, v in payloads.items():
                 setattr(content, k, v)
             content.save()
 
+            old_size = task_obj.size
             task_obj.size = json_size
-            task_obj.save()
+            task_obj.save(update_fields=['size'])
 
             if media_to_attach:
                 task_obj.media.set(MediaFile.objects.filter(id__in=media_to_attach))
             else:
                 task_obj.media.clear()
 
-            request.user.update_used_storage(-task_obj.size + json_size)
+            request.user.update_used_storage(json_size - old_size)
 
         # --- CREATE ---
         else:
@@ -1625,14 +1782,7 @@ def taskSave(request, section_id):
             if task_type == "Pdf":
                 try:
                     pdf_url = payloads.get("pdf_url")
-                    media_obj = None
-                    if pdf_url:
-                        filename = os.path.basename(pdf_url)
-                        candidates = MediaFile.objects.filter(user=request.user, file__endswith=filename)
-                        for m in candidates:
-                            if m.file and m.file.name.endswith(filename):
-                                media_obj = m
-                                break
+                    media_obj = found_media
 
                     print(f"[taskSave] Найденный media_obj для PDF: {media_obj}")
 
@@ -1895,6 +2045,24 @@ def delete_course_pdf(request, course_id, pdf_id):
 """
 
 # Новая логика обработки заданий
+MEDIA_STREAM_CHUNK_SIZE = 64 * 1024  # байт на кусок при потоковой обработке файлов
+
+def iter_base64_chunks(b64_data: str, chunk_chars: int = MEDIA_STREAM_CHUNK_SIZE * 4 // 3):
+    """
+    Декодирует base64 по кускам, не собирая весь blob в памяти.
+    Пробелы и переносы пропускаются, недостающий padding дописывается в конце.
+    При некорректных данных бросает ValueError (binascii.Error).
+    """
+    rest = ''
+    for start in range(0, len(b64_data), chunk_chars):
+        piece = rest + ''.join(b64_data[start:start + chunk_chars].split())
+        usable = len(piece) - len(piece) % 4
+        rest = piece[usable:]
+        if usable:
+            yield base64.b64decode(piece[:usable], validate=True)
+    if rest:
+        yield base64.b64decode(rest + '=' * (-len(rest) % 4), validate=True)
+
 def hashMediaFile(b64: str, user) -> dict | None:
     """
     Ищет MediaFile по SHA-256 хэшу данных из base64/data URI.
@@ -1906,77 +2074,97 @@ def hashMediaFile(b64: str, user) -> dict | None:
     if not b64:
         return None
 
-    # Парсим data URI (если есть) и получаем mime и base64-часть
-    m = re.match(r'\s*data:(?P<mime>[-\w.+/]+)?(?:;charset=[^;]+)?;base64,(?P<data>.+)',
-                 b64, flags=re.I | re.S)
-    if m:
+    # Парсим заголовок data URI (если есть), не копируя сами данные регуляркой
+    mime = None
+    b64_data = b64
+    head_end = b64.find('base64,', 0, 200)
+    if head_end != -1:
+        m = re.match(r'\s*data:(?P<mime>[-\w.+/]+)?(?:;charset=[^;]+)?;$', b64[:head_end], flags=re.I)
+        if not m:
+            return None
         mime = m.group('mime') or None
-        b64_data = m.group('data')
-    else:
-        mime = None
-        b64_data = ''.join(b64.split())  # убираем переносы и пробелы
+        b64_data = b64[head_end + len('base64,'):]
 
-    # decode base64 (мягко, добавляя padding если нужно)
+    # декодируем и хэшируем за один проход
     try:
-        blob = base64.b64decode(b64_data, validate=True)
-    except Exception:
-        try:
-            padding = '=' * (-len(b64_data) % 4)
-            blob = base64.b64decode(b64_data + padding)
-        except Exception:
-            return None
+        return store_media_stream(iter_base64_chunks(b64_data), user, mime=mime)
+    except ValueError:
+        return None
 
-    # вычисляем sha256
-    sha256 = hashlib.sha256(blob).hexdigest()
+def store_media_stream(chunks, user, mime: str = None, ext: str = None) -> dict | None:
+    """
+    Сохраняет поток байтов как MediaFile за один проход: куски пишутся во временный
+    файл, попутно считаются SHA-256 и размер. Если файл с таким хэшем уже есть,
+    в хранилище ничего не пишется.
+    Возвращает то же, что store_media_blob. Ошибки чтения chunks пробрасываются.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    with tempfile.TemporaryFile() as tmp:
+        for chunk in chunks:
+            hasher.update(chunk)
+            size += len(chunk)
+            tmp.write(chunk)
+
+        tmp.seek(0)
+        return _store_hashed_media(File(tmp), hasher.hexdigest(), size, user, mime=mime, ext=ext)
+
+def store_media_blob(blob: bytes, user, mime: str = None, ext: str = None) -> dict | None:
+    """
+    Сохраняет байты как MediaFile с дедупликацией по SHA-256 (логика hashMediaFile).
+    Возвращает {'url': ..., 'size': ..., 'media_id': ...}; size=0, если файл уже был.
+    Расширение берётся из ext (файлы, созданные сервером) или из MEDIA_UPLOAD_EXTENSIONS по mime.
+    В случае ошибки возвращает None.
+    """
+    return _store_hashed_media(ContentFile(blob), hashlib.sha256(blob).hexdigest(), len(blob), user, mime=mime, ext=ext)
 
-    # если есть запись с таким hash — вернуть её url и size=0
+def _store_hashed_media(content, sha256: str, real_size: int, user, mime: str = None, ext: str = None) -> dict | None:
+    """
+    Общая часть store_media_*: у каждого пользователя своя запись MediaFile на файл.
+    Если у пользователя файл уже есть — возвращает её (size=0). Если такой файл есть
+    у другого пользователя — создаёт запись на тот же объект хранилища (место
+    учитывается пользователю, повторно файл не пишется). Иначе записывает файл.
+    """
     try:
-        existing = MediaFile.objects.filter(hash=sha256).first()
+        own = MediaFile.objects.filter(hash=sha256, user=user).first()
+        shared = None if own else MediaFile.objects.filter(hash=sha256).exclude(file='').first()
     except Exception:
         return None
 
-    if existing:
+    if own:
         try:
-            url = existing.file.url if existing.file else None
+            url = own.file.url if own.file else None
         except Exception:
             url = None
-        return {'url': url, 'size': 0, 'media_id': str(existing.id)}
-
-    # иначе — создаём новую запись (с обработкой гонки)
-    # формируем имя файла, пытаемся угадать расширение по mime
-    filename = uuid.uuid4().hex
-    ext = None
-    if mime:
-        try:
-            ext = mimetypes.guess_extension(mime)
-        except Exception:
-            ext = None
-    filename = filename + (ext or '.bin')
-
-    content = ContentFile(blob, name=filename)
-    real_size = len(blob)
+        return {'url': url, 'size': 0, 'media_id': str(own.id)}
 
+    if shared:
+        media = MediaFile(file=shared.file.name, size=real_size, hash=sha256, user=user)
+    else:
+        # Расширение — только из белого списка по mime: от него зависит Content-Type при раздаче файла
+        filename = uuid.uuid4().hex
+        content.name = filename + (ext or MEDIA_UPLOAD_EXTENSIONS.get(mime) or '.bin')
+        media = MediaFile(
+            file=content,
+            size=real_size,
+            hash=sha256,
+            user=user,
+        )
     try:
         with transaction.atomic():
-            media = MediaFile(
-                file=content,
-                size=real_size,
-                hash=sha256,
-            )
-
-            if hasattr(MediaFile, 'user') or 'user' in [f.name for f in MediaFile._meta.get_fields()]:
-                setattr(media, 'user', user)
-
             user.update_used_storage(real_size)
             print("[USER STORAGE UPDATED]: ", real_size // 8 // 1024)
 
             # Сохраняем — в save() модели хэш не будет перезаписан, т.к. мы его выставили
             media.save()
     except IntegrityError:
-        # другая воркер-процедура создала такую запись в параллели — достаём её
-        media = MediaFile.objects.filter(hash=sha256).first()
+        # параллельный запрос этого же пользователя создал запись — убираем наш файл и достаём её
+        if not shared and media.file.name:
+            media.file.storage.delete(media.file.name)
+        media = MediaFile.objects.filter(hash=sha256, user=user).first()
         if not media:
             return None
+        real_size = 0
     except Exception:
         return None
 
@@ -1985,12 +2173,220 @@ def hashMediaFile(b64: str, user) -> dict | None:
     except Exception:
         url = None
 
-    return {'url': url, 'size': media.size, 'media_id': str(media.id)}
+    return {'url': url, 'size': real_size, 'media_id': str(media.id)}
+
+def claim_media(media: MediaFile, user) -> dict | None:
+    """
+    Возвращает запись MediaFile пользователя на тот же файл, что и media (например, готовое
+    аудио из кэша озвучки): при отсутствии создаёт её и учитывает место пользователю.
+    Ответ как у store_media_blob.
+    """
+    if not media.hash or not media.file:
+        return None
+    return _store_hashed_media(None, media.hash, media.size, user)
+
+MEDIA_UPLOAD_LIMITS = {  # допустимые MIME-типы и максимальный размер загрузки в байтах
+    'image/jpeg': 5 * 1024 ** 2,
+    'image/png': 5 * 1024 ** 2,
+    'image/gif': 5 * 1024 ** 2,
+    'image/webp': 5 * 1024 ** 2,
+    'audio/mpeg': 80 * 1024 ** 2,
+    'audio/mp3': 80 * 1024 ** 2,
+    'audio/wav': 80 * 1024 ** 2,
+    'audio/ogg': 80 * 1024 ** 2,
+    'audio/mp4': 80 * 1024 ** 2,
+    'application/pdf': 80 * 1024 ** 2,
+}
+
+MEDIA_UPLOAD_EXTENSIONS = {  # расширение файла в хранилище по MIME-типу; имя файла от клиента не используется
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'audio/mpeg': '.mp3',
+    'audio/mp3': '.mp3',
+    'audio/wav': '.wav',
+    'audio/ogg': '.ogg',
+    'audio/mp4': '.m4a',
+    'application/pdf': '.pdf',
+}
+
+@login_required
+@require_POST
+@ratelimit(key='ip', rate='30/m', block=True)
+def upload_media(request):
+    """
+    Загрузка файла для заданий Image/Audio/Pdf отдельным multipart-запросом.
+    Файл хэшируется потоково и дедуплицируется по SHA-256.
+    Возвращает {'success': True, 'media_id': ..., 'url': ...}; media_id затем передаётся в taskSave.
+    """
+    uploaded = request.FILES.get('file')
+    if not uploaded:
+        return JsonResponse({'success': False, 'error': 'Файл не передан'}, status=400)
+
+    mime = (uploaded.content_type or '').split(';')[0].strip().lower()
+    max_size = MEDIA_UPLOAD_LIMITS.get(mime)
+    if not max_size:
+        return JsonResponse({'success': False, 'error': 'Неподдерживаемый формат файла'}, status=400)
+    if uploaded.size > max_size:
+        return JsonResponse({'success': False,
+                             'error': f'Файл слишком большой. Максимум — {max_size // 1024 ** 2} MB'}, status=400)
+    if request.user.used_storage + uploaded.size > get_storage_limit(request.user):
+        return JsonResponse({'success': False, 'error': 'Превышен лимит'}, status=403)
+
+    res = store_media_stream(uploaded.chunks(), request.user, mime=mime)
+    if not res or not res.get('url'):
+        return JsonResponse({'success': False, 'error': 'Не удалось сохранить файл'}, status=500)
+
+    return JsonResponse({'success': True, 'media_id': res['media_id'], 'url': res['url']})
+
+CHUNKED_UPLOAD_TTL = 24 * 60 * 60  # сколько живёт незавершённая загрузка
+
+def _chunked_upload_key(upload_id) -> str:
+    return f"chunked_upload:{upload_id}"
+
+def _chunked_upload_path(upload_id) -> str:
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{upload_id}.part")
+
+def _get_chunked_upload(request, upload_id):
+    """Возвращает состояние загрузки текущего пользователя или None."""
+    state = cache.get(_chunked_upload_key(upload_id))
+    if not state or state['user_id'] != request.user.id:
+        return None
+    return state
+
+@login_required
+@require_POST
+@ratelimit(key='ip', rate='30/m', block=True)
+def chunked_upload_start(request):
+    """
+    Начинает докачиваемую загрузку.
+    Принимает JSON {mime, size, sha256}; возвращает {upload_id, offset, chunk_size}.
+    Дальше куски отправляются в chunked_upload_chunk, в конце — chunked_upload_finish.
+    """
+    try:
+        data = json.loads(request.body)
+        size = int(data.get('size') or 0)
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Неверный JSON'}, status=400)
+
+    mime = (data.get('mime') or '').split(';')[0].strip().lower()
+    sha256 = (data.get('sha256') or '').lower()
+    max_size = MEDIA_UPLOAD_LIMITS.get(mime)
+    if not max_size:
+        return JsonResponse({'success': False, 'error': 'Неподдерживаемый формат файла'}, status=400)
+    if size <= 0 or size > max_size:
+        return JsonResponse({'success': False,
+                             'error': f'Файл слишком большой. Максимум — {max_size // 1024 ** 2} MB'}, status=400)
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        return JsonResponse({'success': False, 'error': 'Неверный sha256'}, status=400)
+    if request.user.used_storage + size > get_storage_limit(request.user):
+        return JsonResponse({'success': False, 'error': 'Превышен лимит'}, status=403)
+
+    # Такой файл уже загружен этим пользователем — загружать нечего.
+    # Файлы других пользователей по одному хэшу не выдаются: содержимое проверяется в finish
+    existing = MediaFile.objects.filter(hash=sha256, user=request.user).exclude(file='').first()
+    if existing:
+        return JsonResponse({'success': True, 'done': True, 'media_id': str(existing.id), 'url': existing.file.url})
+
+    upload_id = uuid.uuid4().hex
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    open(_chunked_upload_path(upload_id), 'wb').close()
+    cache.set(_chunked_upload_key(upload_id), {
+        'user_id': request.user.id,
+        'size': size,
+        'mime': mime,
+        'sha256': sha256,
+    }, CHUNKED_UPLOAD_TTL)
 
-def removeFile(media_url: str, user) -> dict:
+    return JsonResponse({
+        'success': True,
+        'upload_id': upload_id,
+        'offset': 0,
+        'chunk_size': settings.CHUNKED_UPLOAD_CHUNK_SIZE
+    })
+
+@login_required
+@require_http_methods(["GET", "POST"])
+def chunked_upload_chunk(request, upload_id):
+    """
+    GET — текущий offset (для докачки после обрыва).
+    POST — тело запроса дописывается к файлу; заголовок X-Upload-Offset должен совпадать
+    с уже полученным размером, иначе 409 и актуальный offset.
+    """
+    state = _get_chunked_upload(request, upload_id)
+    path = _chunked_upload_path(upload_id)
+    if not state or not os.path.exists(path):
+        return JsonResponse({'success': False, 'error': 'Загрузка не найдена'}, status=404)
+
+    if request.method == 'GET':
+        return JsonResponse({'success': True, 'offset': os.path.getsize(path)})
+
+    # Один кусок за раз: параллельные запросы к одной загрузке не пишут в файл одновременно
+    lock_key = _chunked_upload_key(upload_id) + ':lock'
+    if not cache.add(lock_key, 1, 60):
+        return JsonResponse({'success': False, 'error': 'Кусок уже загружается'}, status=409)
+    try:
+        offset = os.path.getsize(path)
+        try:
+            client_offset = int(request.headers.get('X-Upload-Offset', -1))
+        except ValueError:
+            client_offset = -1
+        if client_offset != offset:
+            return JsonResponse({'success': False, 'error': 'Неверный offset', 'offset': offset}, status=409)
+
+        chunk = request.body
+        if not chunk or len(chunk) > settings.CHUNKED_UPLOAD_CHUNK_SIZE or offset + len(chunk) > state['size']:
+            return JsonResponse({'success': False, 'error': 'Неверный размер куска', 'offset': offset}, status=400)
+
+        with open(path, 'ab') as f:
+            f.write(chunk)
+        cache.touch(_chunked_upload_key(upload_id), CHUNKED_UPLOAD_TTL)
+        return JsonResponse({'success': True, 'offset': offset + len(chunk)})
+    finally:
+        cache.delete(lock_key)
+
+@login_required
+@require_POST
+def chunked_upload_finish(request, upload_id):
+    """
+    Завершает загрузку: сверяет размер и SHA-256 собранного файла с заявленными
+    и сохраняет его через общую дедупликацию MediaFile. Возвращает {media_id, url}.
+    """
+    state = _get_chunked_upload(request, upload_id)
+    path = _chunked_upload_path(upload_id)
+    if not state or not os.path.exists(path):
+        return JsonResponse({'success': False, 'error': 'Загрузка не найдена'}, status=404)
+
+    size = os.path.getsize(path)
+    if size != state['size']:
+        return JsonResponse({'success': False, 'error': 'Файл загружен не полностью', 'offset': size}, status=409)
+
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MEDIA_STREAM_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    sha256 = hasher.hexdigest()
+
+    try:
+        if sha256 != state['sha256']:
+            return JsonResponse({'success': False, 'error': 'Контрольная сумма не совпадает'}, status=400)
+
+        with open(path, 'rb') as f:
+            res = _store_hashed_media(File(f), sha256, size, request.user, mime=state['mime'])
+    finally:
+        cache.delete(_chunked_upload_key(upload_id))
+        os.remove(path)
+
+    if not res or not res.get('url'):
+        return JsonResponse({'success': False, 'error': 'Не удалось сохранить файл'}, status=500)
+    return JsonResponse({'success': True, 'media_id': res['media_id'], 'url': res['url']})
+
+def removeFile(media_url: str, user, memo: dict = None) -> dict:
     """
     Удаляет MediaFile и связанные CoursePdf, если файл используется только в одном задании.
     Если файл используется в нескольких заданиях — не удаляет.
+    memo — словарь resolve_media_url на время запроса.
     Возвращает подробный словарь результата.
     """
     if not media_url or not isinstance(media_url, str):
@@ -2002,24 +2398,11 @@ def removeFile(media_url: str, user) -> dict:
     except Exception:
         filename = ''
 
-    media = None
     try:
-        # Ищем медиафайл только для данного пользователя
-        media_qs = MediaFile.objects.filter(user=user)
-        media = media_qs.filter(file=media_url).first()
-
-        if not media and filename:
-            candidates = media_qs.filter(file__endswith=filename)
-            for m in candidates:
-                try:
-                    if getattr(m.file, 'url', None) == media_url:
-                        media = m
-                        break
-                    if m.file and m.file.name and m.file.name.endswith(filename):
-                        media = m
-                        break
-                except Exception:
-                    continue
+        # Удалять можно только медиафайл данного пользователя
+        media = resolve_media_url(media_url, memo, user)
+        if media and media.user_id != user.id:
+            media = None
     except Exception:
         return {'success': False, 'error': 'Ошибка при поиске MediaFile'}
 
@@ -2027,14 +2410,18 @@ def removeFile(media_url: str, user) -> dict:
         return {'success': False, 'error': 'MediaFile не найден для данного URL у этого пользователя'}
 
     # --- считаем уникальные BaseTask, где используется media ---
+    # Учитываются задания всех владельцев (копии уроков ссылаются на тот же файл), кроме
+    # заданий без раздела и заданий пользователей, у которых на этот файл своя запись MediaFile
     try:
         task_ids = set()
+        own_copy_owners = MediaFile.objects.filter(
+            storage_key=media.storage_key, user__isnull=False
+        ).exclude(id=media.id).values('user_id')
 
         # a) через M2M BaseTask.media
         m2m_tasks = BaseTask.objects.filter(
-            section__lesson__course__user=user,
             media=media
-        ).values_list("id", flat=True)
+        ).exclude(section__isnull=True).values_list("id", flat=True)
         task_ids.update(m2m_tasks)
 
         # b) inline usage (Image/Audio/Pdf)
@@ -2052,9 +2439,10 @@ def removeFile(media_url: str, user) -> dict:
 
             ids = list(model_qs.values_list('id', flat=True))
             return BaseTask.objects.filter(
-                section__lesson__course__user=user,
                 content_type=ct,
                 object_id__in=ids
+            ).exclude(section__isnull=True).exclude(
+                section__lesson__course__user_id__in=own_copy_owners
             ).values_list("id", flat=True)
 
         for model_cls, field in [(Image, "image_url"), (Audio, "audio_url"), (Pdf, "pdf_url")]:
@@ -2079,7 +2467,7 @@ def removeFile(media_url: str, user) -> dict:
         return {
             'success': True,
             'deleted': False,
-            'reason': 'Файл не используется в заданиях этого пользователя',
+            'reason': 'Файл не используется в заданиях',
             'occurrences': 0
         }
 
@@ -2099,13 +2487,19 @@ def removeFile(media_url: str, user) -> dict:
     # --- удаляем сам MediaFile ---
     try:
         with transaction.atomic():
+            successor_id = MediaFile.objects.filter(storage_key=media.storage_key) \
+                .exclude(id=media.id).values_list('id', flat=True).first()
             try:
-                if media.file:
+                # Объект хранилища удаляется, только если на него не ссылаются записи других пользователей
+                if media.file and not successor_id:
                     media.file.delete(save=False)
                     print(f"[removeFile] Файл в хранилище удалён: {media.file.name}")
             except Exception as e:
                 print(f"[removeFile] Ошибка при удалении файла из хранилища: {e}")
 
+            # Кэш TTS переходит на запись другого пользователя с тем же файлом, а не удаляется каскадом
+            if successor_id:
+                media.tts_cache.update(media_id=successor_id)
             media.delete()
             print(f"[removeFile] MediaFile удалён из БД: id={media_id}")
 
@@ -2134,49 +2528,53 @@ def delete_task_handler(user: CustomUser, task: BaseTask):
       - вычитает размер задания из хранилища пользователя (task.size);
       - удаляет content_object и BaseTask.
     """
-    # 1) Если задание содержит медиа в виде URL — удаляем через removeFile
-    media_url_fields = {
-        'Image': 'image_url',
-        'Audio': 'audio_url',
-        'Pdf': 'pdf_url',
-    }
+    # Освобождение места за файл и за задание записывается одним запросом
+    with user.storage_batch():
+        # 1) Если задание содержит медиа в виде URL — удаляем через removeFile
+        media_url_fields = {
+            'Image': 'image_url',
+            'Audio': 'audio_url',
+            'Pdf': 'pdf_url',
+        }
 
-    task_type = task.content_type.model_class().__name__
-    url_field = media_url_fields.get(task_type)
-    if url_field:
+        task_type = task.content_type.model_class().__name__
+        url_field = media_url_fields.get(task_type)
+        # Контент, на который ссылаются другие задания, и его файлы остаются на месте
+        content_shared = is_task_content_shared(task)
+        if url_field and not content_shared:
+            try:
+                content = task.content_object
+                media_url = getattr(content, url_field, None)
+                if media_url:
+                    removeFile(media_url, user)
+            except Exception:
+                # логировать при необходимости
+                pass
+
+        # 2) Очищаем связи M2M с MediaFile
+        task.media.clear()
+
+        # 3) Вычитаем размер задания из хранилища пользователя
         try:
-            content = task.content_object
-            media_url = getattr(content, url_field, None)
-            if media_url:
-                removeFile(media_url, user)
+            user.update_used_storage(-task.size)
+            print("Updated used storage by", -task.size)
         except Exception:
-            # логировать при необходимости
             pass
 
-    # 2) Очищаем связи M2M с MediaFile
-    task.media.clear()
-
-    # 3) Вычитаем размер задания из хранилища пользователя
-    try:
-        user.update_used_storage(-task.size)
-        print("Updated used storage by", -task.size)
-    except Exception:
-        pass
+        # 4) Удаляем сам content_object
+        content = task.content_object
+        if content and not content_shared:
+            content.delete()
 
-    # 4) Удаляем сам content_object
-    content = task.content_object
-    if content:
-        content.delete()
+        # 5) Удаляем из контекста lesson-а
+        lesson_context = task.section.lesson.context or {}
+        if str(task.id) in lesson_context:
+            del lesson_context[str(task.id)]
+            task.section.lesson.context = lesson_context
+            task.section.lesson.save(update_fields=["context"])
 
-    # 5) Удаляем из контекста lesson-а
-    lesson_context = task.section.lesson.context or {}
-    if str(task.id) in lesson_context:
-        del lesson_context[str(task.id)]
-        task.section.lesson.context = lesson_context
-        task.section.lesson.save(update_fields=["context"])
-
-    # 6) Удаляем BaseTask
-    task.delete()
+        # 6) Удаляем BaseTask
+        task.delete()
 
 
 @require_http_methods(["DELETE"])
@@ -2263,9 +2661,7 @@ def generate_request(request):
             raise PermissionError("Недостаточно токенов для выполнения поиска")
 
         try:
-            if hasattr(request.user, 'metrics'):
-                request.user.metrics.tasks_generated_counter += 1
-                request.user.metrics.save(update_fields=["tasks_generated_counter"])
+            UserMetrics.increment(request.user.id, "tasks_generated_counter")
         except Exception as e:
             # Логируем или просто пропускаем
             import logging
@@ -2306,18 +2702,11 @@ def handle_pdf_upload(request):
     """
     try:
 
-        # Чтение PDF данных
         pdf_file = request.FILES.get('file')
-        if pdf_file:
-            pdf_data = pdf_file.read()
-            pdf_base64 = base64.b64encode(pdf_data).decode('utf-8')
-        else:
-            base64_str = request.POST.get('base64')
-            if base64_str:
-                pdf_base64 = base64_str
-            else:
-                print("handle_pdf_upload: Нет файла и base64 данных")
-                return JsonResponse({'error': 'No file or base64 data provided'}, status=400)
+        base64_str = request.POST.get('base64')
+        if not pdf_file and not base64_str:
+            print("handle_pdf_upload: Нет файла и base64 данных")
+            return JsonResponse({'error': 'No file or base64 data provided'}, status=400)
 
         # Получение параметров
         query = request.POST.get('query', '')
@@ -2327,6 +2716,15 @@ def handle_pdf_upload(request):
         if not section_id:
             return JsonResponse({'error': 'Missing section_id'}, status=400)
 
+        # Необязательный диапазон страниц (нумерация с 1, включительно)
+        try:
+            first_page = int(request.POST.get('page_from') or 0) or None
+            last_page = int(request.POST.get('page_to') or 0) or None
+        except ValueError:
+            return JsonResponse({'error': 'Invalid page range'}, status=400)
+        if (first_page and first_page < 1) or (first_page and last_page and last_page < first_page):
+            return JsonResponse({'error': 'Invalid page range'}, status=400)
+
         # Если нужно создать новый раздел
         if is_new_section:
             print("handle_pdf_upload: Создание нового раздела")
@@ -2364,9 +2762,22 @@ def handle_pdf_upload(request):
             print("handle_pdf_upload: Доступ к разделу запрещён")
             return JsonResponse({'error': 'Access denied'}, status=403)
 
+        # Сохраняем PDF в хранилище и передаём в Celery только ссылку на файл
+        if pdf_file:
+            pdf_path = save_pdf_upload(pdf_file)
+        else:
+            if base64_str.startswith("data:application/pdf;base64,"):
+                base64_str = base64_str.split("base64,", 1)[1]
+            try:
+                pdf_path = save_pdf_upload(ContentFile(base64.b64decode(base64_str)))
+            except (ValueError, TypeError):
+                return JsonResponse({'error': 'Invalid base64 data'}, status=400)
+
         # Запуск фоновой задачи
         print(f"handle_pdf_upload: Запуск задачи Celery для section_id={section_id}")
-        task = process_pdf_section_task.delay(section_id, query, pdf_base64, request.user.id)
+        task = process_pdf_section_task.delay(
+            section_id, query, pdf_path, request.user.id, first_page=first_page, last_page=last_page
+        )
 
         # Возвращаем task_id для опроса статуса
         response_data = {
@@ -2397,6 +2808,10 @@ def get_pdf_status_view(request, task_id):
         "result": None,
     }
 
+    if result.status == "PROGRESS" and isinstance(result.info, dict):
+        # Промежуточный прогресс: {"stage": "chunks" | "tasks", "done": int, "total": int}
+        response_data["progress"] = result.info
+
     if result.ready():
         try:
             task_result = result.get()
@@ -2448,9 +2863,7 @@ def separate_into_blocks(request):
 
     if request.user and request.user.is_authenticated:
         try:
-            if hasattr(request.user, 'metrics'):
-                request.user.metrics.sections_generated_counter += 1
-                request.user.metrics.save(update_fields=["sections_generated_counter"])
+            UserMetrics.increment(request.user.id, "sections_generated_counter")
         except Exception as e:
             # Логируем или просто пропускаем
             import logging
@@ -2536,6 +2949,7 @@ def start_block_generation(request):
         auto_context = data.get("auto_context", [])
         context_flag = data.get("context_flag", False)
         emoji_flag = data.get("emoji_flag", False)
+        block_prompt = data.get("block_prompt", True)
         block = data.get("block", [])
 
         if not section_id or not isinstance(block, list):
@@ -2545,9 +2959,18 @@ def start_block_generation(request):
         lesson_id = section_obj.lesson.id
 
         task_ids = []
+        batch = []
+
+        def flush_batch():
+            # Одиночное задание нет смысла отправлять block prompt'ом
+            if len(batch) == 1:
+                task_ids.append(str(generate_task_celery.delay(request.user.id, batch[0]).id))
+            elif batch:
+                task_ids.append(str(generate_block_celery.delay(request.user.id, list(batch)).id))
+            batch.clear()
+
         for task in block:
             task_type = list(task.keys())[0]
-            print(task)
             user_query = task.get(task_type, {}).get('user_query')
 
             params = {
@@ -2559,9 +2982,19 @@ def start_block_generation(request):
                 "lesson_id": lesson_id,  # обязательно передаём lesson_id
             }
 
+            # Подряд идущие задания объединяем в block prompt, сохраняя порядок результатов
+            if block_prompt and task_type in BLOCK_PROMPT_TASK_TYPES:
+                batch.append(params)
+                if len(batch) >= BLOCK_PROMPT_MAX_TASKS:
+                    flush_batch()
+                continue
+
+            flush_batch()
             async_res = generate_task_celery.delay(request.user.id, params)
             task_ids.append(str(async_res.id))
 
+        flush_batch()
+
         generation = Generation.objects.create(
             user=request.user,
             section_id=section_id,
@@ -2589,21 +3022,31 @@ def block_generation_status(request, generation_id):
     results = []
     in_progress = False
 
-    for tid in task_ids:
-        res = AsyncResult(tid)
+    def collect(res):
+        nonlocal in_progress
         if res.successful():
             # безопасная проверка, что результат содержит data
             result_data = res.result
-            if isinstance(result_data, dict) and "data" in result_data:
+            if isinstance(result_data, dict) and "block" in result_data:
+                # block prompt: готовые данные или id отдельной задачи-фоллбэка
+                for item in result_data["block"]:
+                    if isinstance(item, dict) and "task_id" in item:
+                        collect(AsyncResult(item["task_id"]))
+                    elif isinstance(item, dict) and "data" in item:
+                        results.append(item["data"])
+            elif isinstance(result_data, dict) and "data" in result_data:
                 results.append(result_data["data"])
             else:
                 results.append(result_data)
         elif res.failed():
             # пропускаем неудачные задачи
-            continue
+            return
         else:
             in_progress = True
 
+    for tid in task_ids:
+        collect(AsyncResult(tid))
+
     if in_progress:
         if generation.status != "in_progress":
             generation.status = "in_progress"
@@ -2671,44 +3114,41 @@ def form_block(request):
         created_tasks = []
         updated_auto_context = auto_context
 
+        # --- формируем данные всех элементов, затем создаём задания одной пачкой
+        prepared = []
         for item_idx, item_data in enumerate(data_list):
             try:
-                # --- вызываем универсальную функцию
-                try:
-                    task_data = call_form_function(task_type, request.user, payload=item_data)
-                except Exception as e:
-                    logger.exception("call_form_function failed for %s item %s: %s", task_type, item_idx, e)
-                    continue
-
-                if not task_data or not isinstance(task_data, dict):
-                    logger.warning("call_form_function returned invalid for %s item %s: %r", task_type, item_idx, task_data)
-                    continue
-
-                # --- создаём задание
-                try:
-                    task_instance = create_task_instance(request.user, task_type, task_data, section_obj)
-                except Exception as e:
-                    logger.exception("create_task_instance failed for %s item %s: %s", task_type, item_idx, e)
-                    continue
+                task_data = call_form_function(task_type, request.user, payload=item_data)
+            except Exception as e:
+                logger.exception("call_form_function failed for %s item %s: %s", task_type, item_idx, e)
+                continue
 
-                task_id = getattr(task_instance, "id", None)
-                if not task_id:
-                    logger.warning("create_task_instance returned no id for %s item %s: %r", task_type, item_idx, task_instance)
-                    continue
+            if not task_data or not isinstance(task_data, dict):
+                logger.warning("call_form_function returned invalid for %s item %s: %r", task_type, item_idx, task_data)
+                continue
 
-                created_tasks.append({"task_id": task_id, "task_type": task_type})
+            prepared.append(task_data)
 
-                # --- обновляем контекст (если тип требует)
-                if task_type in {"WordList", "Note", "Article", "Audio"}:
-                    try:
-                        updated_auto_context = update_auto_context(updated_auto_context, task_type, task_data)
-                    except Exception as e:
-                        logger.exception("update_auto_context failed for %s item %s: %s", task_type, item_idx, e)
-                        # не фатально
+        try:
+            task_instances = create_task_instances_bulk(
+                request.user, section_obj, [(task_type, task_data) for task_data in prepared]
+            )
+        except Exception as e:
+            logger.exception("create_task_instances_bulk failed for %s: %s", task_type, e)
+            task_instances = []
 
-            except Exception as outer_e:
-                logger.exception("Unexpected error processing item %s for %s: %s", item_idx, task_type, outer_e)
+        for task_instance, task_data in zip(task_instances, prepared):
+            if task_instance is None:
                 continue
+            created_tasks.append({"task_id": task_instance.id, "task_type": task_type})
+
+            # --- обновляем контекст (если тип требует)
+            if task_type in {"WordList", "Note", "Article", "Audio"}:
+                try:
+                    updated_auto_context = update_auto_context(updated_auto_context, task_type, task_data)
+                except Exception as e:
+                    logger.exception("update_auto_context failed for %s: %s", task_type, e)
+                    # не фатально
 
         return JsonResponse({
             "task_ids": created_tasks,
@@ -3177,23 +3617,26 @@ def formLabelImages(user, payload):
     if len(label_candidates) > 8:
         label_candidates = random.sample(label_candidates, 8)
 
-    for lbl in label_candidates:
-        url = None
-        try:
-            search_result = search_images_api(normalize(lbl, keep_emojis=False), user=user)
-            images_list = search_result.get("images", [])
-            if images_list:
-                url = random.choice(images_list).get("url")
-        except PermissionDenied:
-            url = None
-        except Exception as e:
-            print(f"formLabelImages: error searching image for '{lbl}': {e}")
-            url = None
+    # Ищем картинки параллельно; поиск прекращается, как только найдены картинки для 6 меток
+    try:
+        found = search_images_many(
+            [normalize(lbl, keep_emojis=False) for lbl in label_candidates],
+            user=user,
+            stop_after=6
+        )
+    except PermissionDenied:
+        found = {}
+    except Exception as e:
+        print(f"formLabelImages: error searching images: {e}")
+        found = {}
+
+    for idx, lbl in enumerate(label_candidates):
+        images_list = found.get(idx)
+        url = random.choice(images_list).get("url") if images_list else None
 
         if url:
             cleaned["images"].append({"label": lbl.strip(), "url": url})
 
-        # Завершаем, если уже нашли картинки для 6 меток
         if len(cleaned["images"]) >= 6:
             break
 
@@ -3383,97 +3826,145 @@ def formMakeASentence(user, payload):
 
 
 
+TASK_MODEL_MAP = {
+    "WordList": WordList,
+    "MatchUpTheWords": MatchUpTheWords,
+    "Essay": Essay,
+    "Note": Note,
+    "SortIntoColumns": SortIntoColumns,
+    "MakeASentence": MakeASentence,
+    "Unscramble": Unscramble,
+    "FillInTheBlanks": FillInTheBlanks,
+    "Article": Article,
+    "Audio": Audio,
+    "Test": Test,
+    "TrueOrFalse": TrueOrFalse,
+    "LabelImages": LabelImages,
+}
+
 def create_task_instance(user, task_type, task_data, section_obj):
-    if user is None:
-        return None
     """
     Создаёт BaseTask с привязкой уже загруженных медиа-файлов,
     извлекаемых по URL из payloads, и считает общий размер в байтах.
     """
-    from django.core.exceptions import ObjectDoesNotExist
-
-    model_map = {
-        "WordList": WordList,
-        "MatchUpTheWords": MatchUpTheWords,
-        "Essay": Essay,
-        "Note": Note,
-        "SortIntoColumns": SortIntoColumns,
-        "MakeASentence": MakeASentence,
-        "Unscramble": Unscramble,
-        "FillInTheBlanks": FillInTheBlanks,
-        "Article": Article,
-        "Audio": Audio,
-        "Test": Test,
-        "TrueOrFalse": TrueOrFalse,
-        "LabelImages": LabelImages,
-    }
+    if user is None:
+        return None
+    return create_task_instances_bulk(user, section_obj, [(task_type, task_data)])[0]
 
-    if task_type not in model_map:
+def build_task_content(task_type, task_data):
+    """
+    Собирает (не сохраняя) модель контента задания. Строки длиннее max_length поля
+    обрезаются, чтобы одно длинное название не срывало вставку всей пачки.
+    Непригодные данные (неизвестный тип, лишние поля) — исключение.
+    """
+    model_class = TASK_MODEL_MAP.get(task_type)
+    if model_class is None:
         raise ValueError(f"Unsupported task type: {task_type}")
 
-    model_class = model_map[task_type]
-
-    try:
-        # 1. Создаём подмодель
-        task_instance = model_class.objects.create(**task_data)
-        content_type = ContentType.objects.get_for_model(model_class)
-
-        # 2. Считаем JSON-часть
-        json_body = json.dumps(task_data, ensure_ascii=False)
-        json_size = len(json_body.encode("utf-8"))
-
-        last_order = BaseTask.objects.filter(section=section_obj).aggregate(
-            max_order=Max('order')
-        )['max_order'] or 0
-
-        # 3. Создаём BaseTask (size заполним позже)
-        base_task = BaseTask.objects.create(
-            section=section_obj,
-            order=last_order + 1,
-            content_type=content_type,
-            object_id=task_instance.id,
-            size=1
-        )
-
-    except Exception as e:
-        print(f"[ERROR] Ошибка при создании задачи: {e}")
-        raise
+    instance = model_class(**task_data)
+    for field in model_class._meta.concrete_fields:
+        value = getattr(instance, field.attname)
+        if field.max_length and isinstance(value, str) and len(value) > field.max_length:
+            setattr(instance, field.attname, value[:field.max_length])
+    return instance
 
-    try:
-        # 4. Извлекаем media_ids из payloads
-        media_ids = extract_media_ids(task_type, task_data)
-    except Exception as e:
-        print(f"[ERROR] Ошибка при извлечении media_ids: {e}")
-        media_ids = []
+def create_task_instances_bulk(user, section_obj, items):
+    """
+    Создаёт несколько заданий раздела за фиксированное число запросов:
+    bulk_create на каждую модель контента и на BaseTask, один запрос Max(order),
+    один запрос медиафайлов, одна вставка M2M и одно обновление квоты.
+    items — [(task_type, task_data)]; задания получают порядковые номера подряд в том же порядке.
+    Непригодные элементы пропускаются; если пачка не вставилась, задания создаются
+    по одному, а не удавшиеся записываются в лог.
+    Возвращает список той же длины: BaseTask или None для несозданного задания.
+    """
+    if user is None or not items:
+        return []
 
-    media_size = 0
-    for mid in media_ids:
+    prepared = []  # (индекс в items, task_type, task_data, контент)
+    for idx, (task_type, task_data) in enumerate(items):
         try:
-            media = MediaFile.objects.get(id=mid)
-            media.usage += 1
-            media.save(update_fields=["usage"])
-            base_task.media.add(media)
-            media_size += media.size
-        except MediaFile.DoesNotExist:
-            print(f"[WARNING] MediaFile с id={mid} не найден")
-            continue
+            prepared.append((idx, task_type, task_data, build_task_content(task_type, task_data)))
         except Exception as e:
-            print(f"[ERROR] Ошибка при обработке media id={mid}: {e}")
-            continue
+            logger.warning("Skipping invalid %s task #%s: %s; data=%r", task_type, idx, e, task_data)
 
+    # Медиафайлы всех заданий — одним запросом
+    memo = {}
+    prefetch_media_urls(
+        [url for _, task_type, task_data, _ in prepared for url in collect_media_urls(task_type, task_data)], memo, user
+    )
+
+    results = [None] * len(items)
     try:
-        # 6. Подсчитываем общий размер и сохраняем
-        total_size = json_size + media_size
-        base_task.size = total_size
-        base_task.save(update_fields=["size"])
-
-        # 7. Обновляем квоту пользователя
-        user.update_used_storage(total_size)
-        print(f"[DEBUG] Updated user storage by: {total_size} байт")
-    except Exception as e:
-        print(f"[ERROR] Ошибка при финальном сохранении или обновлении квоты: {e}")
+        with transaction.atomic():
+            created = _insert_task_batch(user, section_obj, prepared, memo)
+    except DatabaseError as e:
+        logger.exception("Bulk task insert failed for section %s, retrying one by one: %s", section_obj.id, e)
+        created = []
+        for entry in prepared:
+            try:
+                with transaction.atomic():
+                    created += _insert_task_batch(user, section_obj, [entry], memo)
+            except DatabaseError as item_error:
+                idx, task_type, task_data, _ = entry
+                logger.error("Failed to create %s task #%s: %s; data=%r", task_type, idx, item_error, task_data)
+
+    for idx, base_task in created:
+        results[idx] = base_task
+    return results
+
+def _insert_task_batch(user, section_obj, prepared, memo):
+    """Вставка подготовленных заданий (см. create_task_instances_bulk). Возвращает [(индекс, BaseTask)]."""
+    if not prepared:
+        return []
 
-    return base_task
+    # 1. Подмодели: по одному bulk_create на модель
+    by_model = {}
+    for _, _, _, instance in prepared:
+        by_model.setdefault(type(instance), []).append(instance)
+    for model_class, model_instances in by_model.items():
+        model_class.objects.bulk_create(model_instances)
+
+    content_types = ContentType.objects.get_for_models(*by_model.keys())
+
+    last_order = BaseTask.objects.filter(section=section_obj).aggregate(
+        max_order=Max('order')
+    )['max_order'] or 0
+
+    # 2. BaseTask с готовым размером (JSON + медиа)
+    base_tasks = []
+    task_media = []
+    for offset, (_, task_type, task_data, instance) in enumerate(prepared, start=1):
+        json_size = len(json.dumps(task_data, ensure_ascii=False).encode("utf-8"))
+        media = {}
+        for url in collect_media_urls(task_type, task_data):
+            found = resolve_media_url(url, memo, user)
+            if found:
+                media[found.id] = found
+        base_tasks.append(BaseTask(
+            section=section_obj,
+            order=last_order + offset,
+            content_type=content_types[type(instance)],
+            object_id=instance.id,
+            size=json_size + sum(m.size for m in media.values()),
+        ))
+        task_media.append(media.values())
+    BaseTask.objects.bulk_create(base_tasks)
+
+    # 3. Связи с медиафайлами — одной вставкой
+    Through = BaseTask.media.through
+    Through.objects.bulk_create([
+        Through(basetask_id=base_task.id, mediafile_id=media.id)
+        for base_task, media_list in zip(base_tasks, task_media)
+        for media in media_list
+    ], ignore_conflicts=True)
+
+    # 4. Квота пользователя — одним обновлением
+    total_size = sum(base_task.size for base_task in base_tasks)
+    user.update_used_storage(total_size)
+    print(f"[DEBUG] Created {len(base_tasks)} tasks, updated user storage by: {total_size} байт")
+
+    return [(idx, base_task) for (idx, _, _, _), base_task in zip(prepared, base_tasks)]
 
 def save_autogen_preferences(request, course_id):
     if request.method == "POST":
@@ -4011,7 +4502,7 @@ def authorize_user(request_user, user_id, classroom_id, task_obj):
     classroom = None
     if classroom_id:
         classroom = get_object_or_404(Classroom, id=classroom_id)
-        if request_user != user and request_user not in classroom.teachers.all() and request_user not in classroom.students.all():
+        if request_user != user and not get_classroom_access(request_user, classroom)['role']:
             return None, None, JsonResponse({'status': 'error', 'message': 'Not authorized'}, status=403)
     else:
         # Доступ к курсу владельцу
@@ -4285,7 +4776,7 @@ def getAnswers(request):
         task_type = task_obj.content_type.model
         classroom_obj = get_object_or_404(Classroom, id=classroom_id)
 
-        if request.user != user and request.user not in classroom_obj.teachers.all() and request.user not in classroom_obj.students.all():
+        if request.user != user and not get_classroom_access(request.user, classroom_obj)['role']:
             return JsonResponse({
                 'status': 'error',
                 'message': 'User does not have access to this task'
@@ -4354,7 +4845,7 @@ def delete_answers(request):
             classroom_obj = get_object_or_404(Classroom, id=classroom_id)
             user = User.objects.get(id=user_id)
 
-            if request.user != user and request.user not in classroom_obj.teachers.all() and request.user not in classroom_obj.students.all():
+            if request.user != user and not get_classroom_access(request.user, classroom_obj)['role']:
                 return JsonResponse({
                     'status': 'error',
                     'message': 'You are not authorized to delete this answer.'
@@ -4450,6 +4941,11 @@ def edge_tts_view(request):
         if not text or not (3 <= len(text) <= 5000):
             return JsonResponse({'error': 'Text must be 3–5000 chars'}, status=400)
 
+        # Уже озвученный текст отдаём сразу, без постановки задачи
+        cached = get_cached_tts(text, voice, rate, pitch, request.user)
+        if cached:
+            return JsonResponse({'state': states.SUCCESS, 'result': cached})
+
         # Создаём celery-задачу
         task = generate_audio_task.delay(
             user_id=request.user.id,
@@ -4494,6 +4990,101 @@ def get_audio_task_generation_status(task_id):
 
 
 
+# Контекст доступа к классам: состав класса и тариф/число классов пользователя
+# кэшируются в Redis, а итог ещё и мемоизируется на объекте пользователя на время запроса.
+CLASSROOM_ACCESS_CACHE_TTL = 5 * 60
+
+
+def classroom_members_cache_key(classroom_id):
+    return f"classroom_access:members:{classroom_id}"
+
+
+def invalidate_classroom_access(classroom_id=None, user_ids=()):
+    """Сбрасывает закэшированный контекст доступа после изменения состава класса."""
+    keys = [user_access_cache_key(uid) for uid in user_ids]
+    if classroom_id:
+        keys.append(classroom_members_cache_key(classroom_id))
+    if keys:
+        cache.delete_many(keys)
+
+
+def _get_classroom_members(classroom_obj):
+    """id учителей (в порядке выдачи teachers.all()) и множество id учеников класса."""
+    key = classroom_members_cache_key(classroom_obj.id)
+    members = cache.get(key)
+    if members is None:
+        members = {
+            'teachers': list(classroom_obj.teachers.values_list('id', flat=True)),
+            'students': set(classroom_obj.students.values_list('id', flat=True)),
+        }
+        cache.set(key, members, CLASSROOM_ACCESS_CACHE_TTL)
+    return members
+
+
+def _get_user_access_facts(user_id):
+    """Тариф (type/status/end_date или None) и число классов, где пользователь — учитель."""
+    key = user_access_cache_key(user_id)
+    facts = cache.get(key)
+    if facts is None:
+        facts = {
+            'tariff': UserTariff.objects.filter(user_id=user_id)
+                                        .values('tariff_type', 'status', 'end_date').first(),
+            'class_count': Classroom.objects.filter(teachers__id=user_id).count(),
+        }
+        cache.set(key, facts, CLASSROOM_ACCESS_CACHE_TTL)
+    return facts
+
+
+def _tariff_facts_active(tariff):
+    """Аналог UserTariff.is_active() для закэшированных полей тарифа."""
+    if not tariff or tariff['status'] != TariffStatus.ACTIVE:
+        return False
+    return not (tariff['end_date'] and tariff['end_date'] < timezone.now())
+
+
+def get_classroom_access(user, classroom_obj=None):
+    """
+    Возвращает контекст доступа пользователя к классу:
+    role / is_teacher / is_student, тариф пользователя (tariff_type, tariff_active),
+    число его классов (class_count) и teacher_tariff_ok — активен ли Premium/Maximum
+    у первого учителя (None, если учителей нет).
+    """
+    memo = getattr(user, '_classroom_access_memo', None)
+    if memo is None:
+        memo = {}
+        user._classroom_access_memo = memo
+    memo_key = classroom_obj.id if classroom_obj else None
+    if memo_key in memo:
+        return memo[memo_key]
+
+    context = {
+        'role': None, 'is_teacher': False, 'is_student': False,
+        'tariff_type': None, 'tariff_active': False, 'class_count': 0,
+        'teacher_tariff_ok': None,
+    }
+    if user.is_authenticated:
+        facts = _get_user_access_facts(user.id)
+        if facts['tariff']:
+            context['tariff_type'] = facts['tariff']['tariff_type']
+            context['tariff_active'] = _tariff_facts_active(facts['tariff'])
+        context['class_count'] = facts['class_count']
+
+        if classroom_obj:
+            members = _get_classroom_members(classroom_obj)
+            context['is_teacher'] = user.id in members['teachers']
+            context['is_student'] = user.id in members['students']
+            context['role'] = 'teacher' if context['is_teacher'] else ('student' if context['is_student'] else None)
+            if members['teachers']:
+                teacher_tariff = _get_user_access_facts(members['teachers'][0])['tariff']
+                context['teacher_tariff_ok'] = (
+                    _tariff_facts_active(teacher_tariff)
+                    and teacher_tariff['tariff_type'] not in (TariffType.FREE, TariffType.BASIC)
+                )
+
+    memo[memo_key] = context
+    return context
+
+
 def check_classroom_access(request, classroom_obj):
     """
     Проверяет доступ к классу или созданию класса:
@@ -4504,45 +5095,27 @@ def check_classroom_access(request, classroom_obj):
     Возвращает None, если доступ разрешён, иначе - HttpResponse (render).
     """
 
-    user = request.user
+    access = get_classroom_access(request.user, classroom_obj)
 
     # -----------------------
     # 1) Если пользователь — студент в этом классе: проверяем тариф первого учителя
     # -----------------------
-    if classroom_obj and user in classroom_obj.students.all() and user not in classroom_obj.teachers.all():
-        # Для студентов проверяем тариф первого учителя
-        teachers = classroom_obj.teachers.all()
-        if teachers:
-            first_teacher = teachers[0]
-            try:
-                teacher_tariff = first_teacher.tariff
-                if teacher_tariff and teacher_tariff.is_active() and teacher_tariff.tariff_type not in (TariffType.FREE,
-                                                                                                        TariffType.BASIC):
-                    return None
-                else:
-                    return render(request, 'access_error/teacher_tariff_required.html')
-            except UserTariff.DoesNotExist:
-                return render(request, 'access_error/teacher_tariff_required.html')
+    if classroom_obj and access['is_student'] and not access['is_teacher']:
+        if access['teacher_tariff_ok'] is False:
+            return render(request, 'access_error/teacher_tariff_required.html')
         return None
 
     # -----------------------
-    # 2) Для учителя (или попытки создания класса) — считаем, сколько у него классов
+    # 2) Для учителя (или попытки создания класса) — сколько у него классов
     # -----------------------
-    try:
-        teacher_class_count = Classroom.objects.filter(teachers=user).count()
-    except Exception:
-        # на всякий случай — если не смогли определить модель класса
-        teacher_class_count = 0
+    teacher_class_count = access['class_count']
 
     # -----------------------
-    # 3) Проверяем наличие записи о тарифе у пользователя
+    # 3) Если тарифной записи нет:
+    #    - если у учителя 0 или 1 класса — разрешаем (поведение по требованию)
+    #    - иначе — перенаправление к тарифам
     # -----------------------
-    try:
-        tariff = user.tariff
-    except UserTariff.DoesNotExist:
-        # Если тарифной записи нет:
-        #    - если у учителя 0 или 1 класса — разрешаем (поведение по требованию)
-        #    - иначе — перенаправление к тарифам
+    if access['tariff_type'] is None:
         if teacher_class_count <= 1:
             return None
         return render(request, 'access_error/pricing_for_teacher.html')
@@ -4550,7 +5123,7 @@ def check_classroom_access(request, classroom_obj):
     # -----------------------
     # 4) Если тариф есть, но он неактивен -> запрещаем (независимо от кол-ва классов)
     # -----------------------
-    if not tariff.is_active():
+    if not access['tariff_active']:
         return render(request, 'access_error/upgrade_subscription.html')
 
     # -----------------------
@@ -4561,7 +5134,7 @@ def check_classroom_access(request, classroom_obj):
     if teacher_class_count <= 1:
         return None
 
-    if tariff.tariff_type in (TariffType.FREE, TariffType.BASIC):
+    if access['tariff_type'] in (TariffType.FREE, TariffType.BASIC):
         return render(request, 'access_error/pricing_for_teacher.html')
 
     # Всё ок
@@ -4583,13 +5156,14 @@ def choose_classroom(request, lesson_id):
         if selected_class_id:
             classroom = get_object_or_404(Classroom, id=selected_class_id)
             # проверяем, что пользователь — учитель этого класса
-            if request.user not in classroom.teachers.all():
+            if not get_classroom_access(request.user, classroom)['is_teacher']:
                 return JsonResponse(
                     {"success": False, "message": "You are not a teacher of this classroom"},
                     status=403
                 )
             classroom.lesson = lesson_instance
             classroom.save()
+            invalidate_classroom_home_fragments(classroom)
             return redirect("classroom_view", classroom_id=selected_class_id)
         return JsonResponse({"success": False})
 
@@ -4702,6 +5276,8 @@ def _create_classroom(request, lesson_obj=None):
     classroom.features = {"copying": True}  # по умолчанию
     classroom.save()
     classroom.teachers.add(request.user)
+    invalidate_classroom_access(classroom.id, [request.user.id])
+    invalidate_home_fragments(request.user.id)
 
     return classroom, None
 
@@ -4723,14 +5299,8 @@ def classroom_view(request, classroom_id):
 
         # Определение роли пользователя
         try:
-            students = classroom_obj.students.all()
-            teachers = classroom_obj.teachers.all()
-
-            if request.user in teachers:
-                user_role = "teacher"
-            elif request.user in students:
-                user_role = "student"
-            else:
+            user_role = get_classroom_access(request.user, classroom_obj)['role']
+            if not user_role:
                 return HttpResponseNotFound("Страница не найдена")
         except Exception as e:
             logger.error(f"Ошибка определения роли: {str(e)}")
@@ -4805,8 +5375,8 @@ def classroom_view(request, classroom_id):
                 'lesson': lesson_obj,
                 'section_list': sections,
                 'section_tasks': section_tasks,
-                'students': students,
-                'teachers': teachers,
+                'students': classroom_obj.students.all(),
+                'teachers': classroom_obj.teachers.all(),
                 'user_role': user_role,
                 'tasks': tasks,
                 'mode': 'classroom',
@@ -4832,7 +5402,7 @@ def select_lesson_for_course(request, course_id):
         return HttpResponseForbidden("Курс не привязан к классу.")
 
     # Проверяем, что пользователь — учитель этого класса
-    if request.user not in classroom.teachers.all():
+    if not get_classroom_access(request.user, classroom)['is_teacher']:
         return HttpResponseForbidden("Доступ только для учителей класса.")
 
     # При необходимости можно передать список существующих уроков/шаблонов
@@ -4847,13 +5417,18 @@ def delete_classroom(request, classroom_id):
     classroom = get_object_or_404(Classroom, id=classroom_id)
 
     # Проверяем, что пользователь - учитель в этом классе
-    if request.user not in classroom.teachers.all():
+    if not get_classroom_access(request.user, classroom)['is_teacher']:
         return JsonResponse({'error': 'Недостаточно прав'}, status=403)
 
     try:
+        teacher_ids = list(classroom.teachers.values_list('id', flat=True))
+        student_ids = list(classroom.students.values_list('id', flat=True))
         with transaction.atomic():
+            classroom_pk = classroom.id
             classroom.delete()
-            return JsonResponse({'success': True})
+        invalidate_classroom_access(classroom_pk, teacher_ids)
+        invalidate_home_fragments(*teacher_ids, *student_ids)
+        return JsonResponse({'success': True})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
@@ -4863,7 +5438,7 @@ def toggle_copying(request, classroom_id):
             # Получаем класс по ID
             classroom = Classroom.objects.get(id=classroom_id)
 
-            if request.user not in classroom.teachers.all():
+            if not get_classroom_access(request.user, classroom)['is_teacher']:
                 return JsonResponse({
                     'success': False,
                     'error': 'У вас нет доступа к данному классу.'
@@ -5006,21 +5581,39 @@ def send_homework(request):
         return HttpResponseBadRequest("Класс не найден")
 
     # Получаем задачи
-    tasks = BaseTask.objects.filter(id__in=task_ids)
+    task_ids = list(BaseTask.objects.filter(id__in=task_ids).values_list('id', flat=True))
+    student_ids = list(classroom.students.values_list('id', flat=True))
 
-    students = classroom.students.all()  # если есть m2m students
-    for student in students:
-        hw, created_flag = Homework.objects.get_or_create(
-            classroom=classroom,
-            student=student,
-            lesson_id=lesson_id,
-            defaults={'status': 'sent', 'assigned_by': request.user}
+    with transaction.atomic():
+        # Домашки учеников: существующие одним запросом, недостающие — одной вставкой
+        homework_ids = dict(
+            Homework.objects.filter(classroom=classroom, lesson_id=lesson_id, student_id__in=student_ids)
+            .values_list('student_id', 'id')
         )
-        hw.tasks.set(tasks)  # Связываем задачи в любом случае
+        new_homeworks = Homework.objects.bulk_create([
+            Homework(
+                classroom=classroom,
+                student_id=student_id,
+                lesson_id=lesson_id,
+                status='sent',
+                assigned_by=request.user
+            )
+            for student_id in student_ids if student_id not in homework_ids
+        ])
+        all_homework_ids = list(homework_ids.values()) + [hw.id for hw in new_homeworks]
+
+        # Задания домашек: лишние связи удаляются одним запросом, новые добавляются одной вставкой
+        Through = Homework.tasks.through
+        Through.objects.filter(homework_id__in=all_homework_ids).exclude(basetask_id__in=task_ids).delete()
+        Through.objects.bulk_create([
+            Through(homework_id=homework_id, basetask_id=task_id)
+            for homework_id in all_homework_ids
+            for task_id in task_ids
+        ], ignore_conflicts=True)
 
     return JsonResponse({
-        'created_count': len(hw.tasks.all()),
-        'created_ids': [str(task.id) for task in hw.tasks.all()],
+        'created_count': len(task_ids) if student_ids else 0,
+        'created_ids': [str(task_id) for task_id in task_ids] if student_ids else [],
     })
 
 @login_required
@@ -5034,8 +5627,9 @@ def homework_view(request, classroom_id, lesson_id):
         return access_resp
 
     # Разрешаем и учителю и ученику
-    is_teacher = request.user in classroom_obj.teachers.all()
-    is_student = request.user in classroom_obj.students.all()
+    access = get_classroom_access(request.user, classroom_obj)
+    is_teacher = access['is_teacher']
+    is_student = access['is_student']
     if not (is_teacher or is_student):
         return HttpResponseForbidden("У вас нет доступа к этому классу.")
 
@@ -5164,11 +5758,13 @@ def accept_invitation(request, code):
         classroom = get_object_or_404(Classroom, invitation_code=code)
 
         # Проверка: уже участник?
-        if (request.user in classroom.students.all()) or (request.user in classroom.teachers.all()):
+        if get_classroom_access(request.user, classroom)['role']:
             return redirect("classroom_view", classroom_id=classroom.id)
 
         # Присоединяем пользователя как ученика
         classroom.students.add(request.user)
+        invalidate_classroom_access(classroom.id, [request.user.id])
+        invalidate_classroom_home_fragments(classroom)
 
         messages.success(request, "Вы успешно присоединились к классу!")
         return redirect("classroom_view", classroom_id=classroom.id)
@@ -5666,70 +6262,108 @@ def _create_local_payment_from_yk(payment_obj):
     )
     return payment_record
 
-def check_user_pending_payments(user):
+# Как часто главная страница может ставить в очередь сверку pending-платежей пользователя
+PENDING_PAYMENTS_CHECK_INTERVAL = 5 * 60
+
+
+def reconcile_pending_payment(payment):
     """
-    Проверяет pending платежи пользователя за последние сутки
-    и обрабатывает их, если они оплачены
+    Сверяет один pending платёж с YooKassa: зачисляет оплаченный, подтверждает
+    ожидающий capture и удаляет отменённый. Возвращает True, если платёж зачислен.
+    """
+    # Получаем актуальный статус из YooKassa
+    yk_obj = Payment.find_one(payment.transaction_id)
+    yk_status = getattr(yk_obj, 'status', None) or (yk_obj.get('status') if isinstance(yk_obj, dict) else None)
+
+    if yk_status in ('succeeded', 'paid'):
+        # Обрабатываем успешный платеж
+        if _safe_mark_completed_and_credit(payment):
+            logger.info("Обработан pending платеж %s для пользователя %s",
+                        payment.pk, payment.user_id)
+            return True
+
+    elif yk_status == 'waiting_for_capture':
+        # Пытаемся подтвердить платеж
+        try:
+            idempotence_key = str(uuid.uuid4())
+            capture_body = {
+                "amount": {
+                    "value": f"{payment.amount:.2f}",
+                    "currency": payment.currency or "RUB"
+                }
+            }
+            capture_response = Payment.capture(payment.transaction_id, capture_body, idempotence_key)
+            captured_status = getattr(capture_response, 'status', None) or (
+                capture_response.get('status') if isinstance(capture_response, dict) else None)
+
+            if captured_status in ('succeeded', 'paid') and _safe_mark_completed_and_credit(payment):
+                logger.info("Подтвержден и обработан pending платеж %s для пользователя %s",
+                            payment.pk, payment.user_id)
+                return True
+
+        except Exception as e:
+            logger.exception("Ошибка capture для платежа %s: %s", payment.pk, str(e))
+
+    elif yk_status in ('canceled', 'cancelled'):
+        # Отменяем локально отмененный платеж
+        payment_pk = payment.pk
+        payment.delete()
+        logger.info("Отменен pending платеж %s для пользователя %s",
+                    payment_pk, payment.user_id)
+
+    return False
+
+
+def check_user_pending_payments(user=None):
+    """
+    Проверяет pending платежи за последние сутки (пользователя или всех, если user=None)
+    и обрабатывает их, если они оплачены. Вызывается из Celery-задачи и крона, а не из запросов.
     """
     # Находим pending платежи за последние 24 часа
     twenty_four_hours_ago = timezone.now() - timedelta(hours=24)
 
     pending_payments = PaymentRecord.objects.filter(
-        user=user,
         status=PaymentRecord.Status.PENDING,
         created_at__gte=twenty_four_hours_ago
-    )
+    ).select_related('user')
+    if user is not None:
+        pending_payments = pending_payments.filter(user=user)
 
     processed_count = 0
 
     for payment in pending_payments:
         try:
-            # Получаем актуальный статус из YooKassa
-            yk_obj = Payment.find_one(payment.transaction_id)
-            yk_status = getattr(yk_obj, 'status', None) or (yk_obj.get('status') if isinstance(yk_obj, dict) else None)
+            if reconcile_pending_payment(payment):
+                processed_count += 1
+        except Exception as e:
+            logger.exception("Ошибка проверки pending платежа %s: %s", payment.pk, str(e))
 
-            if yk_status in ('succeeded', 'paid'):
-                # Обрабатываем успешный платеж
-                success = _safe_mark_completed_and_credit(payment)
-                if success:
-                    processed_count += 1
-                    logger.info("Обработан pending платеж %s для пользователя %s",
-                                payment.pk, user.id)
+    return processed_count
 
-            elif yk_status == 'waiting_for_capture':
-                # Пытаемся подтвердить платеж
-                try:
-                    idempotence_key = str(uuid.uuid4())
-                    capture_body = {
-                        "amount": {
-                            "value": f"{payment.amount:.2f}",
-                            "currency": payment.currency or "RUB"
-                        }
-                    }
-                    capture_response = Payment.capture(payment.transaction_id, capture_body, idempotence_key)
-                    captured_status = getattr(capture_response, 'status', None) or (
-                        capture_response.get('status') if isinstance(capture_response, dict) else None)
 
-                    if captured_status in ('succeeded', 'paid'):
-                        success = _safe_mark_completed_and_credit(payment)
-                        if success:
-                            processed_count += 1
-                            logger.info("Подтвержден и обработан pending платеж %s для пользователя %s",
-                                        payment.pk, user.id)
+@csrf_exempt
+@require_POST
+def yookassa_webhook(request):
+    """
+    HTTP-уведомление YooKassa о смене статуса платежа. Телу уведомления не доверяем:
+    по id платежа ставим в очередь сверку, которая заново запрашивает статус у YooKassa.
+    """
+    try:
+        data = json.loads(request.body)
+        transaction_id = data['object']['id']
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest("Invalid notification")
 
-                except Exception as e:
-                    logger.exception("Ошибка capture для платежа %s: %s", payment.pk, str(e))
+    payment = PaymentRecord.objects.filter(
+        transaction_id=transaction_id,
+        status=PaymentRecord.Status.PENDING
+    ).only('pk').first()
+    if payment:
+        reconcile_payment_task.delay(payment.pk)
 
-            elif yk_status in ('canceled', 'cancelled'):
-                # Отменяем локально отмененный платеж
-                payment.delete()
-                logger.info("Отменен pending платеж %s для пользователя %s",
-                           payment.pk, user.id)
+    # YooKassa ждёт 200, иначе повторяет уведомление
+    return HttpResponse(status=200)
 
-        except Exception as e:
-            logger.exception("Ошибка проверки pending платежа %s: %s", payment.pk, str(e))
-
-    return processed_count
 
 def _safe_mark_completed_and_credit(payment_record, provider_transaction_id=None):
     if payment_record.status == PaymentRecord.Status.COMPLETED:
@@ -5738,15 +6372,16 @@ def _safe_mark_completed_and_credit(payment_record, provider_transaction_id=None
 
     try:
         with transaction.atomic():
+            # Сверку одного платежа могут одновременно запустить вебхук, крон и страница возврата —
+            # блокируем строку, чтобы не зачислить оплату дважды
+            locked = PaymentRecord.objects.select_for_update().only('status').get(pk=payment_record.pk)
+            if locked.status == PaymentRecord.Status.COMPLETED:
+                return True
             payment_record.mark_completed(transaction_id=provider_transaction_id or payment_record.transaction_id)
 
             if payment_record.payment_type == PaymentRecord.PaymentType.TOKEN_PACK and payment_record.token_amount:
-                balance, _ = UserTokenBalance.objects.get_or_create(
-                    user=payment_record.user,
-                    defaults={'tariff_tokens': 0, 'extra_tokens': 0}
-                )
-                balance.extra_tokens = (balance.extra_tokens or 0) + (payment_record.token_amount or 0)
-                balance.save()
+                UserTokenBalance.credit(payment_record.user_id, extra_amount=payment_record.token_amount or 0,
+                                        reason=f"payment {payment_record.pk}")
                 logger.info("Credited %s tokens to user %s for payment %s",
                             payment_record.token_amount, payment_record.user.id, payment_record.pk)
 
@@ -5865,12 +6500,7 @@ def activate_user_tariff(
 
             # 🔹 Начисляем токены, если start_date сегодня или вчера
             if user_tariff.start_date.date() in {now.date(), (now - timedelta(days=1)).date()}:
-                balance, _ = UserTokenBalance.objects.get_or_create(
-                    user=user,
-                    defaults={"tariff_tokens": 0, "extra_tokens": 0},
-                )
-                balance.tariff_tokens = tariff_tokens
-                balance.save()
+                UserTokenBalance.reset_tariff_tokens(user.id, tariff_tokens, reason=f"tariff {tariff_type}")
 
                 logger.info(
                     "Начислено %s тарифных токенов пользователю %s (start_date=%s, сегодня=%s)",
@@ -6062,10 +6692,11 @@ def switch_role(request):
         # Меняем роль
         user.role = Role.TEACHER
         user.save()
+        invalidate_home_fragments(user.id)
 
         # Начисляем бонусы, как при регистрации
         extra_tokens = 200
-        UserTokenBalance.objects.create(user=user, extra_tokens=extra_tokens, tariff_tokens=0)
+        UserTokenBalance.credit(user.id, extra_amount=extra_tokens, reason='signup_bonus')
 
         return JsonResponse({"success": True, "role": user.role})
 
@@ -6125,7 +6756,9 @@ def public_course_selection(request, user, classroom, lesson_obj):
     2) Если в курсе уже есть урок с таким названием - удалить его.
     3) Создать новый урок с таким же названием (is_public=False) в курсе.
     4) Создать в новом уроке столько разделов, сколько было в публичном уроке,
-       и запустить clone_section(old_section, new_section, user) для каждого.
+       и создать в них задания-ссылки на контент публичного урока одной пачкой
+       (clone_sections_bulk с share_content=True); контент копируется только при
+       редактировании задания (fork_task_content), тогда же учитывается место.
     5) Присвоить новый урок к classroom.lesson и сохранить.
     Возвращает dict с информацией или с ключом "error".
     """
@@ -6174,32 +6807,31 @@ def public_course_selection(request, user, classroom, lesson_obj):
                 context=lesson_obj.context or {}
             )
 
-            # Клонируем секции
-            with transaction.atomic():
-                old_sections = list(lesson_obj.sections.all().order_by('id'))
-
-                for old_sec in old_sections:
-                    new_sec = Section.objects.create(
-                        lesson=new_lesson,
-                        name=old_sec.name,
-                        type=old_sec.type,
-                        order=old_sec.order,
-                    )
+            # Клонируем секции и их задания пачкой
+            old_sections = list(lesson_obj.sections.all().order_by('order', 'id'))
+            new_sections = Section.objects.bulk_create([
+                Section(
+                    lesson=new_lesson,
+                    name=old_sec.name,
+                    type=old_sec.type,
+                    order=old_sec.order or idx,
+                )
+                for idx, old_sec in enumerate(old_sections, start=1)
+            ])
 
-                    if callable(clone_section):
-                        try:
-                            clone_section(old_sec, new_sec, user)
-                        except Exception as e:
-                            # Логируем ошибку и откатываем транзакцию
-                            logger.exception("Ошибка клонирования раздела %s -> %s: %s",
-                                             old_sec.pk, new_sec.pk, e)
-                            raise  # Перебрасываем исключение для отката транзакции
-                    else:
-                        logger.warning("Функция клонирования недоступна — раздел %s создан без контента", new_sec.pk)
+            try:
+                # Задания не копируются: ссылки на контент публичного урока, копия — при редактировании
+                clone_sections_bulk(list(zip(old_sections, new_sections)), user, share_content=True)
+            except Exception as e:
+                # Логируем ошибку и откатываем транзакцию
+                logger.exception("Ошибка клонирования разделов урока %s -> %s: %s",
+                                 lesson_obj.pk, new_lesson.pk, e)
+                raise  # Перебрасываем исключение для отката транзакции
 
             # Привязываем новый урок к классу
             classroom.lesson = new_lesson
             classroom.save(update_fields=["lesson"])
+            invalidate_classroom_home_fragments(classroom)
 
             logger.info("Assigned new lesson %s to classroom %s", new_lesson.pk, classroom.pk)
 
@@ -6238,6 +6870,7 @@ def personal_course_selection(request, user, classroom, lesson_obj):
 
     classroom.lesson = lesson_obj
     classroom.save(update_fields=["lesson"])
+    invalidate_classroom_home_fragments(classroom)
     return {
         "message": f"Личный урок '{lesson_obj.name}' выбран для класса {classroom.id}",
         "lesson_id": str(lesson_obj.id),
@@ -6420,12 +7053,8 @@ def give_present(request):
 
             else:
                 # Не бесплатный — начисляем 500 дополнительных токенов
-                tb, _ = UserTokenBalance.objects.select_for_update().get_or_create(user=user, defaults={
-                    "tariff_tokens": 0,
-                    "extra_tokens": 0,
-                })
-                tb.extra_tokens = (tb.extra_tokens or 0) + 500
-                tb.save(update_fields=["extra_tokens", "updated_at"])
+                UserTokenBalance.credit(user.id, extra_amount=500, reason="gift")
+                tb = UserTokenBalance.objects.get(user=user)
 
                 # Отправляем письмо-поздравление
                 try:
@@ -6530,9 +7159,7 @@ def start_generate_lesson(request):
 
     if request.user and request.user.is_authenticated:
         try:
-            if hasattr(request.user, 'metrics'):
-                request.user.metrics.lessons_generated_counter += 1
-                request.user.metrics.save(update_fields=["lessons_generated_counter"])
+            UserMetrics.increment(request.user.id, "lessons_generated_counter")
         except Exception as e:
             # Логируем или просто пропускаем
             import logging
@@ -6652,6 +7279,7 @@ def generate_lesson(user, lesson_topic: str, generation_id: Optional[str] = None
 
         status_obj.lesson = lesson_obj
         status_obj.save(update_fields=["lesson", "updated_at"])
+        invalidate_home_fragments(user.id)
 
     # Шаг 2: запрос к ИИ за структурой разделов
     initial_query = (
@@ -6699,6 +7327,7 @@ def generate_lesson(user, lesson_topic: str, generation_id: Optional[str] = None
 
         # создаём learning секцию
         sec_obj = Section.objects.create(lesson=lesson_obj, name=section_name, type="learning")
+        section_items = []  # задания раздела создаются одной пачкой после генерации
 
         for task_type in sec.get("task_types", []):
             if task_type not in ALLOWED_TASK_TYPES:
@@ -6743,13 +7372,7 @@ def generate_lesson(user, lesson_topic: str, generation_id: Optional[str] = None
                 else:
                     auto_context_str = ""
 
-                try:
-                    task_instance = create_task_instance(user, task_type, filtered_item_data, sec_obj)
-                except Exception as e:
-                    print(e)
-                    logger.exception("Failed to create task instance for %s: %s", task_type, e)
-                    continue
-
+                section_items.append((task_type, filtered_item_data))
                 completed_tasks += 1
                 status_obj.update_progress(completed_tasks, total_tasks)
 
@@ -6758,6 +7381,14 @@ def generate_lesson(user, lesson_topic: str, generation_id: Optional[str] = None
                 logger.exception("Unhandled exception during generation of task %s: %s", task_type, e)
                 continue
 
+        try:
+            created = create_task_instances_bulk(user, sec_obj, section_items)
+            completed_tasks -= created.count(None)
+        except Exception as e:
+            print(e)
+            logger.exception("Failed to create task instances for section %s: %s", section_name, e)
+            completed_tasks -= len(section_items)
+
     status_obj.update_progress(completed_tasks, total_tasks)
     status_obj.mark_finished()
 
@@ -7013,9 +7644,7 @@ def download_public_pdf(request, lesson_id):
 
         if request.user and request.user.is_authenticated:
             try:
-                if hasattr(request.user, 'metrics'):
-                    request.user.metrics.pdf_downloaded_counter += 1
-                    request.user.metrics.save(update_fields=["pdf_downloaded_counter"])
+                UserMetrics.increment(request.user.id, "pdf_downloaded_counter")
             except Exception as e:
                 # Логируем или просто пропускаем
                 import logging
@@ -7031,11 +7660,12 @@ def download_public_pdf(request, lesson_id):
 @login_required
 def pdf_downloaded(request):
     try:
-        metrics, _ = UserMetrics.objects.get_or_create(user=request.user)
-        metrics.update_activity()
-        metrics.pdf_downloaded_counter += 1
-        metrics.save(update_fields=["pdf_downloaded_counter", "last_activity_at", "first_activity_at"])
-        return JsonResponse({"status": "ok", "pdf_downloaded_counter": metrics.pdf_downloaded_counter})
+        UserMetrics.increment(request.user.id, "pdf_downloaded_counter")
+        pending = UserMetrics.pending(request.user.id, "pdf_downloaded_counter")
+        stored = UserMetrics.objects.filter(user=request.user).values_list(
+            'pdf_downloaded_counter', flat=True
+        ).first() or 0
+        return JsonResponse({"status": "ok", "pdf_downloaded_counter": stored + pending})
     except Exception as e:
         return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
@@ -7116,6 +7746,8 @@ def invitation_guide(request):
     if not classroom:
         classroom = Classroom.objects.create(name="My Class")
         classroom.teachers.add(user)
+        invalidate_classroom_access(classroom.id, [user.id])
+        invalidate_home_fragments(user.id)
 
     # генерируем ссылку-приглашение
     classroom_link = request.build_absolute_uri(
@@ -7166,6 +7798,7 @@ def ensure_user_lesson(user):
                     name="Let's begin! 😉",
                     type="learning"
                 )
+            invalidate_home_fragments(user.id)
             return course.id, lesson.id
 
         # 3) нет ни курса, ни урока
@@ -7190,6 +7823,7 @@ def ensure_user_lesson(user):
                 name="Let's begin! 😉",
                 type="learning"
             )
+        invalidate_home_fragments(user.id)
         return new_course.id, lesson.id
 
     except Exception:
@@ -169,6 +169,14 @@ LOGIN_URL = '/users/register/'
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 85 * 1024 * 1024
 
+# OCR PDF: разрешение растеризации страниц и число параллельных процессов tesseract
+PDF_OCR_DPI = int(os.getenv('PDF_OCR_DPI', 200))
+PDF_OCR_WORKERS = int(os.getenv('PDF_OCR_WORKERS', os.cpu_count() or 1))
+
+# Докачиваемые загрузки: куски собираются в файл на диске до вызова finish
+CHUNKED_UPLOAD_DIR = os.getenv('CHUNKED_UPLOAD_DIR', os.path.join(BASE_DIR, 'tmp', 'chunked_uploads'))
+CHUNKED_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
 TARIFFS = {
     'free': {
         'price_month': 0,
@@ -232,6 +240,24 @@ CRONJOBS = [
 
     # 10. Запускать каждый день в полночь — сбрасывать тарифные токены
     ('0 0 * * *', 'django.core.management.call_command', ['reset_tariff_tokens']),
+
+    # 11. Ежедневно в 03:00 вытеснять редко используемые запросы из кэша поиска картинок
+    ('0 3 * * *', 'django.core.management.call_command', ['cleanup_unsplash_images']),
+
+    # 12. Ежедневно в 03:30 ограничивать размер кэша распознанного текста PDF
+    ('30 3 * * *', 'django.core.management.call_command', ['cleanup_pdf_text_cache']),
+
+    # 13. Ежедневно в 04:00 удалять незавершённые докачиваемые загрузки старше суток
+    ('0 4 * * *', 'django.core.management.call_command', ['cleanup_chunked_uploads']),
+
+    # 14. Ежедневно в 04:30 сверять used_storage пользователей с фактическим размером заданий и файлов
+    ('30 4 * * *', 'django.core.management.call_command', ['recalculate_used_storage']),
+
+    # 15. Каждые 10 минут сверять pending-платежи с YooKassa (страховка к вебхуку)
+    ('*/10 * * * *', 'django.core.management.call_command', ['reconcile_pending_payments']),
+
+    # 16. Каждые 5 минут переносить накопленные в Redis метрики активности в UserMetrics
+    ('*/5 * * * *', 'django.core.management.call_command', ['flush_user_metrics']),
 ]
 
 
@@ -0,0 +1,24 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+MAX_UPLOAD_AGE = 24 * 60 * 60  # незавершённые загрузки живут сутки
+
+class Command(BaseCommand):
+    help = 'Удаляет куски незавершённых докачиваемых загрузок старше суток'
+
+    def handle(self, *args, **options):
+        upload_dir = settings.CHUNKED_UPLOAD_DIR
+        if not os.path.isdir(upload_dir):
+            return
+
+        cutoff = time.time() - MAX_UPLOAD_AGE
+        deleted = 0
+        for name in os.listdir(upload_dir):
+            path = os.path.join(upload_dir, name)
+            if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                deleted += 1
+        self.stdout.write(f"Удалено {deleted} незавершённых загрузок.")
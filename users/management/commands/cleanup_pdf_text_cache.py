@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from hub.models import PdfPageText
+
+MAX_CACHE_SIZE = 512 * 1024 * 1024  # 512 МБ текста
+
+class Command(BaseCommand):
+    help = 'Удаляет давно не использованные страницы из кэша текста PDF сверх лимита размера'
+
+    def handle(self, *args, **options):
+        deleted = PdfPageText.evict(MAX_CACHE_SIZE)
+        self.stdout.write(f"Удалено {deleted} страниц из кэша текста PDF.")
@@ -1,12 +1,18 @@
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from datetime import timedelta
-from ...models import SavedUnsplashImage
+from hub.models import SavedUnsplashImage, ImageSearchCache
+
+MAX_CACHE_ENTRIES = 20000
 
 class Command(BaseCommand):
-    help = 'Удаляет записи SavedUnsplashImage старше одного года'
+    help = 'Вытесняет редко используемые запросы из кэша картинок и удаляет записи без ключа'
 
     def handle(self, *args, **options):
-        cutoff = timezone.now() - timedelta(days=365)
-        deleted, _ = SavedUnsplashImage.objects.filter(created_at__lt=cutoff).delete()
-        self.stdout.write(f"Удалено {deleted} старых записей изображений.")
+        # Сначала переносим накопленные в Redis попадания — по ним идёт вытеснение
+        ImageSearchCache.flush_hits()
+        evicted = ImageSearchCache.evict(MAX_CACHE_ENTRIES)
+        cache.delete_many(["image_search:" + key.replace(' ', '_') for key in evicted])
+
+        # Записи без ключа миграция 0008 привязывает к кэшу; оставшиеся недоступны поиску
+        deleted, _ = SavedUnsplashImage.objects.filter(cache__isnull=True).delete()
+        self.stdout.write(f"Вытеснено {len(evicted)} запросов, удалено {deleted} записей изображений без ключа.")
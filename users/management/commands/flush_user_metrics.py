@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from users.models import UserMetrics
+
+
+class Command(BaseCommand):
+    help = 'Переносит накопленные в Redis счётчики и активность пользователей в UserMetrics'
+
+    def handle(self, *args, **options):
+        updated = UserMetrics.flush_buffered()
+        self.stdout.write(f"Обновлены метрики {updated} пользователей.")
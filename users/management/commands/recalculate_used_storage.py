@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+
+from hub.models import BaseTask, MediaFile
+from users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает used_storage пользователей по размерам заданий (BaseTask.size) и файлов (MediaFile.size)'
+
+    def handle(self, *args, **options):
+        usage = {}
+        task_sizes = (
+            BaseTask.objects.filter(section__isnull=False)
+            .values_list('section__lesson__course__user')
+            .annotate(total=Sum('size'))
+        )
+        for user_id, total in task_sizes:
+            usage[user_id] = usage.get(user_id, 0) + (total or 0)
+
+        media_sizes = MediaFile.objects.filter(user__isnull=False).values_list('user').annotate(total=Sum('size'))
+        for user_id, total in media_sizes:
+            usage[user_id] = usage.get(user_id, 0) + (total or 0)
+
+        to_update = []
+        for user in CustomUser.objects.only('id', 'used_storage').iterator():
+            actual = usage.get(user.id, 0)
+            if user.used_storage != actual:
+                user.used_storage = actual
+                to_update.append(user)
+
+        CustomUser.objects.bulk_update(to_update, ['used_storage'], batch_size=500)
+        self.stdout.write(f"Исправлено used_storage у {len(to_update)} пользователей.")
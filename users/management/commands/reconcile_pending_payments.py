@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from hub.views import check_user_pending_payments
+
+
+class Command(BaseCommand):
+    help = 'Сверяет pending-платежи за последние сутки с YooKassa и зачисляет оплаченные'
+
+    def handle(self, *args, **options):
+        processed = check_user_pending_payments()
+        self.stdout.write(f"Обработано платежей: {processed}.")
@@ -16,7 +16,6 @@ class Command(BaseCommand):
 
         for user_tariff in UserTariff.objects.select_related('user'):
             user = user_tariff.user
-            balance, _ = UserTokenBalance.objects.get_or_create(user=user)
 
             # 1) Деактивация просроченных тарифов
             if user_tariff.end_date and user_tariff.end_date < now:
@@ -27,8 +26,7 @@ class Command(BaseCommand):
                     deactivated += 1
 
                 # Сбрасываем токены у неактивного тарифа
-                balance.tariff_tokens = 0
-                balance.save(update_fields=['tariff_tokens', 'updated_at'])
+                UserTokenBalance.reset_tariff_tokens(user.id, 0, reason="tariff expired")
                 continue
 
             # 2) Сброс и начисление токенов в день из reset_dates (только по дате)
@@ -43,8 +41,7 @@ class Command(BaseCommand):
                     if reset_day == today:
                         # Сбрасываем и начисляем новые токены
                         limit = settings.TARIFFS[user_tariff.tariff_type]['token_limit']
-                        balance.tariff_tokens = limit
-                        balance.save(update_fields=['tariff_tokens', 'updated_at'])
+                        UserTokenBalance.reset_tariff_tokens(user.id, limit, reason="monthly reset")
 
                         # Уменьшаем months_left, если поле есть
                         if hasattr(user_tariff, 'months_left'):
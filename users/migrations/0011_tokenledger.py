@@ -0,0 +1,35 @@
+# Generated by Django 4.2.23 on 2026-10-19 16:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_arseniyapplication'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('debit', 'Списание'), ('reserve', 'Резерв'), ('commit', 'Закрытие резерва'), ('release', 'Возврат резерва'), ('credit', 'Начисление'), ('reset', 'Сброс тарифных токенов')], max_length=10)),
+                ('tariff_delta', models.IntegerField(default=0)),
+                ('extra_delta', models.IntegerField(default=0)),
+                ('reservation_id', models.UUIDField(blank=True, db_index=True, null=True)),
+                ('reason', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='token_ledger', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='tokenledger',
+            constraint=models.UniqueConstraint(condition=models.Q(('kind__in', ['commit', 'release'])), fields=('reservation_id',), name='token_ledger_single_settlement'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.23 on 2026-10-19 19:10
+
+from django.db import migrations
+from django.db.models import Sum
+
+
+def add_opening_balances(apps, schema_editor):
+    """Строка CREDIT на остаток каждого баланса, чтобы сумма дельт журнала совпадала с балансом."""
+    UserTokenBalance = apps.get_model('users', 'UserTokenBalance')
+    TokenLedger = apps.get_model('users', 'TokenLedger')
+
+    logged = {
+        row['user_id']: row
+        for row in TokenLedger.objects.values('user_id').annotate(tariff=Sum('tariff_delta'), extra=Sum('extra_delta'))
+    }
+    entries = []
+    for balance in UserTokenBalance.objects.iterator():
+        row = logged.get(balance.user_id, {})
+        tariff_delta = balance.tariff_tokens - (row.get('tariff') or 0)
+        extra_delta = balance.extra_tokens - (row.get('extra') or 0)
+        if tariff_delta or extra_delta:
+            entries.append(TokenLedger(user_id=balance.user_id, kind='credit', tariff_delta=tariff_delta,
+                                       extra_delta=extra_delta, reason='opening_balance'))
+    TokenLedger.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_tokenledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_opening_balances, migrations.RunPython.noop),
+    ]
@@ -1,16 +1,23 @@
 import uuid
-from datetime import date, datetime, timedelta
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone as dt_timezone
 import logging
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.conf import settings
+from django.core.cache import cache
 from dateutil.relativedelta import relativedelta
-from django.db.models import JSONField
+from django.db.models import JSONField, F, Case, When, Value
+from django.db.models.functions import Greatest, Coalesce
+from django_redis import get_redis_connection
 from django.contrib.postgres.fields import ArrayField
+from hub.utils import redis_hash_snapshot, redis_hash_pending
 from django.utils.translation import gettext_lazy as _
 
+logger = logging.getLogger(__name__)
+
 
 class Role(models.TextChoices):
     STUDENT = 'student', 'Ученик'
@@ -100,16 +107,51 @@ class CustomUser(AbstractUser):
     def update_used_storage(self, additional_size):
         """
         Обновляет информацию о занятом объеме памяти пользователем.
-        Гарантирует, что значение used_storage не будет меньше нуля.
+        Изменение применяется атомарно в БД (F-выражение), без сохранения всей строки;
+        значение used_storage не опускается ниже нуля.
+        Внутри storage_batch() изменения накапливаются и записываются одним запросом.
         """
         if not isinstance(additional_size, (int, float)):
             raise TypeError("additional_size must be a number")
 
-        new_storage = self.used_storage + additional_size
-        final_storage = max(new_storage, 0)
+        additional_size = int(additional_size)
+        self.used_storage = max(self.used_storage + additional_size, 0)
 
-        self.used_storage = final_storage
-        self.save()
+        if getattr(self, '_storage_batch_depth', 0):
+            self._storage_batch_delta += additional_size
+            return
+
+        self._apply_storage_delta(additional_size)
+
+    def _apply_storage_delta(self, delta):
+        if delta:
+            type(self).objects.filter(pk=self.pk).update(used_storage=Greatest(F('used_storage') + delta, 0))
+
+    @contextmanager
+    def storage_batch(self):
+        """
+        Контекст для операций с несколькими изменениями хранилища (удаление урока,
+        клонирование раздела и т.п.): суммарное изменение записывается один раз при выходе.
+        Вложенные вызовы допускаются — запись делает внешний.
+        Запись делается только при выходе без исключения (изменения, накопленные в блоке
+        с исключением, отбрасываются), а внутри atomic-блока — после его коммита.
+        """
+        depth = getattr(self, '_storage_batch_depth', 0)
+        if not depth:
+            self._storage_batch_delta = 0
+        entry_delta, entry_used = self._storage_batch_delta, self.used_storage
+        self._storage_batch_depth = depth + 1
+        try:
+            yield self
+        except BaseException:
+            self._storage_batch_delta, self.used_storage = entry_delta, entry_used
+            raise
+        finally:
+            self._storage_batch_depth = depth
+
+        if not depth:
+            delta, self._storage_batch_delta = self._storage_batch_delta, 0
+            transaction.on_commit(lambda: self._apply_storage_delta(delta))
 
 class EmailConfirmation(models.Model):
     email = models.EmailField()
@@ -147,6 +189,11 @@ class TariffStatus(models.TextChoices):
     ACTIVE = 'active', 'Активный'
     UNPAID = 'unpaid', 'Неоплаченный'
 
+def user_access_cache_key(user_id):
+    """Ключ кэша с тарифом и числом классов пользователя (см. hub.views.get_classroom_access)."""
+    return f"classroom_access:user:{user_id}"
+
+
 class UserTariff(models.Model):
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='tariff')
     tariff_type = models.CharField(
@@ -178,6 +225,11 @@ class UserTariff(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Тариф влияет на доступ к классам — сбрасываем закэшированный контекст доступа
+        cache.delete(user_access_cache_key(self.user_id))
+
     def is_active(self):
         if self.status != TariffStatus.ACTIVE:
             return False
@@ -215,6 +267,11 @@ class UserTokenBalance(models.Model):
     extra_tokens = models.IntegerField(default=0, verbose_name='Докупленные токены')
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Списание/начисление идёт условными UPDATE с F() без select_for_update: параллельные
+    # генерации одного пользователя не ждут друг друга и не теряют обновления.
+    # Каждая операция пишет строку в TokenLedger в той же транзакции.
+    DEBIT_RETRIES = 5
+
     @property
     def tokens(self):
         return self.tariff_tokens + self.extra_tokens
@@ -222,6 +279,171 @@ class UserTokenBalance(models.Model):
     def __str__(self):
         return f"{self.user.username} — {self.tokens} токенов (тариф: {self.tariff_tokens}, доп: {self.extra_tokens})"
 
+    @classmethod
+    def _debit(cls, user_id, cost):
+        """
+        Списывает cost сначала с тарифных, затем с докупленных токенов.
+        Возвращает (с тарифных, с докупленных) или None, если токенов не хватает.
+        """
+        qs = cls.objects.filter(user_id=user_id)
+        if cost <= 0:
+            return 0, 0
+        # Частый случай: хватает тарифных — одно условное UPDATE
+        if qs.filter(tariff_tokens__gte=cost).update(tariff_tokens=F('tariff_tokens') - cost,
+                                                     updated_at=timezone.now()):
+            return cost, 0
+
+        # Смешанное списание: UPDATE проходит, только если тарифный остаток не изменился
+        # с момента чтения, а докупленных хватает на остаток; иначе перечитываем
+        for _ in range(cls.DEBIT_RETRIES):
+            row = qs.values('tariff_tokens', 'extra_tokens').first()
+            if row is None or row['tariff_tokens'] + row['extra_tokens'] < cost:
+                return None
+            from_tariff = min(max(row['tariff_tokens'], 0), cost)
+            from_extra = cost - from_tariff
+            if qs.filter(tariff_tokens=row['tariff_tokens'], extra_tokens__gte=from_extra).update(
+                tariff_tokens=F('tariff_tokens') - from_tariff,
+                extra_tokens=F('extra_tokens') - from_extra,
+                updated_at=timezone.now(),
+            ):
+                return from_tariff, from_extra
+        logger.warning("Token debit for user %s gave up after %s retries", user_id, cls.DEBIT_RETRIES)
+        return None
+
+    @classmethod
+    def _refund(cls, user_id, tariff_amount, extra_amount):
+        cls.objects.filter(user_id=user_id).update(
+            tariff_tokens=F('tariff_tokens') + tariff_amount,
+            extra_tokens=F('extra_tokens') + extra_amount,
+            updated_at=timezone.now(),
+        )
+
+    @classmethod
+    def debit(cls, user_id, cost, reason=''):
+        """Атомарно списывает cost токенов. False — если токенов не хватает."""
+        with transaction.atomic():
+            split = cls._debit(user_id, cost)
+            if split is None:
+                return False
+            TokenLedger.objects.create(user_id=user_id, kind=TokenLedger.Kind.DEBIT,
+                                       tariff_delta=-split[0], extra_delta=-split[1], reason=reason)
+        return True
+
+    @classmethod
+    def reserve(cls, user_id, amount, reason=''):
+        """
+        Резервирует amount токенов перед долгой генерацией (токены сразу списываются).
+        Возвращает id резерва для commit_reservation/release_reservation или None.
+        """
+        reservation_id = uuid.uuid4()
+        with transaction.atomic():
+            split = cls._debit(user_id, amount)
+            if split is None:
+                return None
+            TokenLedger.objects.create(user_id=user_id, kind=TokenLedger.Kind.RESERVE,
+                                       reservation_id=reservation_id,
+                                       tariff_delta=-split[0], extra_delta=-split[1], reason=reason)
+        return reservation_id
+
+    @classmethod
+    def commit_reservation(cls, user_id, reservation_id, actual_cost, reason=''):
+        """
+        Закрывает резерв фактической стоимостью: излишек возвращается туда, откуда был списан
+        (сначала в докупленные), недостача досписывается. False — если досписать не из чего;
+        резерв при этом остаётся открытым, его нужно освободить release_reservation.
+        """
+        reserve = TokenLedger.objects.get(reservation_id=reservation_id, kind=TokenLedger.Kind.RESERVE)
+        reserved_tariff, reserved_extra = -reserve.tariff_delta, -reserve.extra_delta
+        overrun = actual_cost - (reserved_tariff + reserved_extra)
+
+        with transaction.atomic():
+            if overrun > 0:
+                split = cls._debit(user_id, overrun)
+                if split is None:
+                    return False
+                tariff_delta, extra_delta = -split[0], -split[1]
+            else:
+                extra_delta = min(-overrun, reserved_extra)
+                tariff_delta = -overrun - extra_delta
+                cls._refund(user_id, tariff_delta, extra_delta)
+            # Уникальное ограничение не даст закрыть резерв дважды
+            TokenLedger.objects.create(user_id=user_id, kind=TokenLedger.Kind.COMMIT,
+                                       reservation_id=reservation_id,
+                                       tariff_delta=tariff_delta, extra_delta=extra_delta, reason=reason)
+        return True
+
+    @classmethod
+    def release_reservation(cls, user_id, reservation_id, reason=''):
+        """Полностью возвращает зарезервированные токены (генерация не удалась)."""
+        reserve = TokenLedger.objects.get(reservation_id=reservation_id, kind=TokenLedger.Kind.RESERVE)
+        with transaction.atomic():
+            cls._refund(user_id, -reserve.tariff_delta, -reserve.extra_delta)
+            TokenLedger.objects.create(user_id=user_id, kind=TokenLedger.Kind.RELEASE,
+                                       reservation_id=reservation_id,
+                                       tariff_delta=-reserve.tariff_delta, extra_delta=-reserve.extra_delta,
+                                       reason=reason)
+
+    @classmethod
+    def credit(cls, user_id, extra_amount=0, tariff_amount=0, reason=''):
+        """Начисляет токены (оплата, подарок) инкрементом F(), создавая баланс при необходимости."""
+        with transaction.atomic():
+            cls.objects.get_or_create(user_id=user_id)
+            cls._refund(user_id, tariff_amount, extra_amount)
+            TokenLedger.objects.create(user_id=user_id, kind=TokenLedger.Kind.CREDIT,
+                                       tariff_delta=tariff_amount, extra_delta=extra_amount, reason=reason)
+
+    @classmethod
+    def reset_tariff_tokens(cls, user_id, amount, reason=''):
+        """Устанавливает тарифные токены в amount (ежемесячный сброс), не трогая докупленные."""
+        with transaction.atomic():
+            balance, _ = cls.objects.select_for_update().get_or_create(user_id=user_id)
+            delta = amount - balance.tariff_tokens
+            cls.objects.filter(pk=balance.pk).update(tariff_tokens=amount, updated_at=timezone.now())
+            if delta:
+                TokenLedger.objects.create(user_id=user_id, kind=TokenLedger.Kind.RESET,
+                                           tariff_delta=delta, extra_delta=0, reason=reason)
+
+
+class TokenLedger(models.Model):
+    """Журнал движения токенов: строки только добавляются, сумма дельт даёт баланс."""
+    class Kind(models.TextChoices):
+        DEBIT = 'debit', 'Списание'
+        RESERVE = 'reserve', 'Резерв'
+        COMMIT = 'commit', 'Закрытие резерва'
+        RELEASE = 'release', 'Возврат резерва'
+        CREDIT = 'credit', 'Начисление'
+        RESET = 'reset', 'Сброс тарифных токенов'
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='token_ledger')
+    kind = models.CharField(max_length=10, choices=Kind.choices)
+    tariff_delta = models.IntegerField(default=0)
+    extra_delta = models.IntegerField(default=0)
+    reservation_id = models.UUIDField(null=True, blank=True, db_index=True)
+    reason = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            # Резерв закрывается ровно один раз — подтверждением или возвратом
+            models.UniqueConstraint(
+                fields=['reservation_id'],
+                condition=models.Q(kind__in=['commit', 'release']),
+                name='token_ledger_single_settlement',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("TokenLedger is append-only")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("TokenLedger is append-only")
+
+    def __str__(self):
+        return f"{self.user_id}: {self.get_kind_display()} {self.tariff_delta:+}/{self.extra_delta:+}"
+
 class Payment(models.Model):
     class PaymentType(models.TextChoices):
         TARIFF     = 'tariff', 'Тариф'
@@ -554,6 +776,95 @@ class UserMetrics(models.Model):
         self.last_activity_at = now
         self.save(update_fields=["first_activity_at", "last_activity_at"])
 
+    @classmethod
+    def record_activity(cls, user_id):
+        """Запоминает активность в Redis; в БД её переносит flush_buffered()."""
+        now = timezone.now().timestamp()
+        pipe = get_redis_connection("default").pipeline()
+        pipe.hset(METRICS_LAST_SEEN_KEY, user_id, now)
+        pipe.hsetnx(METRICS_FIRST_SEEN_KEY, user_id, now)
+        pipe.execute()
+
+    @classmethod
+    def increment(cls, user_id, field, amount=1):
+        """
+        Увеличивает счётчик в Redis (HINCRBY) и отмечает активность.
+        Возвращает прирост в текущем буфере (без сбрасываемого снимка — см. pending()).
+        """
+        now = timezone.now().timestamp()
+        pipe = get_redis_connection("default").pipeline()
+        pipe.hincrby(METRICS_COUNTERS_KEY, f"{user_id}:{field}", amount)
+        pipe.hset(METRICS_LAST_SEEN_KEY, user_id, now)
+        pipe.hsetnx(METRICS_FIRST_SEEN_KEY, user_id, now)
+        return pipe.execute()[0]
+
+    @classmethod
+    def pending(cls, user_id, field):
+        """Прирост счётчика, ещё не перенесённый в БД (включая сбрасываемый сейчас снимок)."""
+        return redis_hash_pending(METRICS_COUNTERS_KEY, f"{user_id}:{field}")
+
+    @classmethod
+    def flush_buffered(cls, batch_size=500):
+        """
+        Переносит накопленные в Redis счётчики и время активности в UserMetrics.
+        Хэши переименовываются (redis_hash_snapshot), поэтому новые события копятся
+        параллельно; все UPDATE выполняются в одной транзакции, а снимок удаляется сразу
+        после её коммита — при ошибке его дочитает следующий запуск. Если сброс уже идёт
+        в другом процессе, этот запуск ничего не делает.
+        Счётчики пишутся UPDATE'ами F() + n, сгруппированными по одинаковому приросту.
+        Возвращает число обновлённых пользователей.
+        """
+        with redis_hash_snapshot(METRICS_COUNTERS_KEY, METRICS_LAST_SEEN_KEY, METRICS_FIRST_SEEN_KEY) as snapshot:
+            increments = {}
+            for name, amount in snapshot[METRICS_COUNTERS_KEY].items():
+                user_id, field = name.split(":", 1)
+                if field in METRICS_COUNTER_FIELDS and int(amount):
+                    increments.setdefault(int(user_id), {})[field] = int(amount)
+            last_seen = {int(uid): float(ts) for uid, ts in snapshot[METRICS_LAST_SEEN_KEY].items()}
+            first_seen = {int(uid): float(ts) for uid, ts in snapshot[METRICS_FIRST_SEEN_KEY].items()}
+
+            with transaction.atomic():
+                user_ids = set(CustomUser.objects.filter(
+                    id__in=set(increments) | set(last_seen) | set(first_seen)
+                ).values_list("id", flat=True))
+
+                if user_ids:
+                    cls.objects.bulk_create([cls(user_id=uid) for uid in user_ids], ignore_conflicts=True)
+
+                    # Счётчики: один UPDATE на группу пользователей с одинаковым набором приростов
+                    groups = {}
+                    for uid, fields in increments.items():
+                        if uid in user_ids:
+                            groups.setdefault(tuple(sorted(fields.items())), []).append(uid)
+                    for fields, uids in groups.items():
+                        cls.objects.filter(user_id__in=uids).update(
+                            **{field: F(field) + amount for field, amount in fields}
+                        )
+
+                    # Активность: Greatest/Coalesce с CASE по пользователю, пачками
+                    def as_datetime(ts):
+                        return datetime.fromtimestamp(ts, tz=dt_timezone.utc)
+
+                    active_ids = sorted(user_ids & (set(last_seen) | set(first_seen)))
+                    for start in range(0, len(active_ids), batch_size):
+                        batch = active_ids[start:start + batch_size]
+                        last_case = Case(
+                            *[When(user_id=uid, then=Value(as_datetime(last_seen.get(uid) or first_seen[uid])))
+                              for uid in batch],
+                            output_field=models.DateTimeField(),
+                        )
+                        first_case = Case(
+                            *[When(user_id=uid, then=Value(as_datetime(first_seen.get(uid) or last_seen[uid])))
+                              for uid in batch],
+                            output_field=models.DateTimeField(),
+                        )
+                        cls.objects.filter(user_id__in=batch).update(
+                            last_activity_at=Greatest(Coalesce(F("last_activity_at"), last_case), last_case),
+                            first_activity_at=Coalesce(F("first_activity_at"), first_case),
+                        )
+
+        return len(user_ids)
+
     def retention_status(self):
         """
         Проверяем retention: вернулся ли пользователь на D1, D3, D7
@@ -574,6 +885,16 @@ class UserMetrics(models.Model):
     def __str__(self):
         return f"Metrics for {self.user}"
 
+
+# Буфер метрик в Redis: счётчики "user_id:field" -> прирост и время последней/первой активности
+METRICS_COUNTERS_KEY = "user_metrics:counters"
+METRICS_LAST_SEEN_KEY = "user_metrics:last_seen"
+METRICS_FIRST_SEEN_KEY = "user_metrics:first_seen"
+METRICS_COUNTER_FIELDS = {
+    "pdf_downloaded_counter", "ai_requests_counter", "tasks_generated_counter",
+    "sections_generated_counter", "lessons_generated_counter",
+}
+
 class Level(models.Model):
     code = models.CharField(max_length=2, unique=True)
     name = models.CharField(max_length=50)
@@ -1,3 +1,176 @@
 from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+
+User = get_user_model()
+
+
+class StorageBatchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="storage", password="pass", role="teacher")
+        User.objects.filter(pk=self.user.pk).update(used_storage=1000)
+        self.user.refresh_from_db()
+
+    def stored(self):
+        return User.objects.get(pk=self.user.pk).used_storage
+
+    def test_delta_written_once_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.user.storage_batch():
+                self.user.update_used_storage(-300)
+                with self.user.storage_batch():
+                    self.user.update_used_storage(50)
+                self.assertEqual(self.stored(), 1000)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.stored(), 750)
+
+    def test_exception_discards_delta(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError):
+                with self.user.storage_batch():
+                    self.user.update_used_storage(-300)
+                    raise RuntimeError("rolled back")
+        self.assertEqual(callbacks, [])
+        self.assertEqual((self.user.used_storage, self.stored()), (1000, 1000))
+
+
+class UserMetricsFlushTest(TestCase):
+    def setUp(self):
+        from django_redis import get_redis_connection
+        from users.models import METRICS_COUNTERS_KEY, METRICS_LAST_SEEN_KEY, METRICS_FIRST_SEEN_KEY
+        self.keys = [k for key in (METRICS_COUNTERS_KEY, METRICS_LAST_SEEN_KEY, METRICS_FIRST_SEEN_KEY)
+                     for k in (key, f"{key}:flushing")]
+        get_redis_connection("default").delete(*self.keys)
+        self.user = User.objects.create_user(username="metrics", password="pass", role="teacher")
+
+    def tearDown(self):
+        from django_redis import get_redis_connection
+        get_redis_connection("default").delete(*self.keys)
+
+    def test_increment_and_flush(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from users.models import UserMetrics
+        first = timezone.now() - timedelta(days=10)
+        future = timezone.now() + timedelta(days=1)
+        UserMetrics.objects.create(user=self.user, pdf_downloaded_counter=4,
+                                   first_activity_at=first, last_activity_at=future)
+
+        UserMetrics.increment(self.user.id, "pdf_downloaded_counter")
+        UserMetrics.increment(self.user.id, "pdf_downloaded_counter", 2)
+        UserMetrics.increment(self.user.id, "tasks_generated_counter", 5)
+        self.assertEqual(UserMetrics.pending(self.user.id, "pdf_downloaded_counter"), 3)
+
+        self.assertEqual(UserMetrics.flush_buffered(), 1)
+        metrics = UserMetrics.objects.get(user=self.user)
+        self.assertEqual((metrics.pdf_downloaded_counter, metrics.tasks_generated_counter), (7, 5))
+        # first_activity_at не перезаписывается (Coalesce), last_activity_at не уходит назад (Greatest)
+        self.assertEqual((metrics.first_activity_at, metrics.last_activity_at), (first, future))
+        self.assertEqual(UserMetrics.pending(self.user.id, "pdf_downloaded_counter"), 0)
+
+        # Пользователь без записи: создаётся и получает время активности
+        other = User.objects.create_user(username="metrics2", email="m2@example.com", password="pass", role="teacher")
+        UserMetrics.record_activity(other.id)
+        UserMetrics.flush_buffered()
+        other_metrics = UserMetrics.objects.get(user=other)
+        self.assertIsNotNone(other_metrics.first_activity_at)
+        self.assertEqual(other_metrics.first_activity_at, other_metrics.last_activity_at)
+        self.assertEqual(UserMetrics.objects.get(user=self.user).pdf_downloaded_counter, 7)
+
+    def test_pending_includes_snapshot_being_flushed(self):
+        from django_redis import get_redis_connection
+        from users.models import UserMetrics, METRICS_COUNTERS_KEY
+        UserMetrics.increment(self.user.id, "pdf_downloaded_counter", 2)
+        # Сброс забрал буфер, но ещё не записал его в БД
+        get_redis_connection("default").rename(METRICS_COUNTERS_KEY, f"{METRICS_COUNTERS_KEY}:flushing")
+        UserMetrics.increment(self.user.id, "pdf_downloaded_counter")
+        self.assertEqual(UserMetrics.pending(self.user.id, "pdf_downloaded_counter"), 3)
+
+    def test_concurrent_flush_is_skipped(self):
+        from django_redis import get_redis_connection
+        from hub.utils import redis_flush_lock_key
+        from users.models import UserMetrics, METRICS_COUNTERS_KEY
+        UserMetrics.objects.create(user=self.user)
+        UserMetrics.increment(self.user.id, "pdf_downloaded_counter", 2)
+
+        # Другой процесс держит блокировку сброса — второй сброс не должен учесть тот же снимок
+        lock = get_redis_connection("default").lock(redis_flush_lock_key(METRICS_COUNTERS_KEY), timeout=60)
+        self.assertTrue(lock.acquire(blocking=False))
+        try:
+            self.assertEqual(UserMetrics.flush_buffered(), 0)
+        finally:
+            lock.release()
+        self.assertEqual(UserMetrics.objects.get(user=self.user).pdf_downloaded_counter, 0)
+
+        self.assertEqual(UserMetrics.flush_buffered(), 1)
+        self.assertEqual(UserMetrics.flush_buffered(), 0)
+        self.assertEqual(UserMetrics.objects.get(user=self.user).pdf_downloaded_counter, 2)
+
+
+class TokenLedgerTest(TestCase):
+    def test_debit_reserve_commit_release(self):
+        from users.models import UserTokenBalance, TokenLedger
+        user = User.objects.create_user(username="spender", password="pass", role="teacher")
+        UserTokenBalance.objects.update_or_create(user=user, defaults={'tariff_tokens': 10, 'extra_tokens': 20})
+
+        def balance():
+            b = UserTokenBalance.objects.get(user=user)
+            return b.tariff_tokens, b.extra_tokens
+
+        # Сначала тарифные, затем докупленные; при нехватке ничего не списывается
+        self.assertTrue(UserTokenBalance.debit(user.id, 15))
+        self.assertEqual(balance(), (0, 15))
+        self.assertFalse(UserTokenBalance.debit(user.id, 16))
+        self.assertEqual(balance(), (0, 15))
+
+        # Резерв с недорасходом возвращает излишек
+        reservation = UserTokenBalance.reserve(user.id, 10)
+        self.assertEqual(balance(), (0, 5))
+        self.assertTrue(UserTokenBalance.commit_reservation(user.id, reservation, 4))
+        self.assertEqual(balance(), (0, 11))
+
+        reservation = UserTokenBalance.reserve(user.id, 5)
+        UserTokenBalance.release_reservation(user.id, reservation)
+        self.assertEqual(balance(), (0, 11))
+
+        ledger = TokenLedger.objects.filter(user=user)
+        self.assertEqual(sum(r.tariff_delta + r.extra_delta for r in ledger), 11 - 30)
+
+    def test_commit_overrun_without_funds_keeps_reservation_open(self):
+        from users.models import UserTokenBalance, TokenLedger
+        from hub.ai_calls import commit_tokens
+        user = User.objects.create_user(username="overrun", password="pass", role="teacher")
+        UserTokenBalance.credit(user.id, extra_amount=12)
+
+        reservation = UserTokenBalance.reserve(user.id, 10)
+        self.assertFalse(UserTokenBalance.commit_reservation(user.id, reservation, 15))
+        self.assertEqual(UserTokenBalance.objects.get(user=user).tokens, 2)
+        self.assertFalse(TokenLedger.objects.filter(reservation_id=reservation, kind="commit").exists())
+
+        # Обёртка возвращает резерв целиком
+        self.assertFalse(commit_tokens(user, reservation, 15))
+        self.assertEqual(UserTokenBalance.objects.get(user=user).tokens, 12)
+        ledger = TokenLedger.objects.filter(user=user)
+        self.assertEqual(sum(r.tariff_delta + r.extra_delta for r in ledger), 12)
+
+    def test_signup_bonus_and_opening_balance_are_in_ledger(self):
+        from importlib import import_module
+        from django.apps import apps
+        from users.models import UserTokenBalance, TokenLedger
+        migration = import_module("users.migrations.0012_tokenledger_opening_balances")
+
+        student = User.objects.create_user(username="student", password="pass", role="student")
+        self.client.force_login(student)
+        self.client.post(reverse("switch_role"), "{}", content_type="application/json")
+        self.assertEqual(TokenLedger.objects.get(user=student).extra_delta, 200)
+
+        # Баланс, появившийся до журнала
+        legacy = User.objects.create_user(username="legacy", email="legacy@example.com", password="pass")
+        UserTokenBalance.objects.create(user=legacy, tariff_tokens=30, extra_tokens=5)
+        migration.add_opening_balances(apps, None)
+        for user in (student, legacy):
+            balance = UserTokenBalance.objects.get(user=user)
+            ledger = TokenLedger.objects.filter(user=user)
+            self.assertEqual(sum(r.tariff_delta for r in ledger), balance.tariff_tokens)
+            self.assertEqual(sum(r.extra_delta for r in ledger), balance.extra_tokens)
 
-# Create your tests here.
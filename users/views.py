@@ -40,7 +40,7 @@ from hub.models import SiteErrorLog, UserContextLength
 from .tokens import generate_unsubscribe_token
 from api_endpoints import YANDEX_CLIENT_ID, YANDEX_CLIENT_SECRET, SMTPBZ_API_KEY
 
-from hub.views import activate_user_tariff
+from hub.views import activate_user_tariff, invalidate_home_fragments
 
 
 @login_required
@@ -227,7 +227,7 @@ def verify_email_view(request):
                             if registration_data.get('double_tokens'):
                                 extra_tokens *= 2
                             try:
-                                UserTokenBalance.objects.create(user=user, extra_tokens=extra_tokens, tariff_tokens=0)
+                                UserTokenBalance.credit(user.id, extra_amount=extra_tokens, reason='signup_bonus')
                             except Exception as e:
                                 logger.exception("Ошибка при создании UserTokenBalance: %s", e)
 
@@ -345,8 +345,7 @@ def verify_email_view(request):
                         else:
                             logger.info("Шаблон WELCOME не найден — приветственное письмо не отправлено.")
 
-                        metrics, _ = UserMetrics.objects.get_or_create(user=user)
-                        metrics.update_activity()
+                        UserMetrics.record_activity(user.id)
                     except Exception as e:
                         logger.exception("Непредвиденная ошибка при попытке отправить WELCOME письмо: %s", e)
 
@@ -575,6 +574,7 @@ def hide_notification(request, notification_id):
             notification=notif,
             defaults={'is_hidden': True, 'hidden_at': now()}
         )
+        invalidate_home_fragments(request.user.id)
     return redirect(request.META.get('HTTP_REFERER', '/'))
 
 